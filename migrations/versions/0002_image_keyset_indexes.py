@@ -0,0 +1,26 @@
+"""composite indexes for keyset pagination of images
+
+Revision ID: 0002
+Revises: 0001b
+Create Date: 2026-10-18 12:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = "0002"
+down_revision: Union[str, None] = "0001b"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_image_created_at_id", "image", ["created_at", "id"], unique=False)
+    op.create_index("ix_image_user_id_created_at_id", "image", ["user_id", "created_at", "id"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_image_user_id_created_at_id", table_name="image")
+    op.drop_index("ix_image_created_at_id", table_name="image")
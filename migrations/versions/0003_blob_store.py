@@ -0,0 +1,43 @@
+"""content-addressed blob store: blob table and image.blob_hash
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 14:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "blob",
+        sa.Column("sha256", sa.String(length=64), nullable=False),
+        sa.Column("file_path", sa.String(), nullable=False),
+        sa.Column("resolution", sa.String(), nullable=False),
+        sa.Column("size", sa.Integer(), nullable=False),
+        sa.Column("content_hash", sa.String(length=64), nullable=True),
+        sa.Column("refcount", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("sha256"),
+    )
+    with op.batch_alter_table("image") as batch_op:
+        batch_op.add_column(sa.Column("blob_hash", sa.String(length=64), nullable=True))
+        batch_op.create_index("ix_image_blob_hash", ["blob_hash"], unique=False)
+        batch_op.create_foreign_key("fk_image_blob_hash_blob", "blob", ["blob_hash"], ["sha256"])
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("image") as batch_op:
+        batch_op.drop_constraint("fk_image_blob_hash_blob", type_="foreignkey")
+        batch_op.drop_index("ix_image_blob_hash")
+        batch_op.drop_column("blob_hash")
+    op.drop_table("blob")
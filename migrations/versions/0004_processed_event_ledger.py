@@ -0,0 +1,34 @@
+"""processed_event ledger for idempotent event processing
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 15:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0004"
+down_revision: Union[str, None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "processed_event",
+        sa.Column("message_id", sa.String(length=64), nullable=False),
+        sa.Column("event_type", sa.String(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.Column("processed_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("message_id"),
+    )
+    op.create_index("ix_processed_event_processed_at", "processed_event", ["processed_at"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_processed_event_processed_at", table_name="processed_event")
+    op.drop_table("processed_event")
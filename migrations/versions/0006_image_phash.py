@@ -0,0 +1,29 @@
+"""image.phash: perceptual hash for near-duplicate search
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 18:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0006"
+down_revision: Union[str, None] = "0005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("image") as batch_op:
+        batch_op.add_column(sa.Column("phash", sa.BigInteger(), nullable=True))
+        batch_op.create_index("ix_image_phash", ["phash"], unique=False)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("image") as batch_op:
+        batch_op.drop_index("ix_image_phash")
+        batch_op.drop_column("phash")
@@ -0,0 +1,475 @@
+import json
+import logging
+import functools
+
+from collections import Counter
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import select, insert, update, bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+
+from apps.image_service.db import acquire_blob, delete_images, find_processed_blob
+from apps.image_service.dto import ImageUpdate
+from apps.image_service.jobs import JOB_DONE, start_jobs, fail_job
+from apps.image_service.ledger import ledger
+from apps.image_service.processor import upload_source, release_upload_source
+from apps.image_service.retry import is_retryable, schedule_retry
+from apps.image_service.worker_pool import (
+    render_in_worker,
+    render_bulk_in_worker,
+    process_pool_context,
+    ImageProcessingError
+)
+from apps.libs.broker.backend import consumer_connection
+from apps.libs.broker.topology import consumer_channels
+from apps.libs.config.core_config import core_config
+from apps.libs.database.database import SessionLocal
+from apps.libs.database.models import Image, Job, ProcessedEvent, Rendition, User
+from apps.libs.metrics.metrics import observe_queue_lag, observe_stages, timed_stage, track_in_flight
+from apps.libs.storage.blobs import file_sha256, remove_blob_files
+from apps.libs.tracing.tracing import current_span, message_span, start_span
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class BatchItem:
+    def __init__(self, method, properties, body):
+        self.method = method
+        self.delivery_tag = method.delivery_tag
+        self.properties = properties
+        self.body = body
+        # спан сообщения живет до подтверждения пачки
+        self.span = message_span("process", properties)
+        self.message_id = None
+        self.event_type = None
+        self.data = None
+        self.processed = None
+        # poison - сообщение нельзя обработать, его нужно отклонить, не ломая пачку
+        self.poison = False
+        # duplicate - повторная доставка уже обработанного события, подтверждается без обработки
+        self.duplicate = False
+        # retrying - временная ошибка, сообщение уйдет в очередь задержки
+        self.retrying = False
+        self.error = None
+
+    def reject(self, error: str):
+        self.poison = True
+        self.error = error
+
+    def retry(self, error: str):
+        self.retrying = True
+        self.error = error
+
+    def fail(self, error: Exception, detail: str = "Image processing failed"):
+        if is_retryable(error):
+            self.retry(str(error))
+        else:
+            self.reject(detail)
+
+    @property
+    def settled(self) -> bool:
+        return self.poison or self.retrying
+
+    def parse(self):
+        message = json.loads(self.body)
+        self.message_id = message.get('message_id')
+        self.event_type = message['event_type']
+        self.data = message['data']
+        if self.event_type not in ('UPLOAD', 'UPDATE', 'DELETE'):
+            raise ValueError(f"Unknown event type: {self.event_type}")
+
+
+class BatchImageConsumer:
+    """
+    Копит до image_batch_size сообщений или image_batch_timeout_ms миллисекунд,
+    затем применяет всю пачку одной транзакцией bulk-запросами и подтверждает
+    ее одним basic_ack(multiple=True). Сообщения, которые не удалось разобрать
+    или применить, отклоняются по отдельности, при временных ошибках -
+    отправляются на повтор с задержкой.
+
+    С batch_thread пачка обрабатывается в этом потоке, а не в потоке
+    соединения: рендер большой пачки не задерживает heartbeat, и брокер не
+    разрывает соединение посреди пачки. Подтверждения отправляются из
+    потока соединения через add_callback_threadsafe. Пока пачка в работе,
+    новые сообщения только копятся.
+    """
+
+    def __init__(
+            self,
+            connection,
+            channel,
+            executor=None,
+            batch_size: int = core_config.image_batch_size,
+            batch_timeout_ms: int = core_config.image_batch_timeout_ms,
+            batch_thread=None
+    ):
+        self.connection = connection
+        self.channel = channel
+        self.executor = executor
+        self.batch_thread = batch_thread
+        # (сообщения, future) пачки, которая обрабатывается в batch_thread
+        self.pending = None
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout_ms / 1000
+        self.items = []
+        self.timer = None
+
+    def on_message(self, ch, method, properties, body):
+        observe_queue_lag(method, properties)
+        self.items.append(BatchItem(method, properties, body))
+        if self.pending is not None:
+            return
+        if len(self.items) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.connection.call_later(self.batch_timeout, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.connection.remove_timeout(self.timer)
+            self.timer = None
+        items, self.items = self.items, []
+        if not items:
+            return
+
+        if self.batch_thread is None:
+            self.settle(items, self.process(items))
+            return
+        future = self.batch_thread.submit(self.process, items)
+        self.pending = (items, future)
+        future.add_done_callback(lambda done: self.connection.add_callback_threadsafe(
+            functools.partial(self.finish, items, done)
+        ))
+
+    def process(self, items) -> str:
+        # у пачки своя трасса: сообщения в ней из разных запросов, связь - через batch_trace_id
+        with start_span("batch", size=len(items)) as batch_span, ExitStack() as resources:
+            self.process_batch(items, resources)
+        return batch_span.trace_id
+
+    def finish(self, items, future):
+        if self.pending is None or self.pending[1] is not future:
+            # пачку уже подтвердил drain
+            return
+        self.pending = None
+        self.settle(items, future.result())
+        if len(self.items) >= self.batch_size:
+            self.flush()
+        elif self.items and self.timer is None:
+            self.timer = self.connection.call_later(self.batch_timeout, self.on_timer)
+
+    def drain(self):
+        """
+        Остановка: дожидается пачки в обработке и обрабатывает накопленные
+        сообщения в текущем потоке.
+        """
+        self.batch_thread = None
+        if self.pending is not None:
+            items, future = self.pending
+            future.exception()
+            self.finish(items, future)
+        self.flush()
+
+    def settle(self, items, batch_trace_id: str):
+        for item in items:
+            if item.retrying:
+                if schedule_retry(
+                        self.channel, item.method.routing_key, item.properties, item.body, item.message_id, item.error
+                ):
+                    continue
+                # попытки исчерпаны: schedule_retry уже завершил задачу и удалил исходник загрузки
+                item.poison = True
+            elif item.poison:
+                if item.event_type == 'UPLOAD':
+                    fail_job(item.message_id, item.error or "Image processing failed")
+                    release_upload_source(item.data)
+            elif item.event_type == 'UPLOAD':
+                release_upload_source(item.data)
+            if item.poison:
+                self.channel.basic_nack(delivery_tag=item.delivery_tag, requeue=False)
+        acked = [item for item in items if not item.poison]
+        if acked:
+            self.channel.basic_ack(delivery_tag=acked[-1].delivery_tag, multiple=True)
+        for item in items:
+            item.span.set(message_id=item.message_id, event_type=item.event_type, batch_trace_id=batch_trace_id)
+            if item.error:
+                item.span.set(error=item.error)
+            item.span.finish()
+        logger.info("Batch of %s messages processed", len(items))
+
+    def process_batch(self, items, resources):
+        for item in items:
+            try:
+                item.parse()
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"Malformed message dropped: {e}")
+                item.poison = True
+        items = [item for item in items if not item.poison]
+        resources.enter_context(track_in_flight(item.event_type for item in items))
+
+        with SessionLocal() as db:
+            user_ids = {item.data.get('user_id') for item in items}
+            known_users = set(db.scalars(select(User.id).where(User.id.in_(user_ids))))
+            for item in items:
+                if item.data.get('user_id') not in known_users:
+                    logger.error("User not found: %s", item.data.get('user_id'))
+                    if item.event_type == 'UPLOAD':
+                        fail_job(item.message_id, "User not found")
+            items = [item for item in items if item.data.get('user_id') in known_users]
+
+            batch_ids = set()
+            for item in items:
+                if item.message_id and (item.message_id in batch_ids or ledger.seen(item.message_id, db)):
+                    logger.info("Duplicate event %s skipped", item.message_id)
+                    item.duplicate = True
+                batch_ids.add(item.message_id)
+            items = [item for item in items if not item.duplicate]
+
+            start_jobs([item.message_id for item in items if item.event_type == 'UPLOAD'])
+            self.render_uploads([item for item in items if item.event_type == 'UPLOAD'], resources, db)
+            items = [item for item in items if not item.settled]
+
+            try:
+                released = self.apply(items, db)
+                with timed_stage("db_commit"):
+                    db.commit()
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Bulk apply failed, retrying batch message by message: {e}")
+                released = self.apply_one_by_one(items, db)
+            remove_blob_files(released)
+            ledger.remember(item.message_id for item in items if not item.settled and not item.duplicate)
+
+    def render_uploads(self, uploads, resources, db):
+        sources = []
+        duplicates = []
+        known = {}
+        for item in uploads:
+            try:
+                path = resources.enter_context(upload_source(item.data))
+                sha256 = item.data.get('sha256') or file_sha256(path)
+            except Exception as e:
+                logger.error(f"Unhandled exception: {str(e)}")
+                item.fail(e)
+                continue
+
+            # уже обработанный исходник не декодируется, одинаковые загрузки в пачке рендерятся один раз
+            if sha256 not in known:
+                known[sha256] = find_processed_blob(sha256, item.data['title'], db)
+                if known[sha256] is None:
+                    sources.append((item, path, sha256))
+                    continue
+            duplicates.append((item, sha256))
+
+        if core_config.image_bulk_ingest:
+            results = self.render_bulk(sources)
+        elif self.executor is not None:
+            futures = [
+                (item, self.executor.submit(
+                    render_in_worker, path, item.data['title'], sha256, item.span.traceparent
+                ))
+                for item, path, sha256 in sources
+            ]
+            results = []
+            for item, future in futures:
+                try:
+                    results.append((item, future.result()))
+                except Exception as e:
+                    results.append((item, e))
+        else:
+            results = []
+            for item, path, sha256 in sources:
+                try:
+                    results.append((item, render_in_worker(path, item.data['title'], sha256, item.span.traceparent)))
+                except Exception as e:
+                    results.append((item, e))
+
+        for item, result in results:
+            if isinstance(result, ImageProcessingError):
+                logger.error(f"HTTPException occurred: {result}")
+                item.reject(str(result))
+            elif isinstance(result, Exception):
+                logger.error(f"Unhandled exception: {str(result)}")
+                item.fail(result)
+            else:
+                observe_stages(result.get("timings", {}))
+                item.processed = result
+                known[result["blob_hash"]] = result
+
+        failed = {sha256: item for item, _, sha256 in sources if item.settled}
+        for item, sha256 in duplicates:
+            if known.get(sha256) is None:
+                logger.error("Duplicate upload %s skipped: source failed to process", sha256)
+                source = failed.get(sha256)
+                if source is not None and source.retrying:
+                    item.retry(source.error)
+                else:
+                    item.reject("Image processing failed")
+            else:
+                item.processed = {**known[sha256], "title": item.data['title']}
+
+    def render_bulk(self, sources) -> list:
+        """
+        Массовая загрузка: исходники рендерятся кусками, каждый кусок - одна
+        задача пула процессов с векторным переводом в оттенки серого.
+        """
+        size = max(1, core_config.image_bulk_chunk_size)
+        chunks = [sources[start:start + size] for start in range(0, len(sources), size)]
+        batch = current_span.get()
+        traceparent = batch.traceparent if batch is not None else None
+        arguments = [[(path, item.data['title'], sha256) for item, path, sha256 in chunk] for chunk in chunks]
+
+        outcomes = []
+        if self.executor is not None:
+            futures = [self.executor.submit(render_bulk_in_worker, chunk, traceparent) for chunk in arguments]
+            for chunk, future in zip(chunks, futures):
+                try:
+                    outcomes.extend(future.result())
+                except Exception as e:
+                    outcomes.extend([e] * len(chunk))
+        else:
+            for chunk in arguments:
+                outcomes.extend(render_bulk_in_worker(chunk, traceparent))
+        return [(item, outcome) for (item, _, _), outcome in zip(sources, outcomes)]
+
+    def apply(self, items, db) -> list:
+        """
+        Применяет пачку. Возвращает пути файлов блобов, на которые больше
+        никто не ссылается: их удаляют после commit.
+        """
+        now = datetime.utcnow()
+
+        events = [
+            {"message_id": item.message_id, "event_type": item.event_type, "user_id": item.data['user_id']}
+            for item in items if item.message_id
+        ]
+        if events:
+            db.execute(insert(ProcessedEvent), events)
+
+        uploads = [item for item in items if item.event_type == 'UPLOAD']
+        if uploads:
+            references = Counter(item.processed["blob_hash"] for item in uploads)
+            for item in {item.processed["blob_hash"]: item for item in uploads}.values():
+                acquire_blob(item.processed, db, references[item.processed["blob_hash"]])
+            image_ids = db.scalars(insert(Image).returning(Image.id, sort_by_parameter_order=True), [
+                {
+                    "title": item.processed["title"],
+                    "file_path": item.processed["file_path"],
+                    "resolution": item.processed["resolution"],
+                    "size": item.processed["size"],
+                    "content_hash": item.processed["content_hash"],
+                    "blob_hash": item.processed["blob_hash"],
+                    "phash": item.processed.get("phash"),
+                    "user_id": item.data['user_id'],
+                    "created_at": now,
+                    "updated_at": now
+                }
+                for item in uploads
+            ]).all()
+            renditions = [
+                {**rendition, "image_id": image_id}
+                for image_id, item in zip(image_ids, uploads)
+                for rendition in item.processed.get("renditions", [])
+            ]
+            if renditions:
+                db.execute(insert(Rendition), renditions)
+            jobs = [
+                {"job_id": item.message_id, "done_image_id": image_id}
+                for image_id, item in zip(image_ids, uploads) if item.message_id
+            ]
+            if jobs:
+                # таблица, а не модель: обычный executemany, задачи могут и отсутствовать
+                job_table = Job.__table__
+                db.execute(
+                    update(job_table)
+                    .where(job_table.c.id == bindparam("job_id"))
+                    .values(status=JOB_DONE, image_id=bindparam("done_image_id"), updated_at=now),
+                    jobs
+                )
+
+        changes = [item for item in items if item.event_type in ('UPDATE', 'DELETE')]
+        if not changes:
+            return []
+
+        owners = dict(db.execute(
+            select(Image.id, Image.user_id).where(Image.id.in_({item.data['image_id'] for item in changes}))
+        ).all())
+
+        updates = {}
+        deletes = set()
+        for item in changes:
+            image_id = item.data['image_id']
+            if owners.get(image_id) != item.data['user_id']:
+                logger.error("HTTPException occurred: Image not found")
+                continue
+            if item.event_type == 'DELETE':
+                deletes.add(image_id)
+                updates.pop(image_id, None)
+            elif image_id not in deletes:
+                new_data = ImageUpdate(**item.data['new_data']).dict(exclude_unset=True)
+                updates.setdefault(image_id, {"id": image_id}).update(new_data, updated_at=now)
+
+        if updates:
+            db.execute(update(Image), list(updates.values()))
+        if not deletes:
+            return []
+        images = db.scalars(
+            select(Image).where(Image.id.in_(deletes)).options(selectinload(Image.renditions))
+        ).all()
+        return delete_images(images, db)
+
+    def apply_one_by_one(self, items, db) -> list:
+        released = []
+        for item in items:
+            try:
+                with db.begin_nested():
+                    item_released = self.apply([item], db)
+                released.extend(item_released)
+            except IntegrityError as e:
+                if ledger.is_recorded(item.message_id, db):
+                    logger.info("Duplicate event %s already processed by another worker", item.message_id)
+                    item.duplicate = True
+                else:
+                    logger.error(f"Unhandled exception: {str(e)}")
+                    item.retry(str(e))
+            except Exception as e:
+                logger.error(f"Unhandled exception: {str(e)}")
+                item.fail(e)
+        db.commit()
+        return released
+
+
+def start_image_batch_consumer():
+    connection = consumer_connection()
+    # prefetch не меньше размера пачки, иначе пачка никогда не наберется
+    prefetch = max(core_config.image_worker_prefetch, core_config.image_batch_size)
+
+    # один поток пачек на все очереди: пачки, как и раньше, обрабатываются по одной
+    with ProcessPoolExecutor(
+            max_workers=core_config.image_worker_processes, mp_context=process_pool_context()
+    ) as executor, ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-batch") as batch_thread:
+        consumers = []
+        channels = consumer_channels(connection, prefetch)
+        for queue, channel in channels:
+            consumer = BatchImageConsumer(connection, channel, executor, batch_thread=batch_thread)
+            channel.basic_consume(queue=queue, on_message_callback=consumer.on_message)
+            consumers.append(consumer)
+        logger.info(
+            "Image batch consumer started: batch size %s, timeout %s ms",
+            core_config.image_batch_size, core_config.image_batch_timeout_ms
+        )
+        try:
+            channels[0][1].start_consuming()
+        except KeyboardInterrupt:
+            for (_, channel), consumer in zip(channels, consumers):
+                channel.stop_consuming()
+                consumer.drain()
+            connection.close()
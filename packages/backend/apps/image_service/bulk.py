@@ -0,0 +1,116 @@
+import os
+import time
+
+from collections import defaultdict
+
+import numpy as np
+
+from fastapi import HTTPException
+from PIL import Image as PILImage
+
+from apps.image_service.db import processed_result, source_sha256
+from apps.image_service.renditions import PRIMARY_PRESET, configured_presets, render_frames, write_rendition
+from apps.libs.storage.blobs import blob_directory, blob_basename
+from apps.libs.storage.image_guard import check_image_source
+from apps.libs.tracing.tracing import start_span
+
+# Коэффициенты Pillow для RGB -> L (ITU-R 601-2 в фиксированной точке 16.16):
+# результат совпадает с convert("L") побайтно, хэши содержимого не меняются
+LUMA_WEIGHTS = (np.uint32(19595), np.uint32(38470), np.uint32(7471))
+
+
+def grayscale_frames(frames: list) -> list:
+    """
+    Переводит RGB/RGBA-кадры одного размера в оттенки серого одной векторной
+    операцией по всей пачке вместо convert("L") для каждого кадра.
+    """
+    stack = np.stack([np.asarray(frame)[..., :3] for frame in frames])
+    # два буфера на всю пачку вместо временного массива на каждую операцию
+    luma = np.multiply(stack[..., 0], LUMA_WEIGHTS[0], dtype=np.uint32)
+    channel = np.empty_like(luma)
+    for index in (1, 2):
+        np.multiply(stack[..., index], LUMA_WEIGHTS[index], out=channel, dtype=np.uint32)
+        luma += channel
+    luma += np.uint32(0x8000)
+    luma >>= 16
+    return [PILImage.fromarray(plane) for plane in luma.astype(np.uint8)]
+
+
+def convert_deferred(rendered: list, presets: list):
+    """
+    Кадры пресетов в оттенках серого, оставленные в RGB/RGBA, группируются
+    по размеру (основной кадр 500x500 у всех исходников одинаковый) и
+    переводятся в L по группе.
+    """
+    groups = defaultdict(list)
+    for entry in rendered:
+        frames = entry["frames"]
+        for position, (frame, _) in enumerate(frames):
+            if presets[position].mode == "L" and frame.mode != "L":
+                groups[frame.size].append((frames, position))
+    if not groups:
+        return
+
+    started = time.perf_counter()
+    with start_span("grayscale", frames=sum(len(group) for group in groups.values())):
+        for group in groups.values():
+            converted = grayscale_frames([frames[position][0] for frames, position in group])
+            for (frames, position), frame in zip(group, converted):
+                frames[position] = (frame, frames[position][1])
+    # стадия общая для пачки, на каждое изображение приходится ее доля
+    share = (time.perf_counter() - started) / len(rendered)
+    for entry in rendered:
+        entry["timings"]["grayscale"] = share
+
+
+def process_image_files(sources: list) -> list:
+    """
+    Пакетный вариант process_image_file для массовой загрузки. sources -
+    список (source, filename, sha256). Декодирование, resize и кодирование
+    остаются поштучными, перевод в оттенки серого делается для всей пачки.
+    Возвращает по элементу на исходник: результат или исключение, ошибка
+    одного файла не ломает пачку.
+    """
+    presets = [PRIMARY_PRESET, *configured_presets()]
+    results = [None] * len(sources)
+    rendered = []
+
+    for index, (source, filename, sha256) in enumerate(sources):
+        timings = {}
+        try:
+            sha256 = sha256 or source_sha256(source)
+            directory = blob_directory(sha256)
+            os.makedirs(directory, exist_ok=True)
+            check_image_source(source)
+            started = time.perf_counter()
+            with PILImage.open(source) as img:
+                frames = render_frames(img, presets, timings, started, defer_grayscale=True)
+                # исходник закрывается сразу: в пачке копятся только готовые кадры
+                frames = [(frame.copy() if frame is img else frame, img_format) for frame, img_format in frames]
+        except (IOError, SyntaxError):
+            results[index] = HTTPException(status_code=400, detail="Invalid image file")
+            continue
+        except Exception as e:
+            results[index] = e
+            continue
+        rendered.append({
+            "index": index, "filename": filename, "sha256": sha256,
+            "directory": directory, "frames": frames, "timings": timings
+        })
+
+    convert_deferred(rendered, presets)
+
+    for entry in rendered:
+        basename = blob_basename(entry["sha256"], entry["filename"])
+        try:
+            primary, *renditions = [
+                write_rendition(frame, img_format, preset, entry["directory"], basename, entry["timings"])
+                for preset, (frame, img_format) in zip(presets, entry["frames"])
+            ]
+        except Exception as e:
+            results[entry["index"]] = e
+            continue
+        results[entry["index"]] = processed_result(
+            entry["filename"], entry["sha256"], primary, renditions, entry["timings"]
+        )
+    return results
@@ -1,13 +1,20 @@
 import os
 import logging
 
+from collections import Counter
 from datetime import datetime
-from PIL import Image as PILImage
 from fastapi import HTTPException, UploadFile
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from apps.image_service.dto import ImageUpdate
-from apps.libs.database.models import Image, User
+from apps.image_service.jobs import JOB_DONE, update_jobs
+from apps.image_service.renditions import PRIMARY_PRESET, configured_presets, render_renditions
+from apps.libs.database.models import Blob, Image, Rendition, User
+from apps.libs.metrics.metrics import observe_stages, timed_stage
+from apps.libs.storage.image_guard import check_image_source
+from apps.libs.storage.blobs import blob_directory, blob_basename, file_sha256, hash_file, remove_blob_files
 
 
 logging.basicConfig(level=logging.INFO)
@@ -41,46 +48,195 @@ def service_delete_image(
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    db.delete(image)
+    released = delete_images([image], db)
     db.commit()
+    remove_blob_files(released)
 
     return
 
 
-def save_processed_image(image: UploadFile, db: Session, current_user) -> Image:
-    default_size = (500, 500)
-
-    directory = "storage"
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    processed_path = os.path.join(directory, f"{timestamp}_{image.filename}")
+def delete_images(images, db: Session) -> list:
+    """
+    Удаляет изображения и снимает их ссылки на блобы. Возвращает пути файлов,
+    на которые больше никто не ссылается; удалять их нужно после commit.
+    """
+    released = []
+    references = Counter()
+    blob_files = {}
+    for image in images:
+        paths = [image.file_path, *(rendition.file_path for rendition in image.renditions)]
+        if image.blob_hash is None:
+            # файлы старых изображений (до хранилища блобов) принадлежат только им
+            released.extend(paths)
+        else:
+            references[image.blob_hash] += 1
+            blob_files[image.blob_hash] = paths
+        db.delete(image)
+    # изображения удаляются раньше блобов, на которые они ссылаются
+    db.flush()
+
+    for blob_hash, count in references.items():
+        db.execute(update(Blob).where(Blob.sha256 == blob_hash).values(refcount=Blob.refcount - count))
+    if references:
+        orphaned = db.scalars(
+            select(Blob.sha256).where(Blob.sha256.in_(references), Blob.refcount <= 0)
+        ).all()
+        if orphaned:
+            db.execute(delete(Blob).where(Blob.sha256.in_(orphaned)))
+        for blob_hash in orphaned:
+            released.extend(blob_files[blob_hash])
+
+    return released
+
+
+def source_sha256(source) -> str:
+    if isinstance(source, (str, os.PathLike)):
+        return file_sha256(source)
+    return hash_file(source)
+
+
+def process_image_file(source, filename: str, sha256: str = None) -> dict:
+    """
+    CPU-часть обработки: основной файл и рендишены из одного декодирования,
+    без обращения к БД. Принимает путь или файловый объект, результат можно
+    передать между процессами. Файлы кладутся в каталог блоба по sha256
+    исходника, поэтому одинаковые загрузки не затирают и не дублируют друг друга.
+    """
+    sha256 = sha256 or source_sha256(source)
+    directory = blob_directory(sha256)
+    os.makedirs(directory, exist_ok=True)
+    timings = {}
 
     try:
-        with PILImage.open(image.file) as img:
-            img_format = img.format
-
-            img_resized = img.resize(default_size).convert("L")
-            img_resized.save(processed_path, format=img_format)
-
-            final_width, final_height = img_resized.size
-            image_size = os.path.getsize(processed_path)
+        # лимиты размера проверяются и здесь: сообщение могло прийти не через API
+        check_image_source(source)
+        primary, *renditions = render_renditions(
+            source,
+            [PRIMARY_PRESET, *configured_presets()],
+            directory,
+            blob_basename(sha256, filename),
+            timings
+        )
     except (IOError, SyntaxError) as e:
         raise HTTPException(status_code=400, detail="Invalid image file")
 
+    return processed_result(filename, sha256, primary, renditions, timings)
+
+
+def processed_result(filename: str, sha256: str, primary: dict, renditions: list, timings: dict) -> dict:
+    return {
+        "title": filename,
+        "file_path": primary["file_path"],
+        "resolution": f"{primary['width']}x{primary['height']}",
+        "size": primary["size"],
+        "content_hash": primary["content_hash"],
+        "blob_hash": sha256,
+        "phash": primary["phash"],
+        "renditions": renditions,
+        "timings": timings
+    }
+
+
+def find_processed_blob(sha256: str, filename: str, db: Session):
+    """
+    Результат обработки уже известного исходника без декодирования: метаданные
+    из Blob, рендишены - с любого изображения, ссылающегося на тот же блоб.
+    None, если блоба нет или его файлы пропали.
+    """
+    blob = db.get(Blob, sha256)
+    if blob is None or blob.refcount <= 0 or not os.path.exists(blob.file_path):
+        return None
+
+    sibling = db.scalar(select(Image).where(Image.blob_hash == sha256).limit(1))
+    renditions = [
+        {
+            "name": rendition.name,
+            "file_path": rendition.file_path,
+            "width": rendition.width,
+            "height": rendition.height,
+            "format": rendition.format,
+            "size": rendition.size,
+            "content_hash": rendition.content_hash
+        }
+        for rendition in (sibling.renditions if sibling else [])
+    ]
+    return {
+        "title": filename,
+        "file_path": blob.file_path,
+        "resolution": blob.resolution,
+        "size": blob.size,
+        "content_hash": blob.content_hash,
+        "blob_hash": sha256,
+        "phash": sibling.phash if sibling else None,
+        "renditions": renditions
+    }
+
+
+def acquire_blob(processed: dict, db: Session, references: int = 1):
+    """
+    Добавляет ссылки на блоб, при первой ссылке создает запись Blob.
+    Инкремент атомарный, одновременная вставка того же блоба другим
+    воркером превращается в инкремент.
+    """
+    increment = update(Blob).where(Blob.sha256 == processed["blob_hash"]).values(
+        refcount=Blob.refcount + references
+    )
+    if db.execute(increment).rowcount:
+        return
+
+    try:
+        with db.begin_nested():
+            db.add(Blob(
+                sha256=processed["blob_hash"],
+                file_path=processed["file_path"],
+                resolution=processed["resolution"],
+                size=processed["size"],
+                content_hash=processed["content_hash"],
+                refcount=references
+            ))
+    except IntegrityError:
+        db.execute(increment)
+
+
+def create_image_record(processed: dict, db: Session, current_user, job_id: str = None) -> Image:
+    acquire_blob(processed, db)
     db_image = Image(
-        title=image.filename,
-        file_path=processed_path,
-        resolution=f"{final_width}x{final_height}",
-        size=image_size,
+        title=processed["title"],
+        file_path=processed["file_path"],
+        resolution=processed["resolution"],
+        size=processed["size"],
+        content_hash=processed["content_hash"],
+        blob_hash=processed["blob_hash"],
+        phash=processed.get("phash"),
         user_id=current_user.id,
         created_at=datetime.utcnow(),
-        updated_at=datetime.utcnow()
+        updated_at=datetime.utcnow(),
+        renditions=[Rendition(**rendition) for rendition in processed.get("renditions", [])]
     )
     db.add(db_image)
-    db.commit()
+    db.flush()
+    # задача завершается в той же транзакции, что и создание изображения
+    update_jobs([job_id], JOB_DONE, db, image_id=db_image.id)
+    with timed_stage("db_commit"):
+        db.commit()
     db.refresh(db_image)
     logger.info("Save processed image to database")
 
     return db_image
+
+
+def save_processed_image(
+        image: UploadFile,
+        db: Session,
+        current_user,
+        sha256: str = None,
+        job_id: str = None
+) -> Image:
+    sha256 = sha256 or hash_file(image.file)
+    processed = find_processed_blob(sha256, image.filename, db)
+    if processed is None:
+        processed = process_image_file(image.file, image.filename, sha256)
+        observe_stages(processed["timings"])
+    else:
+        logger.info("Known blob %s, decode skipped", sha256)
+    return create_image_record(processed, db, current_user, job_id)
@@ -0,0 +1,54 @@
+import logging
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from apps.libs.database.database import SessionLocal
+from apps.libs.database.models import Job
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_PROCESSING = "processing"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+def update_jobs(job_ids, status: str, db: Session, **values):
+    """
+    Меняет статус задач в текущей транзакции. События без задачи (старые
+    сообщения, update/delete) просто не находят строк.
+    """
+    job_ids = [job_id for job_id in job_ids if job_id]
+    if job_ids:
+        db.execute(update(Job).where(Job.id.in_(job_ids)).values(status=status, **values))
+
+
+def start_jobs(job_ids):
+    with SessionLocal() as db:
+        update_jobs(job_ids, JOB_PROCESSING, db)
+        db.commit()
+
+
+def fail_job(job_id, error: str):
+    if not job_id:
+        return
+    try:
+        with SessionLocal() as db:
+            update_jobs([job_id], JOB_FAILED, db, error=error)
+            db.commit()
+    except Exception as e:
+        logger.error(f"Failed to mark job {job_id} as failed: {e}")
+
+
+def requeue_job(job_id, error: str):
+    # сообщение ушло на повтор: задача снова ждет в очереди, error объясняет задержку
+    if not job_id:
+        return
+    try:
+        with SessionLocal() as db:
+            update_jobs([job_id], JOB_QUEUED, db, error=error)
+            db.commit()
+    except Exception as e:
+        logger.error(f"Failed to requeue job {job_id}: {e}")
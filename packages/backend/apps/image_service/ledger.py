@@ -0,0 +1,129 @@
+import math
+import hashlib
+import logging
+import threading
+
+from collections import OrderedDict
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from apps.libs.config.core_config import core_config
+from apps.libs.database.models import ProcessedEvent
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        # двойное хэширование: k позиций из одного 128-битного дайджеста
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class EventLedger:
+    """
+    Проверка, обрабатывалось ли событие с данным message_id.
+
+    Последние id хранятся в LRU (точный ответ "да"), остальные - в bloom-фильтре:
+    если фильтр говорит "нет", событие точно новое и к БД можно не ходить.
+    В БД идем только при положительном ответе фильтра. Уникальный ключ таблицы
+    processed_event страхует от гонок и от всего, что фильтр забыл после сброса.
+    """
+
+    def __init__(
+            self,
+            recent_size: int = core_config.event_ledger_recent_size,
+            bloom_capacity: int = core_config.event_ledger_bloom_capacity,
+            bloom_error_rate: float = core_config.event_ledger_bloom_error_rate
+    ):
+        self.recent_size = recent_size
+        self.bloom_error_rate = bloom_error_rate
+        self.recent = OrderedDict()
+        self.bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(("recent_hits", "bloom_negatives", "db_lookups", "duplicates"), 0)
+
+    def warm(self, db: Session):
+        """
+        Заполняет фильтр id из журнала, чтобы повторы после рестарта воркера
+        тоже отсекались без лишней обработки.
+        """
+        message_ids = db.scalars(
+            select(ProcessedEvent.message_id)
+            .order_by(ProcessedEvent.processed_at.desc())
+            .limit(self.bloom.capacity)
+        ).all()
+        self.remember(reversed(message_ids))
+        logger.info("Event ledger warmed with %s message ids", len(message_ids))
+
+    def seen(self, message_id: str, db: Session) -> bool:
+        if not message_id:
+            return False
+        with self._lock:
+            if message_id in self.recent:
+                self.recent.move_to_end(message_id)
+                self.counters["recent_hits"] += 1
+                self.counters["duplicates"] += 1
+                return True
+            if message_id not in self.bloom:
+                self.counters["bloom_negatives"] += 1
+                return False
+            self.counters["db_lookups"] += 1
+
+        return self.is_recorded(message_id, db)
+
+    def is_recorded(self, message_id: str, db: Session) -> bool:
+        found = message_id is not None and db.get(ProcessedEvent, message_id) is not None
+        if found:
+            self.remember([message_id])
+            with self._lock:
+                self.counters["duplicates"] += 1
+        return found
+
+    def record(self, message_id: str, event_type: str, user_id, db: Session):
+        """
+        Добавляет запись в текущую транзакцию, commit делает обработчик события.
+        flush сразу, чтобы дубликат, который параллельно обрабатывает другой воркер,
+        упал на уникальном ключе (IntegrityError) до начала обработки.
+        """
+        if message_id:
+            db.add(ProcessedEvent(message_id=message_id, event_type=event_type, user_id=user_id))
+            db.flush()
+
+    def remember(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                if not message_id:
+                    continue
+                self.recent[message_id] = None
+                self.recent.move_to_end(message_id)
+                if self.bloom.count >= self.bloom.capacity:
+                    # переполненный фильтр теряет точность: начинаем новый с последних id
+                    self.bloom = BloomFilter(self.bloom.capacity, self.bloom_error_rate)
+                    for recent_id in self.recent:
+                        self.bloom.add(recent_id)
+                self.bloom.add(message_id)
+            while len(self.recent) > self.recent_size:
+                self.recent.popitem(last=False)
+
+
+ledger = EventLedger()
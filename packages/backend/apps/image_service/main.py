@@ -1,5 +1,53 @@
+import threading
+import logging
+
+from apps.libs.broker.backend import close_consumer_connections
+from apps.libs.config.core_config import core_config
+from apps.image_service.batch_consumer import start_image_batch_consumer
+from apps.image_service.ledger import ledger
 from apps.image_service.processor import start_image_listener
+from apps.image_service.worker_pool import start_image_worker_pool
+from apps.libs.database.database import SessionLocal
+from apps.libs.metrics.metrics import start_metrics_server
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+worker_thread = None
+
+
+def run_image_worker():
+    with SessionLocal() as db:
+        ledger.warm(db)
+
+    if core_config.image_worker_mode == "pool":
+        start_image_worker_pool()
+    elif core_config.image_worker_mode == "batch":
+        start_image_batch_consumer()
+    else:
+        start_image_listener()
+
+
+def start_in_process_worker():
+    """
+    Воркер в потоке процесса main_api - для брокера в памяти, когда API и
+    image_service работают как один процесс.
+    """
+    global worker_thread
+    worker_thread = threading.Thread(target=run_image_worker, name="image-worker", daemon=True)
+    worker_thread.start()
+    logger.info("Image worker started in process, mode: %s", core_config.image_worker_mode)
+
+
+def stop_in_process_worker(timeout: float = 30):
+    global worker_thread
+    if worker_thread is None:
+        return
+    close_consumer_connections()
+    worker_thread.join(timeout)
+    worker_thread = None
 
 
 if __name__ == "__main__":
-    start_image_listener()
+    start_metrics_server(core_config.port_image_metrics)
+    run_image_worker()
@@ -0,0 +1,31 @@
+from PIL import Image as PILImage
+
+# dHash: 8 строк по 8 сравнений соседних пикселей кадра 9x8 в оттенках серого
+HASH_SIZE = 8
+HASH_MASK = (1 << HASH_SIZE * HASH_SIZE) - 1
+
+
+def to_signed(value: int) -> int:
+    # BigInteger в PostgreSQL знаковый: старший бит хэша становится знаком
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def dhash(frame) -> int:
+    """
+    Разностный перцептивный хэш кадра. Похожие изображения (пересжатые,
+    уменьшенные, с другой яркостью) отличаются в нескольких битах. Значение
+    знаковое, в том виде, в каком хранится в Image.phash.
+    """
+    if frame.mode != "L":
+        frame = frame.convert("L")
+    pixels = frame.resize((HASH_SIZE + 1, HASH_SIZE), PILImage.Resampling.LANCZOS).tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for column in range(offset, offset + HASH_SIZE):
+            value = value << 1 | (pixels[column] > pixels[column + 1])
+    return to_signed(value)
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return ((first ^ second) & HASH_MASK).bit_count()
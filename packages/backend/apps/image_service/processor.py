@@ -1,11 +1,11 @@
 import base64
 import os
-import pika
 import json
 import tempfile
-import time
 import logging
 
+from contextlib import contextmanager
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from fastapi import HTTPException, UploadFile
 
@@ -15,60 +15,93 @@ from apps.image_service.db import (
     service_delete_image
 )
 from apps.image_service.dto import ImageUpdate
-from apps.libs.database.database import get_db
-from apps.libs.config.core_config import core_config
+from apps.image_service.jobs import start_jobs, fail_job
+from apps.image_service.ledger import ledger
+from apps.image_service.retry import PoisonMessageError, is_retryable, retry_or_dead_letter
+from apps.libs.broker.backend import consumer_connection
+from apps.libs.broker.topology import consumer_channels
+from apps.libs.database.database import SessionLocal
+from apps.libs.metrics.metrics import events_in_flight, observe_queue_lag, timed_stage
 from apps.libs.database.models import User
+from apps.libs.storage.staging import staged_blob_path, remove_staged
+from apps.libs.tracing.tracing import activate, message_span
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def wait_for_rabbitmq_connection(host, port):
-    while True:
-        try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=port))
-            connection.close()
-            break
-        except pika.exceptions.AMQPConnectionError:
-            time.sleep(5)
-
-
 def callback(ch, method, properties, body):
-    process_image_action(body)
+    observe_queue_lag(method, properties)
+    # стадии обработки становятся дочерними спанами спана сообщения
+    with activate(message_span("process", properties, queue=method.routing_key)) as span:
+        try:
+            process_image_action(body)
+        except PoisonMessageError as e:
+            logger.error(f"Malformed message dropped: {e}")
+            span.set(error=str(e))
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        except Exception as e:
+            span.set(error=str(e))
+            retry_or_dead_letter(ch, method, properties, body, properties.message_id, str(e))
+            return
+        ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
 def start_image_listener():
-    wait_for_rabbitmq_connection(core_config.rabbitmq_host, core_config.rabbitmq_port)
-
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host=core_config.rabbitmq_host, port=core_config.rabbitmq_port)
-    )
-    channel = connection.channel()
-    channel.queue_declare(queue=core_config.rabbitmq_queue)
-
-    channel.basic_consume(queue=core_config.rabbitmq_queue, on_message_callback=callback, auto_ack=True)
+    connection = consumer_connection()
+    # ручные ack и prefetch 1: пока обрабатывается загрузка, из приоритетной очереди
+    # выдается следующее изменение, а не вся очередь загрузок
+    channels = consumer_channels(connection, prefetch_count=1)
+    for queue, channel in channels:
+        channel.basic_consume(queue=queue, on_message_callback=callback)
 
     try:
-        channel.start_consuming()
+        channels[0][1].start_consuming()
     except KeyboardInterrupt:
         connection.close()
 
 
 def process_image_action(body):
-    data = json.loads(body)
-    event_type = data['event_type']
+    """
+    Обрабатывает событие. Ошибки в данных события логируются и считаются
+    окончательными, временные (БД, хранилище) пробрасываются вызывающему,
+    чтобы сообщение ушло на повтор.
+    """
+    try:
+        data = json.loads(body)
+        event_type = data['event_type']
+        message_id = data.get('message_id')
+    except (ValueError, KeyError, TypeError) as e:
+        raise PoisonMessageError(str(e)) from e
+
+    in_flight = events_in_flight(event_type)
+    in_flight.inc()
+    db: Session = SessionLocal()
+    # исходник загрузки нужен повтору, поэтому удаляется, только когда событие завершено
+    retry = False
+    try:
+        if ledger.seen(message_id, db):
+            logger.info("Duplicate event %s skipped", message_id)
+            return
 
-    db: Session = next(get_db())
-    user_id = data['data'].get('user_id')
-    user = db.query(User).filter(User.id == user_id).first()
+        user_id = data['data'].get('user_id')
+        user = db.query(User).filter(User.id == user_id).first()
 
-    if not user:
-        logger.error("User not found: %s", user_id)
-        return
+        if not user:
+            logger.error("User not found: %s", user_id)
+            if event_type == 'UPLOAD':
+                fail_job(message_id, "User not found")
+            return
 
-    try:
         if event_type == 'UPLOAD':
-            handle_upload_event(data['data'], user, db)
+            # статус processing коммитится отдельно и сразу, чтобы клиент увидел его во время обработки
+            start_jobs([message_id])
+
+        ledger.record(message_id, event_type, user_id, db)
+
+        if event_type == 'UPLOAD':
+            handle_upload_event(data['data'], user, db, message_id)
 
         elif event_type == 'UPDATE':
             handle_update_event(data['data'], db, user)
@@ -76,36 +109,82 @@ def process_image_action(body):
         elif event_type == 'DELETE':
             handle_delete_event(data['data'], db, user)
 
+        ledger.remember([message_id])
+
+    except IntegrityError as e:
+        db.rollback()
+        if ledger.is_recorded(message_id, db):
+            logger.info("Duplicate event %s already processed by another worker", message_id)
+        else:
+            logger.error(f"Unhandled exception: {str(e)}")
+            retry = True
+            raise
     except HTTPException as e:
         logger.error(f"HTTPException occurred: {e.detail}")
+        db.rollback()
+        if event_type == 'UPLOAD':
+            fail_job(message_id, e.detail)
     except Exception as e:
         logger.error(f"Unhandled exception: {str(e)}")
+        db.rollback()
+        if is_retryable(e):
+            retry = True
+            raise
+        if event_type == 'UPLOAD':
+            fail_job(message_id, "Image processing failed")
+    finally:
+        db.close()
+        in_flight.dec()
+        if event_type == 'UPLOAD' and not retry:
+            release_upload_source(data.get('data'))
 
 
-def handle_upload_event(image_data, user, db):
+def handle_upload_event(image_data, user, db, job_id=None):
     logger.info("Processing UPLOAD image")
 
+    with upload_source(image_data) as source_path:
+        with open(source_path, 'rb') as img_file:
+            upload_file = UploadFile(file=img_file, filename=image_data['title'])
+            save_processed_image(upload_file, db, user, image_data.get('sha256'), job_id)
+            logger.info("Image processed and saved for user_id: %s", user.id)
+
+
+@contextmanager
+def upload_source(image_data):
+    """
+    Отдает путь к исходному файлу загрузки: staged-блоб (claim check) или
+    временный файл из base64. Временный файл удаляется после обработки,
+    staged-блоб - только через release_upload_source, когда событие
+    завершено: сообщение, ушедшее на повтор, снова прочитает тот же файл.
+    """
+    if 'staged_ref' in image_data:
+        yield staged_blob_path(image_data['staged_ref'], image_data.get('size'))
+        return
+
     try:
-        if image_data['file_data'].startswith("data:image/png;base64,"):
-            image_data['file_data'] = image_data['file_data'][len("data:image/png;base64,"):]
-        image_bytes = base64.b64decode(image_data['file_data'])
+        with timed_stage("decode_base64"):
+            if image_data['file_data'].startswith("data:image/png;base64,"):
+                image_data['file_data'] = image_data['file_data'][len("data:image/png;base64,"):]
+            image_bytes = base64.b64decode(image_data['file_data'])
     except Exception as e:
         logger.error(f"Error decoding image: {e}")
-        return
-
-    temp_file_path = save_image_to_temp_file(image_bytes)
+        raise
 
+    with timed_stage("temp_write"):
+        temp_file_path = save_image_to_temp_file(image_bytes)
     try:
-        with open(temp_file_path, 'rb') as img_file:
-            upload_file = UploadFile(file=img_file, filename=image_data['title'])
-            save_processed_image(upload_file, db, user)
-            logger.info("Image processed and saved for user_id: %s", user.id)
+        yield temp_file_path
     finally:
         if os.path.exists(temp_file_path):
             os.remove(temp_file_path)
             logger.info("Temporary file removed: %s", temp_file_path)
 
 
+def release_upload_source(image_data):
+    if image_data and 'staged_ref' in image_data:
+        remove_staged(image_data['staged_ref'])
+
+
 def handle_update_event(update_data, db, user):
     logger.info("Processing UPDATE event")
     image_id = update_data['image_id']
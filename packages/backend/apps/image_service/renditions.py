@@ -0,0 +1,215 @@
+import io
+import os
+import json
+import time
+import hashlib
+
+from functools import lru_cache
+from typing import Literal, Optional
+
+from PIL import Image as PILImage
+from pydantic import BaseModel
+
+from apps.image_service.phash import dhash
+from apps.libs.config.core_config import core_config
+from apps.libs.tracing.tracing import record_span
+
+
+class RenditionPreset(BaseModel):
+    name: str
+    width: int
+    height: int
+    # contain - вписать с сохранением пропорций, cover - заполнить и обрезать по центру,
+    # stretch - растянуть без сохранения пропорций
+    fit: Literal["contain", "cover", "stretch"] = "contain"
+    mode: Optional[str] = None
+    format: Optional[str] = None
+    quality: Optional[int] = None
+
+
+# Основной файл изображения (Image.file_path), как и раньше: 500x500 в оттенках серого
+PRIMARY_PRESET = RenditionPreset(name="default", width=500, height=500, fit="stretch", mode="L")
+
+DEFAULT_PRESETS = [
+    RenditionPreset(name="web", width=2048, height=2048, fit="contain", format="JPEG", quality=85),
+    RenditionPreset(name="preview", width=1024, height=1024, fit="contain", format="JPEG", quality=80),
+    RenditionPreset(name="thumbnail", width=256, height=256, fit="cover", format="JPEG", quality=75),
+]
+
+FORMAT_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif"}
+
+
+@lru_cache
+def configured_presets() -> tuple:
+    if not core_config.image_renditions:
+        return tuple(DEFAULT_PRESETS)
+    return tuple(RenditionPreset(**preset) for preset in json.loads(core_config.image_renditions))
+
+
+def scaled_size(source_size: tuple, preset: RenditionPreset) -> tuple:
+    """
+    Размер, до которого нужно уменьшить исходник (для cover - до обрезки).
+    Увеличение не делается: мелкие исходники остаются в своем размере.
+    """
+    source_width, source_height = source_size
+    if preset.fit == "stretch":
+        return preset.width, preset.height
+
+    if preset.fit == "cover":
+        scale = max(preset.width / source_width, preset.height / source_height)
+    else:
+        scale = min(preset.width / source_width, preset.height / source_height)
+    scale = min(scale, 1.0)
+    return max(1, round(source_width * scale)), max(1, round(source_height * scale))
+
+
+def center_crop(img, width: int, height: int):
+    width, height = min(width, img.width), min(height, img.height)
+    left = (img.width - width) // 2
+    top = (img.height - height) // 2
+    return img.crop((left, top, left + width, top + height))
+
+
+def output_mode(img, preset: RenditionPreset, img_format: str) -> str:
+    mode = preset.mode or img.mode
+    if img_format == "JPEG" and mode not in ("L", "RGB", "CMYK"):
+        return "RGB"
+    return mode
+
+
+def decode_for(img, targets: list):
+    """
+    Декодирует исходник один раз. Для JPEG через draft сразу получаем кадр,
+    уменьшенный в 2/4/8 раз, но не меньше самого крупного из targets.
+    """
+    largest = (max(size[0] for size in targets), max(size[1] for size in targets))
+    img.draft(img.mode, largest)
+    img.load()
+    # у палитровых изображений resize работает только через NEAREST
+    if img.mode in ("P", "1"):
+        return img.convert("RGBA" if "transparency" in img.info else "RGB")
+    return img
+
+
+def finish_frame(frame, preset: RenditionPreset, source_format: str, defer_grayscale: bool = False):
+    """
+    defer_grayscale оставляет RGB/RGBA-кадр пресета в оттенках серого без
+    convert: пакетный рендер переводит такие кадры в L сразу для всей пачки.
+    """
+    if preset.fit == "cover":
+        frame = center_crop(frame, preset.width, preset.height)
+
+    img_format = (preset.format or source_format).upper()
+    mode = output_mode(frame, preset, img_format)
+    if frame.mode != mode and not (defer_grayscale and mode == "L" and frame.mode in ("RGB", "RGBA")):
+        frame = frame.convert(mode)
+    return frame, img_format
+
+
+def save_options(preset: RenditionPreset) -> dict:
+    return {"quality": preset.quality} if preset.quality else {}
+
+
+def track_stage(timings: dict, stage: str, started: float) -> float:
+    now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0.0) + now - started
+    # спан по уже измеренному интервалу: в цикле рендера нет лишних блоков with
+    ended = time.time()
+    record_span(stage, ended - (now - started), ended)
+    return now
+
+
+def render_renditions(source, presets, directory: str, basename: str, timings: dict = None) -> list:
+    """
+    Строит все рендишены из одного декодирования исходника. Результаты
+    возвращаются в порядке presets. В timings накапливается время стадий
+    (open, resize, encode, write): рендер может идти в дочернем процессе,
+    поэтому метрики пишет вызывающий.
+    """
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+    with PILImage.open(source) as img:
+        frames = render_frames(img, presets, timings, started)
+        return [
+            write_rendition(frame, img_format, preset, directory, basename, timings)
+            for preset, (frame, img_format) in zip(presets, frames)
+        ]
+
+
+def render_frames(img, presets, timings: dict, started: float, defer_grayscale: bool = False) -> list:
+    """
+    Кадры (frame, format) для presets из открытого исходника. Рендишены
+    строятся от большего к меньшему, каждый уменьшается из предыдущего
+    промежуточного кадра, а не из полноразмерного исходника. Основой служат
+    только кадры с сохраненными пропорциями: растянутый кадр (основной
+    500x500) исказил бы следующие. Кадр может быть самим img, поэтому
+    записывать его нужно, пока исходник открыт.
+    """
+    source_format = img.format
+    targets = [scaled_size(img.size, preset) for preset in presets]
+    decoded = decode_for(img, targets)
+    started = track_stage(timings, "open", started)
+
+    frames = [None] * len(presets)
+    previous = decoded
+    order = sorted(range(len(presets)), key=lambda i: targets[i][0] * targets[i][1], reverse=True)
+    for index in order:
+        target = targets[index]
+        base = previous if previous.width >= target[0] and previous.height >= target[1] else decoded
+
+        frame = base if base.size == target else base.resize(target, reducing_gap=3.0)
+        if presets[index].fit != "stretch":
+            previous = frame
+        frames[index] = finish_frame(frame, presets[index], source_format, defer_grayscale)
+        started = track_stage(timings, "resize", started)
+    return frames
+
+
+def write_rendition(frame, img_format: str, preset: RenditionPreset, directory: str, basename: str, timings: dict):
+    started = time.perf_counter()
+    extension = FORMAT_EXTENSIONS.get(img_format, img_format.lower())
+    if preset is PRIMARY_PRESET:
+        path = os.path.join(directory, basename)
+    else:
+        stem = os.path.splitext(basename)[0]
+        path = os.path.join(directory, "renditions", f"{stem}_{preset.name}.{extension}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # кодируем в память, чтобы посчитать хэш содержимого без повторного чтения файла
+    buffer = io.BytesIO()
+    frame.save(buffer, format=img_format, **save_options(preset))
+    content = buffer.getbuffer()
+    content_hash = hashlib.sha256(content).hexdigest()
+    started = track_stage(timings, "encode", started)
+    with open(path, "wb") as output:
+        output.write(content)
+    started = track_stage(timings, "write", started)
+
+    rendition = {
+        "name": preset.name,
+        "file_path": path,
+        "width": frame.width,
+        "height": frame.height,
+        "format": img_format,
+        "size": len(content),
+        "content_hash": content_hash
+    }
+    if preset is PRIMARY_PRESET:
+        # основной кадр уже уменьшен и в оттенках серого: хэш без повторного декодирования
+        rendition["phash"] = dhash(frame)
+        track_stage(timings, "phash", started)
+    return rendition
+
+
+def render_to_bytes(source, preset: RenditionPreset) -> bytes:
+    with PILImage.open(source) as img:
+        source_format = img.format
+        target = scaled_size(img.size, preset)
+        decoded = decode_for(img, [target])
+
+        frame = decoded if decoded.size == target else decoded.resize(target, reducing_gap=3.0)
+        frame, img_format = finish_frame(frame, preset, source_format)
+
+        buffer = io.BytesIO()
+        frame.save(buffer, format=img_format, **save_options(preset))
+        return buffer.getvalue()
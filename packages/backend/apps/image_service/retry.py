@@ -0,0 +1,96 @@
+import json
+import logging
+
+import pika
+
+from fastapi import HTTPException
+
+from apps.image_service.jobs import requeue_job, fail_job
+from apps.libs.broker.topology import RETRY_HEADER, RETRY_ERROR_HEADER, retry_queue, retry_delay
+from apps.libs.config.core_config import core_config
+from apps.libs.metrics.metrics import IMAGE_EVENT_RETRIES
+from apps.libs.storage.staging import remove_staged
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class PoisonMessageError(Exception):
+    """
+    Сообщение нельзя разобрать: повтор не поможет, оно сразу уходит в dead-letter очередь.
+    """
+
+
+# Ошибки в самих данных события повторять бессмысленно, остальные (БД, хранилище,
+# брокер) считаются временными
+PERMANENT_ERRORS = (PoisonMessageError, HTTPException, ValueError, KeyError, TypeError)
+
+
+def is_retryable(error: Exception) -> bool:
+    return not isinstance(error, PERMANENT_ERRORS)
+
+
+def delivery_attempt(properties) -> int:
+    headers = (properties.headers if properties is not None else None) or {}
+    return int(headers.get(RETRY_HEADER, 0))
+
+
+def release_dead_lettered_upload(body):
+    """
+    Из dead-letter очереди сообщения не возвращаются в обработку, поэтому
+    staged-исходник загрузки удаляется вместе с отказом от сообщения.
+    """
+    try:
+        data = json.loads(body)['data']
+    except (ValueError, KeyError, TypeError):
+        return
+    if isinstance(data, dict) and 'staged_ref' in data:
+        remove_staged(data['staged_ref'])
+
+
+def schedule_retry(channel, queue: str, properties, body, message_id, error: str) -> bool:
+    """
+    Публикует копию сообщения в очередь задержки следующего повтора. Оригинал
+    вызывающий подтверждает сам. Возвращает False, если попытки исчерпаны:
+    тогда сообщение нужно отклонить без requeue, и оно попадет в dead-letter очередь.
+    """
+    attempt = delivery_attempt(properties) + 1
+    if attempt >= core_config.rabbitmq_retry_max_attempts:
+        logger.error("Message %s failed after %s attempts, dead-lettered: %s", message_id, attempt, error)
+        IMAGE_EVENT_RETRIES.labels(queue, "dead_lettered").inc()
+        fail_job(message_id, "Image processing failed")
+        release_dead_lettered_upload(body)
+        return False
+
+    headers = dict((properties.headers if properties is not None else None) or {})
+    headers[RETRY_HEADER] = attempt
+    headers[RETRY_ERROR_HEADER] = error[:1000]
+    channel.basic_publish(
+        exchange='',
+        routing_key=retry_queue(queue, attempt),
+        body=body,
+        properties=pika.BasicProperties(
+            message_id=message_id,
+            content_type=properties.content_type if properties is not None else 'application/json',
+            headers=headers
+        )
+    )
+    requeue_job(message_id, error)
+    IMAGE_EVENT_RETRIES.labels(queue, "retried").inc()
+    logger.warning(
+        "Message %s failed (%s), retry %s of %s in %.1fs",
+        message_id, error, attempt, core_config.rabbitmq_retry_max_attempts - 1, retry_delay(attempt)
+    )
+    return True
+
+
+def retry_or_dead_letter(channel, method, properties, body, message_id, error: str):
+    """
+    Для потребителей с поштучными ack: повтор с задержкой или dead-letter очередь.
+    Все публикуется через exchange по умолчанию, поэтому routing_key доставки -
+    это имя рабочей очереди, в том числе после возврата из очереди задержки.
+    """
+    if schedule_retry(channel, method.routing_key, properties, body, message_id, error):
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+    else:
+        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
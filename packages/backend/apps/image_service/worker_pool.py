@@ -0,0 +1,255 @@
+import json
+import logging
+import functools
+import contextvars
+import multiprocessing
+
+from contextlib import ExitStack
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+
+from apps.image_service.bulk import process_image_files
+from apps.image_service.db import process_image_file, create_image_record, find_processed_blob
+from apps.image_service.jobs import start_jobs, fail_job
+from apps.image_service.ledger import ledger
+from apps.image_service.processor import (
+    upload_source,
+    release_upload_source,
+    handle_update_event,
+    handle_delete_event
+)
+from apps.image_service.retry import is_retryable, retry_or_dead_letter
+from apps.libs.broker.backend import consumer_connection, in_memory
+from apps.libs.broker.topology import consumer_channels
+from apps.libs.config.core_config import core_config
+from apps.libs.database.database import SessionLocal
+from apps.libs.database.models import User
+from apps.libs.metrics.metrics import events_in_flight, observe_queue_lag, observe_stages
+from apps.libs.storage.blobs import file_sha256
+from apps.libs.tracing.tracing import (
+    Span,
+    activate,
+    current_span,
+    message_span,
+    parse_traceparent,
+    start_span,
+    use_span
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ImageProcessingError(Exception):
+    pass
+
+
+def process_pool_context():
+    """
+    С брокером в памяти воркер работает в потоке процесса main_api. fork
+    многопоточного процесса с event loop копирует блокировки, захваченные
+    другими потоками, поэтому процессы пула тогда запускаются через spawn.
+    """
+    if in_memory():
+        return multiprocessing.get_context("spawn")
+    return None
+
+
+def render_in_worker(source_path: str, filename: str, sha256: str = None, traceparent: str = None) -> dict:
+    # контекст трассы передается в дочерний процесс строкой traceparent
+    # HTTPException не переживает pickle при возврате из дочернего процесса
+    try:
+        with start_span("render", parent=parse_traceparent(traceparent)):
+            return process_image_file(source_path, filename, sha256)
+    except HTTPException as e:
+        raise ImageProcessingError(e.detail)
+
+
+def render_bulk_in_worker(sources: list, traceparent: str = None) -> list:
+    with start_span("render_bulk", parent=parse_traceparent(traceparent), size=len(sources)):
+        results = process_image_files(sources)
+    return [ImageProcessingError(result.detail) if isinstance(result, HTTPException) else result for result in results]
+
+
+class PooledImageConsumer:
+    """
+    Потребитель с ручными ack: UPLOAD уходит в пул процессов, запись в БД и ack
+    выполняются в потоке соединения после завершения обработки. Временные
+    ошибки отправляют сообщение на повтор с задержкой.
+    """
+
+    def __init__(self, connection, channel, executor):
+        self.connection = connection
+        self.channel = channel
+        self.executor = executor
+
+    def on_message(self, ch, method, properties, body):
+        with activate(message_span("process", properties, message_id=getattr(properties, "message_id", None))):
+            self.handle_message(ch, method, properties, body)
+
+    def handle_message(self, ch, method, properties, body):
+        delivery_tag = method.delivery_tag
+        try:
+            data = json.loads(body)
+            event_type = data['event_type']
+            event_data = data['data']
+            message_id = data.get('message_id')
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Malformed message dropped: {e}")
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=False)
+            return
+
+        observe_queue_lag(method, properties)
+        with SessionLocal() as db:
+            try:
+                if ledger.seen(message_id, db):
+                    logger.info("Duplicate event %s skipped", message_id)
+                    ch.basic_ack(delivery_tag=delivery_tag)
+                    return
+            except Exception as e:
+                logger.error(f"Unhandled exception: {str(e)}")
+                retry_or_dead_letter(ch, method, properties, body, message_id, str(e))
+                return
+
+            if event_type == 'UPLOAD':
+                self.submit_upload(method, properties, body, message_id, event_data)
+                return
+
+            with events_in_flight(event_type).track_inprogress():
+                try:
+                    user = db.get(User, event_data.get('user_id'))
+                    if not user:
+                        logger.error("User not found: %s", event_data.get('user_id'))
+                    else:
+                        ledger.record(message_id, event_type, user.id, db)
+                        if event_type == 'UPDATE':
+                            handle_update_event(event_data, db, user)
+                        elif event_type == 'DELETE':
+                            handle_delete_event(event_data, db, user)
+                        ledger.remember([message_id])
+                except IntegrityError as e:
+                    db.rollback()
+                    if not ledger.is_recorded(message_id, db):
+                        logger.error(f"Unhandled exception: {str(e)}")
+                        retry_or_dead_letter(ch, method, properties, body, message_id, str(e))
+                        return
+                    logger.info("Duplicate event %s already processed by another worker", message_id)
+                except HTTPException as e:
+                    logger.error(f"HTTPException occurred: {e.detail}")
+                except Exception as e:
+                    logger.error(f"Unhandled exception: {str(e)}")
+                    db.rollback()
+                    if is_retryable(e):
+                        retry_or_dead_letter(ch, method, properties, body, message_id, str(e))
+                    else:
+                        ch.basic_nack(delivery_tag=delivery_tag, requeue=False)
+                    return
+        ch.basic_ack(delivery_tag=delivery_tag)
+
+    def submit_upload(self, method, properties, body, message_id, image_data):
+        resources = ExitStack()
+        # спан загрузки завершается вместе с ресурсами, когда finish_upload закончит запись
+        span = Span("upload", current_span.get(), message_id=message_id)
+        resources.callback(span.finish)
+        with use_span(span):
+            self.start_upload(method, properties, body, message_id, image_data, resources, span)
+
+    def start_upload(self, method, properties, body, message_id, image_data, resources, span):
+        # загрузка остается "в полете", пока рендер в пуле процессов не завершится
+        events_in_flight('UPLOAD').inc()
+        try:
+            start_jobs([message_id])
+            source_path = resources.enter_context(upload_source(image_data))
+            sha256 = image_data.get('sha256') or file_sha256(source_path)
+            with SessionLocal() as db:
+                processed = find_processed_blob(sha256, image_data['title'], db)
+            if processed is not None:
+                # исходник уже обработан: пул процессов не нужен, только новая ссылка на блоб
+                future = Future()
+                future.set_result(processed)
+                self.finish_upload(method, properties, body, message_id, image_data, future, resources)
+                return
+            future = self.executor.submit(
+                render_in_worker, source_path, image_data['title'], sha256, span.traceparent
+            )
+        except Exception as e:
+            span.set(error=str(e))
+            resources.close()
+            events_in_flight('UPLOAD').dec()
+            logger.error(f"Unhandled exception: {str(e)}")
+            self.fail_upload(method, properties, body, message_id, image_data, e)
+            return
+
+        # finish_upload выполняется в потоке соединения, но в контексте со спаном загрузки
+        context = contextvars.copy_context()
+        future.add_done_callback(lambda done: self.connection.add_callback_threadsafe(functools.partial(
+            context.run, self.finish_upload, method, properties, body, message_id, image_data, done, resources
+        )))
+
+    def finish_upload(self, method, properties, body, message_id, image_data, future, resources):
+        try:
+            processed = future.result()
+            observe_stages(processed.get("timings", {}))
+            with SessionLocal() as db:
+                user = db.get(User, image_data.get('user_id'))
+                if not user:
+                    logger.error("User not found: %s", image_data.get('user_id'))
+                    fail_job(message_id, "User not found")
+                else:
+                    try:
+                        ledger.record(message_id, 'UPLOAD', user.id, db)
+                    except IntegrityError:
+                        # повторная доставка, которую параллельно уже обработал другой воркер
+                        db.rollback()
+                        if not ledger.is_recorded(message_id, db):
+                            raise
+                        logger.info("Duplicate event %s already processed by another worker", message_id)
+                    else:
+                        create_image_record(processed, db, user, message_id)
+                        ledger.remember([message_id])
+                        logger.info("Image processed and saved for user_id: %s", user.id)
+        except ImageProcessingError as e:
+            logger.error(f"HTTPException occurred: {e}")
+            current_span.get().set(error=str(e))
+            fail_job(message_id, str(e))
+        except Exception as e:
+            logger.error(f"Unhandled exception: {str(e)}")
+            current_span.get().set(error=str(e))
+            self.fail_upload(method, properties, body, message_id, image_data, e)
+            return
+        finally:
+            resources.close()
+            events_in_flight('UPLOAD').dec()
+        release_upload_source(image_data)
+        self.channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def fail_upload(self, method, properties, body, message_id, image_data, error):
+        if is_retryable(error):
+            retry_or_dead_letter(self.channel, method, properties, body, message_id, str(error))
+            return
+        fail_job(message_id, "Image processing failed")
+        release_upload_source(image_data)
+        self.channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+
+
+def start_image_worker_pool():
+    connection = consumer_connection()
+    with ProcessPoolExecutor(
+            max_workers=core_config.image_worker_processes, mp_context=process_pool_context()
+    ) as executor:
+        channels = consumer_channels(connection, core_config.image_worker_prefetch)
+        for queue, channel in channels:
+            consumer = PooledImageConsumer(connection, channel, executor)
+            channel.basic_consume(queue=queue, on_message_callback=consumer.on_message)
+        logger.info(
+            "Image worker pool started: %s processes, prefetch %s",
+            core_config.image_worker_processes, core_config.image_worker_prefetch
+        )
+        try:
+            channels[0][1].start_consuming()
+        except KeyboardInterrupt:
+            for _, channel in channels:
+                channel.stop_consuming()
+            connection.close()
@@ -1,16 +1,18 @@
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from apps.libs.auth.jwt import verify_access_token
-from apps.libs.database.database import get_db
+from apps.libs.auth.principal_cache import principal_cache
+from apps.libs.database.database import get_async_db
 from apps.libs.database.models import User
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 
-def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
+async def get_current_user(db: AsyncSession = Depends(get_async_db), token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
@@ -26,8 +28,22 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_
     if username is None:
         raise credentials_exception
 
-    user = db.query(User).filter_by(username=username).first()
+    # В новых токенах есть id пользователя: поиск по первичному ключу вместо username
+    user_id = payload.get("uid")
+    cache_key = user_id if user_id is not None else username
+    user = principal_cache.get(cache_key)
+    if user is not None:
+        return user
+
+    if user_id is not None:
+        user = await db.get(User, user_id)
+        if user is not None and user.username != username:
+            user = None
+    else:
+        user = await db.scalar(select(User).filter_by(username=username))
     if user is None:
         raise credentials_exception
 
+    db.expunge(user)
+    principal_cache.put(cache_key, user)
     return user
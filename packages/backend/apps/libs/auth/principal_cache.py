@@ -0,0 +1,73 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from apps.libs.config.core_config import core_config
+from apps.libs.database.models import User
+
+
+class PrincipalCache:
+    """
+    TTL + LRU кэш аутентифицированных пользователей по subject токена.
+
+    Хранит отсоединенные от сессии объекты User. Записи живут не дольше ttl,
+    поэтому изменения, сделанные другими процессами, видны с задержкой не больше ttl.
+    """
+
+    def __init__(self, max_size: int, ttl: float, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache(max_size=core_config.auth_cache_size, ttl=core_config.auth_cache_ttl)
+
+
+def invalidate_user(user: User):
+    principal_cache.invalidate(user.id, user.username)
+
+
+@event.listens_for(User, "after_delete")
+def invalidate_deleted_user(mapper, connection, user):
+    invalidate_user(user)
+
+
+@event.listens_for(User, "after_update")
+def invalidate_updated_user(mapper, connection, user):
+    # смена пароля или имени должна сразу выбивать закэшированного пользователя в этом процессе
+    invalidate_user(user)
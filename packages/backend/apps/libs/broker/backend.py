@@ -0,0 +1,63 @@
+import time
+import logging
+
+import pika
+
+from apps.libs.broker.memory import memory_broker
+from apps.libs.broker.pool import default_connection_factory
+from apps.libs.config.core_config import core_config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BROKER_BACKENDS = ("rabbitmq", "memory")
+
+
+def broker_backend() -> str:
+    backend = core_config.broker_backend
+    if backend not in BROKER_BACKENDS:
+        raise ValueError(f"Unknown BROKER_BACKEND: {backend}, expected one of {', '.join(BROKER_BACKENDS)}")
+    return backend
+
+
+def in_memory() -> bool:
+    return broker_backend() == "memory"
+
+
+def wait_for_rabbitmq_connection(host, port):
+    while True:
+        try:
+            connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=port))
+            connection.close()
+            break
+        except pika.exceptions.AMQPConnectionError:
+            time.sleep(5)
+
+
+def publisher_connection():
+    """
+    Фабрика соединений для ChannelPool. Бэкенд выбирается при каждом
+    подключении, поэтому пул, созданный при импорте, следует настройке.
+    """
+    if in_memory():
+        return memory_broker.connect()
+    return default_connection_factory()
+
+
+def consumer_connection():
+    """
+    Соединение для потребителей image_service: с RabbitMQ - после того как
+    брокер стал доступен, в памяти - сразу.
+    """
+    if in_memory():
+        return memory_broker.connect()
+    wait_for_rabbitmq_connection(core_config.rabbitmq_host, core_config.rabbitmq_port)
+    return pika.BlockingConnection(
+        pika.ConnectionParameters(host=core_config.rabbitmq_host, port=core_config.rabbitmq_port)
+    )
+
+
+def close_consumer_connections():
+    # start_consuming воркера, запущенного в том же процессе, возвращается
+    if in_memory():
+        memory_broker.close_connections()
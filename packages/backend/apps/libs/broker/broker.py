@@ -1,8 +1,19 @@
+import asyncio
 import pika
 import json
+import time
+import uuid
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+
+from apps.libs.broker.backend import publisher_connection
+from apps.libs.broker.pool import BatchPublishError, ChannelPool
+from apps.libs.broker.topology import declare_topology, queue_for_event
 from apps.libs.config.core_config import core_config
+from apps.libs.metrics.metrics import BROKER_PUBLISH_FAILURES, BROKER_PUBLISH_SECONDS, published_at_header
+from apps.libs.tracing.tracing import inject, start_span
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -11,30 +22,162 @@ pika_logger = logging.getLogger('pika')
 pika_logger.setLevel(logging.ERROR)
 
 
-connection = None
+publisher_pool = ChannelPool(
+    queue_name=core_config.rabbitmq_queue, connection_factory=publisher_connection, declare=declare_topology
+)
+publisher_executor = None
+in_flight = None
 
 
-def create_connection():
-    global connection
-    try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(
-            host=core_config.rabbitmq_host,
-            port=core_config.rabbitmq_port
-        ))
-        logger.info("RabbitMQ connection established.")
-    except pika.exceptions.AMQPConnectionError as e:
-        connection = None
-        logger.error(f"Failed to connect to RabbitMQ: {e}")
-
-
-async def send_message(event_type, data):
-    create_connection()
-    if connection:
-        channel = connection.channel()
-        channel.queue_declare(queue=core_config.rabbitmq_queue)
-
-        message = json.dumps({'event_type': event_type, 'data': data})
-        channel.basic_publish(exchange='', routing_key=core_config.rabbitmq_queue, body=message)
-        logger.info(f" [x] Sent '{event_type}', user_id: {data['user_id']}")
+def start_publisher():
+    global publisher_executor, in_flight
+    publisher_pool.open()
+    # Потоков столько же, сколько каналов в пуле: каждый публикует через свой канал,
+    # а event loop только ждет результат.
+    publisher_executor = ThreadPoolExecutor(
+        max_workers=core_config.rabbitmq_pool_size,
+        thread_name_prefix="amqp-publisher"
+    )
+    in_flight = asyncio.Semaphore(core_config.rabbitmq_max_in_flight)
+
+
+def close_publisher():
+    global publisher_executor
+    if publisher_executor is not None:
+        publisher_executor.shutdown(wait=True)
+        publisher_executor = None
+    publisher_pool.close()
+
+
+def broker_busy_exception():
+    return HTTPException(status_code=503, detail="Message broker is busy, try again later")
+
+
+class PublishPendingError(HTTPException):
+    """
+    Брокер не подтвердил публикацию за rabbitmq_publish_timeout, но поток
+    публикации продолжает работу: сообщение еще может дойти до воркера.
+    outcome - future публикации, по ней вызывающий узнает итог и только
+    тогда убирает то, что нужно сообщению (staged-файл, задачу).
+    """
+
+    def __init__(self, outcome):
+        super().__init__(status_code=503, detail="Message broker has not confirmed the message yet")
+        self.outcome = outcome
+
+
+def log_late_outcome(routing_key: str, future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is None:
+        logger.info(f"Publish to {routing_key} confirmed after the timeout")
     else:
-        logger.error("No connection to RabbitMQ. Message not sent.")
+        logger.error(f"Publish to {routing_key} failed after the timeout: {error!r}")
+
+
+async def publish(routing_key: str, message, properties=None):
+    await run_in_publisher(routing_key, publisher_pool.publish, routing_key, message, properties)
+
+
+async def publish_batch(routing_key: str, messages: list):
+    # пачка занимает один слот in_flight и один поток: публикация идет через один канал
+    await run_in_publisher(routing_key, publisher_pool.publish_batch, routing_key, messages)
+
+
+async def run_in_publisher(routing_key: str, function, *args):
+    if publisher_executor is None:
+        start_publisher()
+
+    try:
+        await asyncio.wait_for(in_flight.acquire(), timeout=core_config.rabbitmq_backpressure_timeout)
+    except asyncio.TimeoutError:
+        logger.error("Too many messages in flight, rejecting publish")
+        BROKER_PUBLISH_FAILURES.labels(routing_key, "backpressure").inc()
+        raise broker_busy_exception()
+
+    try:
+        future = asyncio.get_running_loop().run_in_executor(publisher_executor, function, *args)
+    except Exception:
+        in_flight.release()
+        raise
+    # Слот освобождается только когда поток закончил публикацию, даже если запрос
+    # уже получил 503 по таймауту, поэтому очередь исполнителя остается ограниченной.
+    future.add_done_callback(lambda _: in_flight.release())
+
+    try:
+        await asyncio.wait_for(asyncio.shield(future), timeout=core_config.rabbitmq_publish_timeout)
+    except asyncio.TimeoutError:
+        logger.error("Timed out waiting for RabbitMQ publisher confirm")
+        BROKER_PUBLISH_FAILURES.labels(routing_key, "timeout").inc()
+        future.add_done_callback(lambda done: log_late_outcome(routing_key, done))
+        raise PublishPendingError(future)
+
+
+async def send_message(event_type, data, message_id=None):
+    """
+    Публикует событие и возвращает его message_id - ключ идемпотентности,
+    по которому воркер отсекает повторные доставки, а клиент узнает статус обработки.
+    Если брокер не ответил вовремя, PublishPendingError: сообщение могло быть
+    отправлено.
+    """
+    message_id = message_id or uuid.uuid4().hex
+    message = json.dumps({'message_id': message_id, 'event_type': event_type, 'data': data})
+    queue = queue_for_event(event_type)
+    with start_span("publish", queue=queue, event_type=event_type, message_id=message_id) as span:
+        # воркер продолжает трассу от спана публикации
+        properties = pika.BasicProperties(
+            message_id=message_id, content_type='application/json', headers=inject(published_at_header())
+        )
+        started = time.perf_counter()
+        try:
+            await publish(queue, message, properties)
+            BROKER_PUBLISH_SECONDS.labels(queue).observe(time.perf_counter() - started)
+            logger.info(f" [x] Sent '{event_type}' {message_id}, user_id: {data['user_id']}")
+        except pika.exceptions.NackError:
+            logger.error(f"RabbitMQ rejected '{event_type}' message")
+            BROKER_PUBLISH_FAILURES.labels(queue, "nack").inc()
+            raise broker_busy_exception()
+        except pika.exceptions.AMQPError as e:
+            # в том числе таймаут ожидания канала из пула: сообщение не отправлено,
+            # вызывающий должен получить ошибку и убрать staged-файл и задачу
+            logger.error(f"No connection to RabbitMQ. Message not sent: {e}")
+            BROKER_PUBLISH_FAILURES.labels(queue, "connection").inc()
+            span.set(error=repr(e))
+            raise broker_busy_exception()
+    return message_id
+
+
+async def send_messages(event_type, messages: list) -> list:
+    """
+    Публикует пачку событий одного типа одной публикацией. messages - список
+    (message_id, data). Возвращает message_id принятых брокером сообщений:
+    если публикация прервалась, это начало списка, остальные не отправлены.
+    Если брокер не ответил вовремя, PublishPendingError: итог пачки (None или
+    BatchPublishError) придет в ее outcome.
+    """
+    queue = queue_for_event(event_type)
+    bodies = []
+    with start_span("publish_batch", queue=queue, event_type=event_type, messages=len(messages)) as span:
+        # у всех сообщений пачки родитель - спан пакетной публикации
+        headers = inject(published_at_header())
+        for message_id, data in messages:
+            body = json.dumps({'message_id': message_id, 'event_type': event_type, 'data': data})
+            properties = pika.BasicProperties(
+                message_id=message_id, content_type='application/json', headers=dict(headers)
+            )
+            bodies.append((body, properties))
+        started = time.perf_counter()
+        try:
+            await publish_batch(queue, bodies)
+        except BatchPublishError as e:
+            reason = "nack" if isinstance(e.error, pika.exceptions.NackError) else "connection"
+            logger.error(
+                f"Batch of '{event_type}' stopped after {e.published} of {len(messages)} messages: {e.error!r}"
+            )
+            BROKER_PUBLISH_FAILURES.labels(queue, reason).inc()
+            span.set(error=repr(e.error), published=e.published)
+            return [message_id for message_id, _ in messages[:e.published]]
+        BROKER_PUBLISH_SECONDS.labels(queue).observe(time.perf_counter() - started)
+        logger.info(f" [x] Sent {len(messages)} '{event_type}' messages")
+    return [message_id for message_id, _ in messages]
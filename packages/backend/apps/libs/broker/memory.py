@@ -0,0 +1,278 @@
+import collections
+import itertools
+import threading
+import time
+import weakref
+import logging
+
+import pika
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MemoryQueue:
+    def __init__(self, name: str, arguments: dict = None):
+        self.name = name
+        self.arguments = arguments or {}
+        ttl = self.arguments.get('x-message-ttl')
+        self.ttl = ttl / 1000 if ttl is not None else None
+        # (истекает, exchange, routing_key, body, properties, redelivered)
+        self.messages = collections.deque()
+
+    def put(self, exchange: str, routing_key: str, body, properties, redelivered: bool = False):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.messages.append((expires, exchange, routing_key, body, properties, redelivered))
+
+
+class MemoryBroker:
+    """
+    Брокер в памяти процесса с той частью семантики RabbitMQ, на которую
+    опираются публикатор и воркеры: exchange по умолчанию и fanout, prefetch
+    и ручные ack, dead-letter при nack без requeue и по TTL очереди (очереди
+    задержки повторов). Соединения повторяют интерфейс BlockingConnection,
+    поэтому ChannelPool и все режимы воркера работают с ним без изменений.
+    Сообщения не переживают перезапуск процесса.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.bindings = collections.defaultdict(list)
+        self.connections = weakref.WeakSet()
+
+    def connect(self) -> "MemoryConnection":
+        connection = MemoryConnection(self)
+        with self.condition:
+            self.connections.add(connection)
+        return connection
+
+    def close_connections(self):
+        # неподтвержденные сообщения возвращаются в очереди, как при обрыве соединения с RabbitMQ
+        for connection in list(self.connections):
+            connection.close()
+
+    def queue(self, name: str, arguments: dict = None) -> MemoryQueue:
+        if name not in self.queues:
+            self.queues[name] = MemoryQueue(name, arguments)
+        return self.queues[name]
+
+    def publish(self, exchange: str, routing_key: str, body, properties=None):
+        with self.condition:
+            self.route(exchange, routing_key, body, properties)
+            self.condition.notify_all()
+
+    def route(self, exchange: str, routing_key: str, body, properties):
+        if exchange == '':
+            targets = [self.queue(routing_key)]
+        else:
+            targets = [self.queues[name] for name in self.bindings.get(exchange, [])]
+        for target in targets:
+            target.put(exchange, routing_key, body, properties)
+
+    def dead_letter(self, queue: MemoryQueue, routing_key: str, body, properties):
+        exchange = queue.arguments.get('x-dead-letter-exchange')
+        if exchange is None:
+            logger.warning("Message dropped from %s: no dead-letter exchange", queue.name)
+            return
+        self.route(exchange, queue.arguments.get('x-dead-letter-routing-key', routing_key), body, properties)
+
+    def expire(self, now: float) -> float:
+        """
+        Снимает истекшие сообщения с головы очередей с TTL и возвращает время
+        ближайшего следующего истечения (или None).
+        """
+        next_expiry = None
+        for queue in list(self.queues.values()):
+            if queue.ttl is None:
+                continue
+            while queue.messages and queue.messages[0][0] <= now:
+                _, _, routing_key, body, properties, _ = queue.messages.popleft()
+                self.dead_letter(queue, routing_key, body, properties)
+            if queue.messages and (next_expiry is None or queue.messages[0][0] < next_expiry):
+                next_expiry = queue.messages[0][0]
+        return next_expiry
+
+
+class MemoryChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self.prefetch_count = 0
+        self.consumers = []
+        self.unacked = collections.OrderedDict()
+        self.tags = itertools.count(1)
+
+    def confirm_delivery(self):
+        # публикация синхронная: сообщение уже в очереди, когда basic_publish вернулся
+        pass
+
+    def basic_qos(self, prefetch_count: int = 0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    def exchange_declare(self, exchange: str, exchange_type: str = 'direct', **kwargs):
+        with self.broker.condition:
+            self.broker.bindings.setdefault(exchange, [])
+
+    def queue_declare(self, queue: str, arguments: dict = None, **kwargs):
+        with self.broker.condition:
+            self.broker.queue(queue, arguments)
+
+    def queue_bind(self, queue: str, exchange: str, **kwargs):
+        with self.broker.condition:
+            if queue not in self.broker.bindings[exchange]:
+                self.broker.bindings[exchange].append(queue)
+
+    def basic_publish(self, exchange: str, routing_key: str, body, properties=None, mandatory: bool = False):
+        if not self.is_open or not self.connection.is_open:
+            raise pika.exceptions.ChannelWrongStateError("Channel is closed.")
+        self.broker.publish(exchange, routing_key, body, properties)
+
+    def basic_consume(self, queue: str, on_message_callback, auto_ack: bool = False, **kwargs):
+        with self.broker.condition:
+            self.consumers.append((self.broker.queue(queue), on_message_callback, auto_ack))
+            self.broker.condition.notify_all()
+
+    def take(self) -> list:
+        """
+        Забирает доставки в пределах prefetch. Вызывается под блокировкой брокера.
+        """
+        deliveries = []
+        for queue, callback, auto_ack in self.consumers:
+            while queue.messages and (not self.prefetch_count or len(self.unacked) < self.prefetch_count):
+                _, exchange, routing_key, body, properties, redelivered = queue.messages.popleft()
+                tag = next(self.tags)
+                if not auto_ack:
+                    self.unacked[tag] = (queue, exchange, routing_key, body, properties)
+                method = pika.spec.Basic.Deliver(
+                    delivery_tag=tag, redelivered=redelivered, exchange=exchange, routing_key=routing_key
+                )
+                deliveries.append((callback, method, properties, body))
+        return deliveries
+
+    def settle(self, delivery_tag: int, multiple: bool) -> list:
+        if multiple:
+            tags = [tag for tag in self.unacked if not delivery_tag or tag <= delivery_tag]
+        else:
+            tags = [delivery_tag] if delivery_tag in self.unacked else []
+        return [self.unacked.pop(tag) for tag in tags]
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False):
+        with self.broker.condition:
+            self.settle(delivery_tag, multiple)
+            self.broker.condition.notify_all()
+
+    def basic_nack(self, delivery_tag: int = 0, multiple: bool = False, requeue: bool = True):
+        with self.broker.condition:
+            messages = self.settle(delivery_tag, multiple)
+            if requeue:
+                self.requeue(messages)
+            else:
+                for queue, _, routing_key, body, properties in messages:
+                    self.broker.dead_letter(queue, routing_key, body, properties)
+            self.broker.condition.notify_all()
+
+    def requeue(self, messages: list):
+        for queue, exchange, routing_key, body, properties in reversed(messages):
+            queue.messages.appendleft((None, exchange, routing_key, body, properties, True))
+
+    def start_consuming(self):
+        self.connection.start_consuming()
+
+    def stop_consuming(self):
+        self.connection.stop_consuming()
+
+    def close(self):
+        with self.broker.condition:
+            self.is_open = False
+            self.requeue(self.settle(0, multiple=True))
+            self.broker.condition.notify_all()
+
+
+class MemoryConnection:
+    """
+    Аналог BlockingConnection: start_consuming на любом канале обслуживает
+    все каналы соединения в вызывающем потоке, колбэки add_callback_threadsafe
+    и таймеры call_later выполняются в том же потоке.
+    """
+
+    # без событий цикл все равно просыпается, чтобы заметить закрытие соединения
+    MAX_WAIT = 1.0
+
+    def __init__(self, broker: MemoryBroker):
+        self.broker = broker
+        self.is_open = True
+        self.consuming = False
+        self.channels = []
+        self.callbacks = collections.deque()
+        self.timers = {}
+        self.timer_ids = itertools.count(1)
+
+    def channel(self) -> MemoryChannel:
+        channel = MemoryChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback):
+        with self.broker.condition:
+            self.callbacks.append(callback)
+            self.broker.condition.notify_all()
+
+    def call_later(self, delay: float, callback):
+        timer = next(self.timer_ids)
+        self.timers[timer] = (time.monotonic() + delay, callback)
+        return timer
+
+    def remove_timeout(self, timer):
+        self.timers.pop(timer, None)
+
+    def start_consuming(self):
+        self.consuming = True
+        while self.consuming and self.is_open:
+            for callback, *args in self.poll():
+                callback(*args)
+
+    def poll(self) -> list:
+        """
+        Собирает готовые колбэки, таймеры и доставки или ждет их появления.
+        Сами колбэки выполняются вне блокировки брокера.
+        """
+        with self.broker.condition:
+            while self.consuming and self.is_open:
+                now = time.monotonic()
+                next_expiry = self.broker.expire(now)
+                ready = [(callback,) for callback in self.callbacks]
+                self.callbacks.clear()
+                for timer, (due, callback) in sorted(self.timers.items(), key=lambda item: item[1][0]):
+                    if due <= now:
+                        del self.timers[timer]
+                        ready.append((callback,))
+                for channel in self.channels:
+                    if channel.is_open:
+                        ready.extend(
+                            (callback, channel, method, properties, body)
+                            for callback, method, properties, body in channel.take()
+                        )
+                if ready:
+                    return ready
+                wake = [now + self.MAX_WAIT, *(due for due, _ in self.timers.values())]
+                if next_expiry is not None:
+                    wake.append(next_expiry)
+                self.broker.condition.wait(max(0.0, min(wake) - now))
+        return []
+
+    def stop_consuming(self):
+        with self.broker.condition:
+            self.consuming = False
+            self.broker.condition.notify_all()
+
+    def close(self):
+        with self.broker.condition:
+            self.is_open = False
+            for channel in self.channels:
+                channel.close()
+            self.broker.condition.notify_all()
+
+
+memory_broker = MemoryBroker()
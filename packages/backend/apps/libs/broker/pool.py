@@ -0,0 +1,230 @@
+import queue
+import threading
+import time
+import logging
+
+import pika
+
+from apps.libs.config.core_config import core_config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class PoolClosedError(pika.exceptions.AMQPConnectionError):
+    pass
+
+
+class BatchPublishError(pika.exceptions.AMQPError):
+    """
+    Публикация пачки прервалась на сообщении с индексом published: все
+    сообщения до него брокер уже принял, error - исходная ошибка.
+    """
+
+    def __init__(self, published: int, error: Exception):
+        super().__init__(published, error)
+        self.published = published
+        self.error = error
+
+
+def default_connection_factory():
+    return pika.BlockingConnection(pika.ConnectionParameters(
+        host=core_config.rabbitmq_host,
+        port=core_config.rabbitmq_port,
+        blocked_connection_timeout=core_config.rabbitmq_publish_timeout
+    ))
+
+
+class PooledChannel:
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+
+    @property
+    def is_open(self):
+        return self.connection.is_open and self.channel.is_open
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except pika.exceptions.AMQPError as e:
+            logger.warning(f"Error while closing RabbitMQ connection: {e}")
+
+
+class ChannelPool:
+    """
+    Пул долгоживущих соединений RabbitMQ (по одному каналу на соединение).
+
+    BlockingConnection не потокобезопасен, поэтому каждый канал в любой момент
+    времени используется только одним потоком. Очередь (или вся топология,
+    если передан declare) объявляется один раз и повторно только после
+    потери соединения. При включенных publisher confirms basic_publish
+    возвращается только после подтверждения брокера и выбрасывает
+    NackError, если брокер отказался принять сообщение.
+    """
+
+    def __init__(
+            self,
+            queue_name: str,
+            size: int = core_config.rabbitmq_pool_size,
+            connection_factory=default_connection_factory,
+            reconnect_attempts: int = core_config.rabbitmq_reconnect_attempts,
+            reconnect_backoff: float = core_config.rabbitmq_reconnect_backoff,
+            reconnect_backoff_max: float = core_config.rabbitmq_reconnect_backoff_max,
+            acquire_timeout: float = core_config.rabbitmq_pool_timeout,
+            publisher_confirms: bool = core_config.rabbitmq_publisher_confirms,
+            declare=None
+    ):
+        self.queue_name = queue_name
+        self.declare = declare or self.declare_queue
+        self.size = size
+        self.connection_factory = connection_factory
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_backoff = reconnect_backoff
+        self.reconnect_backoff_max = reconnect_backoff_max
+        self.acquire_timeout = acquire_timeout
+        self.publisher_confirms = publisher_confirms
+
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._declared = False
+        self._closed = False
+
+    def _open(self) -> PooledChannel:
+        attempt = 0
+        while True:
+            try:
+                connection = self.connection_factory()
+                channel = connection.channel()
+                if self.publisher_confirms:
+                    channel.confirm_delivery()
+                with self._lock:
+                    declare = not self._declared
+                    self._declared = True
+                if declare:
+                    self.declare(channel)
+                logger.info("RabbitMQ connection established.")
+                return PooledChannel(connection, channel)
+            except pika.exceptions.AMQPError as e:
+                with self._lock:
+                    self._declared = False
+                attempt += 1
+                if attempt >= self.reconnect_attempts:
+                    logger.error(f"Failed to connect to RabbitMQ: {e}")
+                    raise
+                delay = min(self.reconnect_backoff_max, self.reconnect_backoff * 2 ** (attempt - 1))
+                logger.warning(f"RabbitMQ connection failed ({e}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+    def declare_queue(self, channel):
+        channel.queue_declare(queue=self.queue_name)
+
+    def acquire(self) -> PooledChannel:
+        if self._closed:
+            raise PoolClosedError("Publisher pool is closed")
+
+        try:
+            pooled = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    return self._open()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            try:
+                pooled = self._idle.get(timeout=self.acquire_timeout)
+            except queue.Empty:
+                raise pika.exceptions.AMQPConnectionError("Timed out waiting for a pooled RabbitMQ channel")
+
+        if not pooled.is_open:
+            self._discard(pooled)
+            return self.acquire()
+        return pooled
+
+    def release(self, pooled: PooledChannel):
+        if self._closed or not pooled.is_open:
+            self._discard(pooled)
+            return
+        self._idle.put_nowait(pooled)
+
+    def _discard(self, pooled: PooledChannel):
+        pooled.close()
+        with self._lock:
+            self._created -= 1
+            self._declared = False
+
+    def publish(self, routing_key: str, body, properties=None):
+        for attempt in range(2):
+            pooled = self.acquire()
+            try:
+                pooled.channel.basic_publish(
+                    exchange='',
+                    routing_key=routing_key,
+                    body=body,
+                    properties=properties
+                )
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+                self._discard(pooled)
+                if attempt:
+                    raise
+                logger.warning(f"Publish failed on a stale channel ({e}), reconnecting")
+                continue
+            except Exception:
+                self._discard(pooled)
+                raise
+            self.release(pooled)
+            return
+
+    def publish_batch(self, routing_key: str, messages: list):
+        """
+        Публикует пачку (body, properties) через один канал одним вызовом из
+        потока исполнителя. После переподключения публикация продолжается с
+        первого неподтвержденного сообщения, уже принятые брокером не повторяются.
+        """
+        published = 0
+        for attempt in range(2):
+            try:
+                pooled = self.acquire()
+            except Exception as e:
+                raise BatchPublishError(published, e)
+            try:
+                for body, properties in messages[published:]:
+                    pooled.channel.basic_publish(
+                        exchange='',
+                        routing_key=routing_key,
+                        body=body,
+                        properties=properties
+                    )
+                    published += 1
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+                self._discard(pooled)
+                if attempt:
+                    raise BatchPublishError(published, e)
+                logger.warning(f"Batch publish failed on a stale channel ({e}), reconnecting")
+                continue
+            except Exception as e:
+                self._discard(pooled)
+                raise BatchPublishError(published, e)
+            self.release(pooled)
+            return
+
+    def open(self):
+        self._closed = False
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(pooled)
+        logger.info("RabbitMQ publisher pool closed.")
@@ -0,0 +1,110 @@
+import logging
+
+import pika
+
+from apps.libs.config.core_config import core_config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# UPDATE/DELETE - дешевые изменения метаданных, они не должны ждать за очередью загрузок
+PRIORITY_EVENTS = ('UPDATE', 'DELETE')
+
+# Заголовок с номером повтора; первая доставка его не содержит
+RETRY_HEADER = "x-retry-attempt"
+RETRY_ERROR_HEADER = "x-retry-error"
+
+# Заголовок с временем публикации в миллисекундах: по нему воркер считает время ожидания в очереди
+PUBLISHED_AT_HEADER = "x-published-at"
+
+
+def work_queues() -> tuple:
+    # приоритетная очередь первой: ее канал открывается и начинает потреблять раньше
+    return core_config.rabbitmq_priority_queue, core_config.rabbitmq_queue
+
+
+def queue_for_event(event_type: str) -> str:
+    if event_type in PRIORITY_EVENTS:
+        return core_config.rabbitmq_priority_queue
+    return core_config.rabbitmq_queue
+
+
+def dead_letter_exchange() -> str:
+    return f"{core_config.rabbitmq_dead_letter_queue}.exchange"
+
+
+def retry_queue(queue: str, attempt: int) -> str:
+    return f"{queue}.retry.{attempt}"
+
+
+def retry_delay(attempt: int) -> float:
+    return min(core_config.rabbitmq_retry_delay_max, core_config.rabbitmq_retry_delay * 2 ** (attempt - 1))
+
+
+def queue_arguments() -> list:
+    """
+    Очереди воркера с их аргументами: рабочие очереди отправляют отклоненные
+    сообщения в dead-letter exchange, очереди задержки по истечении TTL
+    возвращают их в исходную рабочую очередь.
+    """
+    exchange = dead_letter_exchange()
+    queues = []
+    for queue in work_queues():
+        queues.append((queue, {'x-dead-letter-exchange': exchange}))
+        for attempt in range(1, core_config.rabbitmq_retry_max_attempts):
+            queues.append((retry_queue(queue, attempt), {
+                'x-message-ttl': int(retry_delay(attempt) * 1000),
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': queue
+            }))
+    return queues
+
+
+def declare_topology(channel):
+    """
+    Объявляет очереди воркера изображений.
+
+    Рабочие очереди отправляют отклоненные (nack без requeue) сообщения в
+    dead-letter exchange, а он - в dead-letter очередь. Для каждого повтора
+    своя очередь задержки с фиксированным TTL: по истечении TTL сообщение
+    возвращается в исходную рабочую очередь. TTL на очередь, а не на
+    сообщение, потому что RabbitMQ снимает истекшие сообщения только с
+    головы очереди.
+
+    Аргументы существующих очередей поменять нельзя: очереди, объявленные
+    предыдущей версией или с другими задержками, переобъявляет
+    python -m apps.libs.broker.upgrade.
+    """
+    exchange = dead_letter_exchange()
+    channel.exchange_declare(exchange=exchange, exchange_type='fanout')
+    channel.queue_declare(queue=core_config.rabbitmq_dead_letter_queue)
+    channel.queue_bind(queue=core_config.rabbitmq_dead_letter_queue, exchange=exchange)
+
+    for queue, arguments in queue_arguments():
+        try:
+            channel.queue_declare(queue=queue, arguments=arguments)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            if e.reply_code == 406:
+                logger.error(
+                    f"Queue {queue} exists with different arguments, "
+                    f"stop the services and run python -m apps.libs.broker.upgrade"
+                )
+            raise
+
+
+def consumer_channels(connection, prefetch_count: int) -> list:
+    """
+    Открывает по каналу на каждую рабочую очередь. У каждого канала свой
+    prefetch, поэтому загрузки в обработке не занимают окно приоритетной
+    очереди, а ack с multiple=True не задевает доставки другой очереди.
+    Подтверждения публикаций включены, чтобы копия сообщения для повтора
+    была принята брокером до ack оригинала.
+    """
+    channels = []
+    for queue in work_queues():
+        channel = connection.channel()
+        channel.confirm_delivery()
+        channel.basic_qos(prefetch_count=prefetch_count)
+        channels.append((queue, channel))
+    declare_topology(channels[0][1])
+    return channels
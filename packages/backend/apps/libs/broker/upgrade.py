@@ -0,0 +1,102 @@
+import logging
+
+import pika
+
+from apps.libs.broker.backend import in_memory
+from apps.libs.broker.pool import default_connection_factory
+from apps.libs.broker.topology import declare_topology, queue_arguments
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def holding_queue(queue: str) -> str:
+    return f"{queue}.upgrade"
+
+
+def queue_matches(connection, queue: str, arguments: dict) -> bool:
+    """
+    Проверяет, что очередь можно объявить с нужными аргументами. Брокер
+    закрывает канал при PRECONDITION_FAILED, поэтому проверка идет в
+    отдельном канале.
+    """
+    channel = connection.channel()
+    try:
+        channel.queue_declare(queue=queue, arguments=arguments)
+    except pika.exceptions.ChannelClosedByBroker as e:
+        if e.reply_code != 406:
+            raise
+        return False
+    channel.close()
+    return True
+
+
+def queue_exists(connection, queue: str) -> bool:
+    channel = connection.channel()
+    try:
+        channel.queue_declare(queue=queue, passive=True)
+    except pika.exceptions.ChannelClosedByBroker as e:
+        if e.reply_code != 404:
+            raise
+        return False
+    channel.close()
+    return True
+
+
+def move_messages(channel, source: str, target: str) -> int:
+    """
+    Перекладывает сообщения из source в target. Оригинал подтверждается
+    только после того, как брокер принял копию, поэтому прерванный перенос
+    может задвоить сообщение, но не потерять его.
+    """
+    moved = 0
+    while True:
+        method, properties, body = channel.basic_get(queue=source)
+        if method is None:
+            return moved
+        channel.basic_publish(exchange='', routing_key=target, body=body, properties=properties)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        moved += 1
+
+
+def upgrade_topology(connection):
+    """
+    Переобъявляет очереди, аргументы которых отличаются от текущей
+    топологии (очереди версии без dead-letter очереди, очереди задержки
+    после изменения задержек). Сообщения такой очереди переносятся во
+    временную очередь <queue>.upgrade, очередь удаляется и объявляется
+    заново, после чего сообщения возвращаются. Повторный запуск доводит
+    прерванное обновление до конца.
+
+    Сервисы на время обновления должны быть остановлены.
+    """
+    channel = connection.channel()
+    channel.confirm_delivery()
+    for queue, arguments in queue_arguments():
+        if queue_matches(connection, queue, arguments):
+            continue
+        holding = holding_queue(queue)
+        channel.queue_declare(queue=holding)
+        moved = move_messages(channel, queue, holding)
+        channel.queue_delete(queue=queue)
+        logger.info(f"Queue {queue} deleted for re-declaration, {moved} messages kept in {holding}")
+
+    declare_topology(channel)
+    for queue, _ in queue_arguments():
+        holding = holding_queue(queue)
+        if not queue_exists(connection, holding):
+            continue
+        moved = move_messages(channel, holding, queue)
+        channel.queue_delete(queue=holding)
+        logger.info(f"Queue {queue} re-declared, {moved} messages restored")
+
+
+if __name__ == "__main__":
+    if in_memory():
+        logger.info("BROKER_BACKEND=memory keeps no queues between runs, nothing to upgrade")
+    else:
+        connection = default_connection_factory()
+        try:
+            upgrade_topology(connection)
+        finally:
+            connection.close()
@@ -7,19 +7,137 @@ class CoreConfig(BaseSettings):
     # Параметры для основного API и API изображений
     port_main_api: int = int(os.getenv("PORT_MAIN_API", 8000))
     port_image_api: int = int(os.getenv("PORT_IMAGE_API", 8001))
+    # HTTP-порт метрик Prometheus у image_service (0 - выключен); main_api отдает /metrics сам
+    port_image_metrics: int = int(os.getenv("PORT_IMAGE_METRICS", 9101))
+
+    # Трассировка: контекст W3C traceparent идет из HTTP-запроса в заголовки сообщений и в воркер.
+    # Спаны пишутся в JSON lines файл (пустой путь - не пишутся), доля записываемых трасс
+    trace_export_path: str = os.getenv("TRACE_EXPORT_PATH", "")
+    trace_sample_ratio: float = float(os.getenv("TRACE_SAMPLE_RATIO", 1.0))
 
     # Параметры базы данных
     database_url: str = os.getenv("DATABASE_URL")
 
+    # Пул соединений с базой (для sqlite не применяется)
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", 10))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", 20))
+    db_pool_timeout: float = float(os.getenv("DB_POOL_TIMEOUT", 30))
+    db_pool_pre_ping: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    db_pool_recycle: int = int(os.getenv("DB_POOL_RECYCLE", 1800))
+
     # Параметры JWT
     jwt_secret: str = os.getenv("JWT_SECRET", "your_jwt_secret")
     jwt_algorithm: str = "HS256"
     jwt_expiration_minutes: int = 30
 
+    # Кэш аутентифицированных пользователей (0 - выключен)
+    auth_cache_size: int = int(os.getenv("AUTH_CACHE_SIZE", 10000))
+    auth_cache_ttl: float = float(os.getenv("AUTH_CACHE_TTL", 60))
+
+    # Хэширование паролей: стоимость bcrypt и отдельный пул потоков с ограниченной очередью
+    bcrypt_rounds: int = int(os.getenv("BCRYPT_ROUNDS", 12))
+    password_hash_workers: int = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+    password_hash_max_queue: int = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", 16))
+
+    # Брокер сообщений: "rabbitmq" или "memory" - очереди в памяти процесса main_api,
+    # image_service тогда запускается в том же процессе (одна машина, бенчмарки, локальный запуск)
+    broker_backend: str = os.getenv("BROKER_BACKEND", "rabbitmq")
+
     # Параметры RabbitMQ
     rabbitmq_host: str = os.getenv("RABBITMQ_HOST", "rabbitmq")
     rabbitmq_port: int = int(os.getenv("RABBITMQ_PORT", 5672))
     rabbitmq_queue: str = os.getenv("RABBITMQ_QUEUE", "image_events")
 
+    # Топология очередей: UPDATE/DELETE идут в отдельную приоритетную очередь, упавшие сообщения
+    # повторяются через очереди задержки (экспоненциальная задержка), после max_attempts - в dead-letter очередь
+    rabbitmq_priority_queue: str = os.getenv("RABBITMQ_PRIORITY_QUEUE", "image_events.priority")
+    rabbitmq_dead_letter_queue: str = os.getenv("RABBITMQ_DEAD_LETTER_QUEUE", "image_events.dead")
+    rabbitmq_retry_max_attempts: int = int(os.getenv("RABBITMQ_RETRY_MAX_ATTEMPTS", 5))
+    rabbitmq_retry_delay: float = float(os.getenv("RABBITMQ_RETRY_DELAY", 1.0))
+    rabbitmq_retry_delay_max: float = float(os.getenv("RABBITMQ_RETRY_DELAY_MAX", 60.0))
+
+    # Пул соединений публикатора RabbitMQ
+    rabbitmq_pool_size: int = int(os.getenv("RABBITMQ_POOL_SIZE", 4))
+    rabbitmq_pool_timeout: float = float(os.getenv("RABBITMQ_POOL_TIMEOUT", 5.0))
+    rabbitmq_reconnect_attempts: int = int(os.getenv("RABBITMQ_RECONNECT_ATTEMPTS", 3))
+    rabbitmq_reconnect_backoff: float = float(os.getenv("RABBITMQ_RECONNECT_BACKOFF", 0.2))
+    rabbitmq_reconnect_backoff_max: float = float(os.getenv("RABBITMQ_RECONNECT_BACKOFF_MAX", 5.0))
+
+    # Асинхронная публикация: подтверждения брокера и ограничение сообщений "в полете"
+    rabbitmq_publisher_confirms: bool = os.getenv("RABBITMQ_PUBLISHER_CONFIRMS", "true").lower() == "true"
+    rabbitmq_max_in_flight: int = int(os.getenv("RABBITMQ_MAX_IN_FLIGHT", 64))
+    rabbitmq_backpressure_timeout: float = float(os.getenv("RABBITMQ_BACKPRESSURE_TIMEOUT", 2.0))
+    rabbitmq_publish_timeout: float = float(os.getenv("RABBITMQ_PUBLISH_TIMEOUT", 10.0))
+
+    # Передача загрузок: "claim_check" - файл кладется в общее хранилище, в сообщении только ссылка,
+    # "inline" - файл передается в сообщении в base64
+    upload_transport: str = os.getenv("UPLOAD_TRANSPORT", "claim_check")
+    staging_dir: str = os.getenv("STAGING_DIR", "storage/staging")
+    upload_chunk_size: int = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+
+    # Ограничения загрузок (проверяются и в API, и в image_service): размер файла, число пикселей
+    # (защита от decompression bomb), до скольких первых байт заголовок разбирается после каждого
+    # куска (дальше - при удвоении прочитанного, до max_upload_bytes) и допустимые форматы
+    max_upload_bytes: int = int(os.getenv("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+    max_image_pixels: int = int(os.getenv("MAX_IMAGE_PIXELS", 50_000_000))
+    upload_sniff_bytes: int = int(os.getenv("UPLOAD_SNIFF_BYTES", 64 * 1024))
+    upload_allowed_formats: str = os.getenv("UPLOAD_ALLOWED_FORMATS", "JPEG,PNG,WEBP,GIF,BMP,TIFF")
+    # Пакетная загрузка /image/upload_images: сколько файлов принимается в одном запросе и
+    # сколько байт base64 (UPLOAD_TRANSPORT=inline) копится в памяти до публикации части пачки
+    upload_batch_max_files: int = int(os.getenv("UPLOAD_BATCH_MAX_FILES", 500))
+    upload_batch_publish_bytes: int = int(os.getenv("UPLOAD_BATCH_PUBLISH_BYTES", 16 * 1024 * 1024))
+
+    # Контентно-адресуемое хранилище обработанных изображений (каталоги по префиксу sha256 исходника)
+    blob_dir: str = os.getenv("BLOB_DIR", "storage/blobs")
+
+    # Режим воркера image_service: "simple" - один поток с auto_ack,
+    # "pool" - ручные ack, prefetch и пул процессов для обработки изображений,
+    # "batch" - пачки сообщений, одна транзакция и один ack на пачку
+    image_worker_mode: str = os.getenv("IMAGE_WORKER_MODE", "pool")
+    image_worker_processes: int = int(os.getenv("IMAGE_WORKER_PROCESSES", os.cpu_count() or 1))
+    image_worker_prefetch: int = int(os.getenv("IMAGE_WORKER_PREFETCH", 2 * (os.cpu_count() or 1)))
+
+    image_batch_size: int = int(os.getenv("IMAGE_BATCH_SIZE", 100))
+    image_batch_timeout_ms: int = int(os.getenv("IMAGE_BATCH_TIMEOUT_MS", 200))
+
+    # Массовая загрузка (режим batch): загрузки пачки рендерятся кусками по image_bulk_chunk_size,
+    # основной кадр в оттенках серого считается одной векторной операцией NumPy на весь кусок
+    image_bulk_ingest: bool = os.getenv("IMAGE_BULK_INGEST", "false").lower() == "true"
+    image_bulk_chunk_size: int = int(os.getenv("IMAGE_BULK_CHUNK_SIZE", 16))
+
+    # Журнал обработанных событий: LRU последних id и bloom-фильтр перед запросом к БД
+    event_ledger_recent_size: int = int(os.getenv("EVENT_LEDGER_RECENT_SIZE", 100000))
+    event_ledger_bloom_capacity: int = int(os.getenv("EVENT_LEDGER_BLOOM_CAPACITY", 1000000))
+    event_ledger_bloom_error_rate: float = float(os.getenv("EVENT_LEDGER_BLOOM_ERROR_RATE", 0.001))
+
+    # Статусы задач загрузки: период опроса БД для long-poll/SSE, максимальное ожидание и heartbeat SSE
+    job_poll_interval: float = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+    job_long_poll_max: float = float(os.getenv("JOB_LONG_POLL_MAX", 30))
+    job_sse_heartbeat: float = float(os.getenv("JOB_SSE_HEARTBEAT", 15))
+
+    # Пресеты рендишенов в JSON, например
+    # [{"name": "thumbnail", "width": 256, "height": 256, "fit": "cover", "format": "JPEG", "quality": 75}]
+    image_renditions: str = os.getenv("IMAGE_RENDITIONS", "")
+
+    # Рендер по запросу (/image/{image_id}/render) и кэш вариантов
+    render_max_dimension: int = int(os.getenv("RENDER_MAX_DIMENSION", 4096))
+    render_cache_dir: str = os.getenv("RENDER_CACHE_DIR", "storage/render_cache")
+    render_cache_memory_bytes: int = int(os.getenv("RENDER_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+    render_cache_memory_item_bytes: int = int(os.getenv("RENDER_CACHE_MEMORY_ITEM_BYTES", 256 * 1024))
+    render_cache_disk_bytes: int = int(os.getenv("RENDER_CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+
+    # Отдача файлов изображений (/image/{image_id}/download)
+    download_cache_max_age: int = int(os.getenv("DOWNLOAD_CACHE_MAX_AGE", 31536000))
+
+    # Потоковая выгрузка метаданных (/image/export): строк на одну выборку серверного курсора
+    export_batch_size: int = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+
+    # Поиск похожих (/image/{image_id}/similar): наибольшее допустимое расстояние Хэмминга между
+    # dHash, сколько строк дочитывается в индекс в памяти за одну выборку и сколько секунд
+    # индекс ждет строку с пропущенным id (транзакция воркера еще не завершилась)
+    similar_max_distance: int = int(os.getenv("SIMILAR_MAX_DISTANCE", 16))
+    similar_index_batch_size: int = int(os.getenv("SIMILAR_INDEX_BATCH_SIZE", 10000))
+    similar_index_gap_timeout: float = float(os.getenv("SIMILAR_INDEX_GAP_TIMEOUT", 600))
+
 
 core_config = CoreConfig()
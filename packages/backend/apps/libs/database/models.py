@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import BigInteger, Column, Integer, String, DateTime, ForeignKey, Index
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
 from apps.libs.database.database import Base
@@ -13,6 +14,21 @@ class User(Base):
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
 
 
+class Blob(Base):
+    """
+    Обработанный исходник, общий для всех Image с одинаковым содержимым.
+    Файлы удаляются, когда refcount падает до нуля.
+    """
+    __tablename__ = "blob"
+    sha256 = Column(String(64), primary_key=True)
+    file_path = Column(String, nullable=False)
+    resolution = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    content_hash = Column(String(64), nullable=True)
+    refcount = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=func.now())
+
+
 class Image(Base):
     __tablename__ = "image"
     id = Column(Integer, primary_key=True, index=True)
@@ -20,6 +36,63 @@ class Image(Base):
     file_path = Column(String, nullable=False)
     resolution = Column(String, nullable=False)
     size = Column(Integer, nullable=False)
+    # sha256 содержимого файла, используется как сильный ETag
+    content_hash = Column(String(64), nullable=True)
+    # sha256 исходного файла; у изображений, загруженных до хранилища блобов, пусто
+    blob_hash = Column(String(64), ForeignKey("blob.sha256"), nullable=True, index=True)
+    # dHash основного кадра (знаковое 64-битное) для поиска похожих; у старых изображений пусто
+    phash = Column(BigInteger, nullable=True, index=True)
     user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    renditions = relationship("Rendition", cascade="all, delete-orphan", passive_deletes=True)
+
+    # keyset-пагинация списка изображений по (created_at, id), в том числе по владельцу
+    __table_args__ = (
+        Index("ix_image_created_at_id", "created_at", "id"),
+        Index("ix_image_user_id_created_at_id", "user_id", "created_at", "id"),
+    )
+
+
+class Rendition(Base):
+    __tablename__ = "rendition"
+    id = Column(Integer, primary_key=True, index=True)
+    image_id = Column(Integer, ForeignKey("image.id", ondelete="CASCADE"), nullable=False, index=True)
+    name = Column(String, nullable=False)
+    file_path = Column(String, nullable=False)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    format = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    content_hash = Column(String(64), nullable=True)
+    created_at = Column(DateTime, default=func.now())
+
+
+class ProcessedEvent(Base):
+    """
+    Журнал обработанных событий брокера. Запись добавляется в той же транзакции,
+    что и результат обработки, поэтому повторная доставка не применится дважды.
+    """
+    __tablename__ = "processed_event"
+    message_id = Column(String(64), primary_key=True)
+    event_type = Column(String, nullable=False)
+    user_id = Column(Integer, nullable=True)
+    processed_at = Column(DateTime, default=func.now(), index=True)
+
+
+class Job(Base):
+    """
+    Статус обработки загрузки. id совпадает с message_id события UPLOAD:
+    main_api создает задачу в статусе queued, image_service переводит ее
+    в processing и затем в done (с image_id) или failed (с текстом ошибки).
+    """
+    __tablename__ = "job"
+    id = Column(String(64), primary_key=True)
+    user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False, index=True)
+    event_type = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="queued")
+    image_id = Column(Integer, ForeignKey("image.id", ondelete="SET NULL"), nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
@@ -0,0 +1,121 @@
+import collections
+import os
+import time
+
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server
+)
+
+from apps.libs.broker.topology import PUBLISHED_AT_HEADER, RETRY_HEADER
+from apps.libs.tracing.tracing import start_span
+
+# Метки только с ограниченным набором значений (шаблон маршрута, очередь, стадия),
+# чтобы число временных рядов не росло с числом пользователей и изображений
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"]
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "HTTP requests being handled", ["method"], multiprocess_mode="livesum"
+)
+
+BROKER_PUBLISH_SECONDS = Histogram(
+    "broker_publish_duration_seconds", "Time to publish a message including the broker confirm", ["queue"]
+)
+BROKER_PUBLISH_FAILURES = Counter(
+    "broker_publish_failures", "Messages that were not published", ["queue", "reason"]
+)
+
+IMAGE_STAGE_SECONDS = Histogram(
+    "image_stage_duration_seconds", "Time spent in each image processing stage", ["stage"]
+)
+IMAGE_QUEUE_LAG_SECONDS = Histogram(
+    "image_queue_lag_seconds", "Time between publishing an event and its first delivery", ["queue"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+)
+IMAGE_EVENTS_IN_FLIGHT = Gauge(
+    "image_events_in_flight", "Events being processed by the worker", ["event_type"], multiprocess_mode="livesum"
+)
+IMAGE_EVENT_RETRIES = Counter(
+    "image_event_retries", "Failed events sent to a delay queue or dead-lettered", ["queue", "outcome"]
+)
+
+
+EVENT_TYPES = ('UPLOAD', 'UPDATE', 'DELETE')
+
+
+def events_in_flight(event_type: str):
+    # тип события приходит из сообщения: неизвестные значения не должны плодить метки
+    return IMAGE_EVENTS_IN_FLIGHT.labels(event_type if event_type in EVENT_TYPES else "unknown")
+
+
+@contextmanager
+def track_in_flight(event_types):
+    counts = collections.Counter(event_types)
+    for event_type, count in counts.items():
+        events_in_flight(event_type).inc(count)
+    try:
+        yield
+    finally:
+        for event_type, count in counts.items():
+            events_in_flight(event_type).dec(count)
+
+
+def published_at_header() -> dict:
+    return {PUBLISHED_AT_HEADER: int(time.time() * 1000)}
+
+
+def observe_queue_lag(method, properties):
+    headers = (properties.headers if properties is not None else None) or {}
+    published_at = headers.get(PUBLISHED_AT_HEADER)
+    # повторы ждут в очередях задержки намеренно, их в ожидании не учитываем
+    if published_at is None or RETRY_HEADER in headers:
+        return
+    IMAGE_QUEUE_LAG_SECONDS.labels(method.routing_key).observe(max(0.0, time.time() - published_at / 1000))
+
+
+def observe_stages(timings: dict):
+    for stage, seconds in timings.items():
+        IMAGE_STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+@contextmanager
+def timed_stage(stage: str):
+    started = time.perf_counter()
+    try:
+        with start_span(stage):
+            yield
+    finally:
+        IMAGE_STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def metrics_registry():
+    """
+    При нескольких процессах (воркеры uvicorn) prometheus_client пишет значения
+    в файлы каталога PROMETHEUS_MULTIPROC_DIR, и отдавать нужно их сумму.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render_metrics() -> tuple:
+    return generate_latest(metrics_registry()), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port: int):
+    # отдельный поток-демон с HTTP-сервером, обработку сообщений не задерживает
+    if port:
+        start_http_server(port, registry=metrics_registry())
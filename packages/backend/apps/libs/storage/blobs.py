@@ -0,0 +1,51 @@
+import os
+import re
+import hashlib
+import logging
+
+from apps.libs.config.core_config import core_config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BLOB_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def blob_directory(sha256: str) -> str:
+    """
+    Каталог блоба: storage/blobs/ab/cd для хэша abcd..., чтобы в одном
+    каталоге не копились сотни тысяч файлов.
+    """
+    if not BLOB_HASH_PATTERN.match(sha256):
+        raise ValueError(f"Invalid blob hash: {sha256!r}")
+    return os.path.join(core_config.blob_dir, sha256[:2], sha256[2:4])
+
+
+def blob_basename(sha256: str, filename: str) -> str:
+    return f"{sha256}{os.path.splitext(filename)[1].lower()}"
+
+
+def hash_file(source, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Потоковый sha256 файлового объекта; позиция чтения восстанавливается.
+    """
+    position = source.tell()
+    sha256 = hashlib.sha256()
+    while chunk := source.read(chunk_size):
+        sha256.update(chunk)
+    source.seek(position)
+    return sha256.hexdigest()
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    with open(path, "rb") as source:
+        return hash_file(source, chunk_size)
+
+
+def remove_blob_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+            logger.info("Blob file removed: %s", path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,133 @@
+import io
+import os
+
+from fastapi import HTTPException
+from PIL import Image as PILImage
+
+from apps.libs.config.core_config import core_config
+
+# Собственная защита Pillow (предупреждение выше лимита, ошибка выше двух лимитов)
+# согласована с настройкой, чтобы не срабатывать раньше нашей проверки
+PILImage.MAX_IMAGE_PIXELS = core_config.max_image_pixels
+
+
+def allowed_formats() -> set:
+    return {name.strip().upper() for name in core_config.upload_allowed_formats.split(",") if name.strip()}
+
+
+def check_upload_size(size: int):
+    if size is not None and size > core_config.max_upload_bytes:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image file is too large, limit is {core_config.max_upload_bytes} bytes"
+        )
+
+
+def check_image_header(img_format: str, size: tuple):
+    """
+    Проверка по заголовку, до декодирования пикселей: формат из списка
+    допустимых и число пикселей не больше max_image_pixels.
+    """
+    if img_format not in allowed_formats():
+        raise HTTPException(status_code=415, detail=f"Unsupported image format: {img_format}")
+    width, height = size
+    if width * height > core_config.max_image_pixels:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image is too large: {width}x{height}, limit is {core_config.max_image_pixels} pixels"
+        )
+
+
+def check_image_source(source):
+    """
+    Проверка исходника в image_service перед обработкой: размер файла и
+    заголовок. PILImage.open читает только заголовок, пиксели не декодируются.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        check_upload_size(os.path.getsize(source))
+    try:
+        with PILImage.open(source) as img:
+            check_image_header(img.format, img.size)
+    except PILImage.DecompressionBombError:
+        raise HTTPException(status_code=413, detail="Image is too large")
+    if not isinstance(source, (str, os.PathLike)):
+        source.seek(0)
+
+
+# Сколько первых байт проверяется на сигнатуру формата (столько же читает PILImage.open)
+MAGIC_BYTES = 16
+
+
+def has_known_magic(prefix: bytes) -> bool:
+    """
+    Начинается ли файл с сигнатуры одного из допустимых форматов. Проверяются
+    те же функции accept плагинов Pillow, что использует PILImage.open.
+    """
+    PILImage.init()
+    for img_format in allowed_formats():
+        if img_format not in PILImage.OPEN:
+            continue
+        _, accept = PILImage.OPEN[img_format]
+        if accept is None or accept(prefix):
+            return True
+    return False
+
+
+class UploadGuard:
+    """
+    Проверяет загрузку по мере чтения кусков: считает байты и определяет
+    формат и размеры по началу файла. Файл с неизвестной сигнатурой
+    отклоняется на первом куске, слишком большой - как только превысит
+    лимит, до того как загрузка целиком прочитана и отправлена в очередь.
+
+    Заголовок разбирается после каждого куска в пределах upload_sniff_bytes,
+    дальше - каждый раз, когда прочитанное начало файла удвоилось: у фото с
+    камер и телефонов перед SOF бывает больше 64 КБ APPn-сегментов (ICC,
+    EXIF, XMP, MPF). Начало файла копится, пока формат не определен, не
+    больше max_upload_bytes.
+    """
+
+    def __init__(self, sniff_bytes: int = None):
+        self.sniff_bytes = sniff_bytes or core_config.upload_sniff_bytes
+        self.head = bytearray()
+        self.next_sniff = 0
+        self.size = 0
+        self.format = None
+        self.dimensions = None
+
+    def feed(self, chunk: bytes):
+        self.size += len(chunk)
+        check_upload_size(self.size)
+        if self.format is not None:
+            return
+        magic_checked = len(self.head) >= MAGIC_BYTES
+        self.head += chunk
+        if not magic_checked and len(self.head) >= MAGIC_BYTES and not has_known_magic(bytes(self.head[:MAGIC_BYTES])):
+            raise HTTPException(status_code=415, detail="Uploaded file is not a supported image")
+        if len(self.head) >= self.next_sniff:
+            self.sniff()
+            # разбор заново с начала файла: после upload_sniff_bytes - реже, чтобы не было O(n^2)
+            self.next_sniff = len(self.head) + 1 if len(self.head) < self.sniff_bytes else 2 * len(self.head)
+
+    def sniff(self):
+        try:
+            # open ленивый: разбирает только заголовок и не выделяет память под пиксели
+            with PILImage.open(io.BytesIO(self.head)) as img:
+                self.format, self.dimensions = img.format, img.size
+        except PILImage.DecompressionBombError:
+            raise HTTPException(status_code=413, detail="Image is too large")
+        except (OSError, SyntaxError, ValueError):
+            # заголовок еще не прочитан целиком
+            return
+        self.head = bytearray()
+        check_image_header(self.format, self.dimensions)
+
+    def finish(self):
+        if self.format is None and self.head:
+            self.sniff()
+        if self.format is None:
+            raise HTTPException(status_code=415, detail="Uploaded file is not a supported image")
+
+    @property
+    def resolution(self) -> str:
+        return f"{self.dimensions[0]}x{self.dimensions[1]}"
@@ -0,0 +1,71 @@
+import os
+import re
+import uuid
+import hashlib
+import logging
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from apps.libs.config.core_config import core_config
+from apps.libs.storage.image_guard import UploadGuard
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAGED_REF_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def staged_path(staged_ref: str) -> str:
+    # ref приходит из сообщения брокера, поэтому не даем выйти за пределы staging_dir
+    if not STAGED_REF_PATTERN.match(staged_ref):
+        raise ValueError(f"Invalid staged ref: {staged_ref!r}")
+    return os.path.join(core_config.staging_dir, staged_ref)
+
+
+async def stage_upload(upload: UploadFile, guard: UploadGuard = None) -> dict:
+    """
+    Потоково копирует загрузку в общее хранилище кусками по upload_chunk_size,
+    попутно считая sha256 и размер. В сообщение брокера уходит только ссылка.
+    guard проверяет размер и заголовок изображения по ходу копирования:
+    отклоненная загрузка не дочитывается, частичный файл удаляется.
+    """
+    guard = guard or UploadGuard()
+    os.makedirs(core_config.staging_dir, exist_ok=True)
+
+    staged_ref = uuid.uuid4().hex
+    path = staged_path(staged_ref)
+    partial_path = f"{path}.part"
+    sha256 = hashlib.sha256()
+    size = 0
+
+    try:
+        with open(partial_path, "wb") as staged_file:
+            while chunk := await upload.read(core_config.upload_chunk_size):
+                guard.feed(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+                await run_in_threadpool(staged_file.write, chunk)
+        guard.finish()
+        os.replace(partial_path, path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    logger.info("Upload staged: %s (%s bytes)", staged_ref, size)
+    return {"staged_ref": staged_ref, "sha256": sha256.hexdigest(), "size": size}
+
+
+def staged_blob_path(staged_ref: str, expected_size: int = None) -> str:
+    path = staged_path(staged_ref)
+    if expected_size is not None and os.path.getsize(path) != expected_size:
+        raise ValueError(f"Staged blob {staged_ref} size mismatch")
+    return path
+
+
+def remove_staged(staged_ref: str):
+    path = staged_path(staged_ref)
+    if os.path.exists(path):
+        os.remove(path)
+        logger.info("Staged upload removed: %s", staged_ref)
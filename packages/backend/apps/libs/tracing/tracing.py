@@ -0,0 +1,199 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from apps.libs.broker.topology import PUBLISHED_AT_HEADER, RETRY_HEADER
+from apps.libs.config.core_config import core_config
+
+# Заголовок W3C Trace Context: и в HTTP, и в заголовках сообщений AMQP
+TRACEPARENT_HEADER = "traceparent"
+TRACE_ID_HEADER = "x-trace-id"
+
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class SpanContext:
+    """
+    Ссылка на спан из другого процесса: то, что передается в traceparent.
+    """
+
+    __slots__ = ("trace_id", "span_id", "sampled")
+
+    def __init__(self, trace_id: str, span_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+class Span(SpanContext):
+    __slots__ = ("name", "parent_id", "start", "end", "attributes")
+
+    def __init__(self, name: str, parent: SpanContext = None, start: float = None, **attributes):
+        if parent is None:
+            # новая трасса: решение о записи принимается один раз и передается дальше во флаге
+            super().__init__(new_id(16), new_id(8), random.random() < core_config.trace_sample_ratio)
+        else:
+            super().__init__(parent.trace_id, new_id(8), parent.sampled)
+        self.name = name
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, end: float = None):
+        if self.end is None:
+            self.end = time.time() if end is None else end
+            exporter.export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": round((self.end - self.start) * 1000, 3),
+            "pid": os.getpid(),
+            "attributes": self.attributes
+        }
+
+
+current_span: ContextVar = ContextVar("current_span", default=None)
+
+
+def new_id(size: int) -> str:
+    return random.getrandbits(size * 8).to_bytes(size, "big").hex()
+
+
+def extract(headers) -> SpanContext:
+    return parse_traceparent((headers or {}).get(TRACEPARENT_HEADER))
+
+
+def parse_traceparent(value) -> SpanContext:
+    """
+    Некорректный traceparent не ошибка: трасса просто начинается заново.
+    """
+    if not isinstance(value, str):
+        return None
+    match = TRACEPARENT_PATTERN.match(value.strip().lower())
+    if match is None or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    return SpanContext(match.group(1), match.group(2), int(match.group(3), 16) & 1 == 1)
+
+
+def inject(headers: dict) -> dict:
+    span = current_span.get()
+    if span is not None:
+        headers[TRACEPARENT_HEADER] = span.traceparent
+    return headers
+
+
+@contextmanager
+def use_span(span: SpanContext):
+    """
+    Делает спан текущим, не завершая его: для спанов, которые живут дольше одного вызова.
+    """
+    token = current_span.set(span)
+    try:
+        yield span
+    finally:
+        current_span.reset(token)
+
+
+@contextmanager
+def activate(span: Span):
+    """
+    Делает спан текущим на время блока и завершает его.
+    """
+    token = current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set(error=repr(e))
+        raise
+    finally:
+        current_span.reset(token)
+        span.finish()
+
+
+def start_span(name: str, parent: SpanContext = None, **attributes):
+    """
+    Дочерний спан текущего (или явно переданного parent) на время блока.
+    """
+    return activate(Span(name, parent if parent is not None else current_span.get(), **attributes))
+
+
+def message_span(name: str, properties, **attributes) -> Span:
+    """
+    Спан обработки сообщения, продолжающий трассу из его заголовков. Время
+    от публикации до получения записывается отдельным спаном queue_wait
+    рядом с ним. У повторов ожидание включает задержку повтора, его не пишем.
+    """
+    headers = getattr(properties, "headers", None) or {}
+    parent = extract(headers)
+    received = time.time()
+    attempt = headers.get(RETRY_HEADER, 0)
+    published_at = headers.get(PUBLISHED_AT_HEADER)
+    if parent is not None and published_at is not None and not attempt:
+        record_span("queue_wait", min(published_at / 1000, received), received, parent, **attributes)
+    return Span(name, parent, start=received, attempt=attempt, **attributes)
+
+
+def record_span(name: str, start: float, end: float, parent: SpanContext = None, **attributes):
+    """
+    Спан по уже измеренному интервалу: ожидание в очереди, стадии рендера.
+    """
+    parent = parent if parent is not None else current_span.get()
+    if parent is None or not parent.sampled or not exporter.enabled:
+        return
+    Span(name, parent, start=start, **attributes).finish(end)
+
+
+class JsonLinesExporter:
+    """
+    Пишет завершенные спаны в файл, по одному JSON на строку. Файл открыт с
+    O_APPEND и каждая строка пишется одним write, поэтому API, воркер и его
+    дочерние процессы могут писать в один файл. Пустой путь - ничего не пишется,
+    контекст при этом все равно передается дальше.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = None
+        self.pid = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def export(self, span: Span):
+        if not self.enabled or not span.sampled:
+            return
+        line = (json.dumps(span.to_dict(), default=str) + "\n").encode()
+        with self.lock:
+            # после fork дескриптор родителя не используется
+            if self.fd is None or self.pid != os.getpid():
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                self.pid = os.getpid()
+            os.write(self.fd, line)
+
+
+exporter = JsonLinesExporter(core_config.trace_export_path)
@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from apps.libs.database.database import get_db
+from apps.libs.database.database import get_async_db
 from .auth_dto import LoginDto, RegisterDto, Token
 from .auth_service import service_register, service_login
 
@@ -10,7 +10,7 @@ auth_router = APIRouter(prefix="/auth")
 
 
 @auth_router.post("/register", response_model=Token)
-async def register(user_data: RegisterDto, db: Session = Depends(get_db)):
+async def register(user_data: RegisterDto, db: AsyncSession = Depends(get_async_db)):
     """
     Роут для регистрации новых юзеров.
     Пример curl-запроса:
@@ -27,7 +27,7 @@ async def register(user_data: RegisterDto, db: Session = Depends(get_db)):
 
 
 @auth_router.post("/login", response_model=Token)
-async def login(user_data: LoginDto, db: Session = Depends(get_db)):
+async def login(user_data: LoginDto, db: AsyncSession = Depends(get_async_db)):
     """
     Роут для логина
 
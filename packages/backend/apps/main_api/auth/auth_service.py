@@ -1,42 +1,36 @@
-from passlib.context import CryptContext
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from apps.libs.auth.jwt import create_access_token
 from apps.libs.database.models import User
 from apps.main_api.auth.auth_dto import RegisterDto, LoginDto
+from apps.main_api.auth.hashing import pwd_context, hash_password_async, verify_password_async
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-
-def hash_password(password: str):
-    return pwd_context.hash(password)
-
-
-def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-async def service_register(user_data: RegisterDto, db: Session):
-    existing_user = db.query(User).filter_by(username=user_data.username).first()
+async def service_register(user_data: RegisterDto, db: AsyncSession):
+    existing_user = await db.scalar(select(User).filter_by(username=user_data.username))
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered")
 
-    hashed_password = hash_password(user_data.password)
+    hashed_password = await hash_password_async(user_data.password)
     new_user = User(username=user_data.username, hashed_password=hashed_password)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
 
-    token = create_access_token(data={"sub": new_user.username})
+    token = create_access_token(data={"sub": new_user.username, "uid": new_user.id})
     return {"access_token": token, "token_type": "bearer"}
 
 
-async def service_login(user_data: LoginDto, db: Session):
-    user = db.query(User).filter_by(username=user_data.username).first()
-    if not user or not verify_password(user_data.password, user.hashed_password):
+async def service_login(user_data: LoginDto, db: AsyncSession):
+    user = await db.scalar(select(User).filter_by(username=user_data.username))
+    if not user or not await verify_password_async(user_data.password, user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
-    token = create_access_token(data={"sub": user.username})
+    # Если изменилась стоимость bcrypt (BCRYPT_ROUNDS), перехэшируем пароль, пока он известен
+    if pwd_context.needs_update(user.hashed_password):
+        user.hashed_password = await hash_password_async(user_data.password)
+        await db.commit()
+
+    token = create_access_token(data={"sub": user.username, "uid": user.id})
     return {"access_token": token, "token_type": "bearer"}
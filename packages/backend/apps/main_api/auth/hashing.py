@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+from apps.libs.config.core_config import core_config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=core_config.bcrypt_rounds)
+
+hashing_executor = None
+pending = 0
+pending_lock = threading.Lock()
+
+
+def hash_password(password: str):
+    return pwd_context.hash(password)
+
+
+def verify_password(plain_password: str, hashed_password: str):
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def start_hashing_pool():
+    global hashing_executor
+    # bcrypt отпускает GIL на время хэширования, поэтому потоков достаточно,
+    # а event loop в это время продолжает обслуживать остальные запросы.
+    hashing_executor = ThreadPoolExecutor(
+        max_workers=core_config.password_hash_workers,
+        thread_name_prefix="password-hash"
+    )
+
+
+def close_hashing_pool():
+    global hashing_executor
+    if hashing_executor is not None:
+        hashing_executor.shutdown(wait=True)
+        hashing_executor = None
+
+
+def hashing_busy_exception():
+    return HTTPException(status_code=503, detail="Authentication service is busy, try again later")
+
+
+async def run_hashing(func, *args):
+    """
+    Выполняет func в пуле хэширования. Если все потоки заняты и очередь
+    уже заполнена, сразу отвечает 503, а не копит ожидающие запросы.
+    """
+    global pending
+    if hashing_executor is None:
+        start_hashing_pool()
+
+    with pending_lock:
+        if pending >= core_config.password_hash_workers + core_config.password_hash_max_queue:
+            logger.warning("Password hashing pool is saturated, rejecting request")
+            raise hashing_busy_exception()
+        pending += 1
+
+    # Место в очереди освобождается, когда поток действительно закончил работу,
+    # даже если клиент уже отключился и запрос отменен.
+    future = hashing_executor.submit(func, *args)
+    future.add_done_callback(release_pending)
+    return await asyncio.wrap_future(future)
+
+
+def release_pending(_):
+    global pending
+    with pending_lock:
+        pending -= 1
+
+
+async def hash_password_async(password: str):
+    return await run_hashing(hash_password, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str):
+    return await run_hashing(verify_password, plain_password, hashed_password)
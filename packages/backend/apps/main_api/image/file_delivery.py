@@ -0,0 +1,55 @@
+import os
+
+from email.utils import formatdate
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+
+
+def etag_for(content_hash: str) -> str:
+    return f'"{content_hash}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match сравнивается слабо: W/"x" совпадает с "x"
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (candidate.strip() for candidate in if_none_match.split(","))
+    return etag in (candidate.removeprefix("W/") for candidate in candidates)
+
+
+def not_modified_response(headers: dict) -> Response:
+    return Response(status_code=304, headers=headers)
+
+
+class ImageFileResponse(FileResponse):
+    """
+    FileResponse с сильным ETag из хэша содержимого.
+
+    Range-запросы обслуживает FileResponse. If-Range сравнивается с нашим ETag,
+    а не с тем, который Starlette строит из mtime и размера. Если сервер
+    поддерживает ASGI-расширение http.response.pathsend, тело целиком отдается
+    самим сервером без чтения файла в приложении (sendfile).
+    """
+
+    def _should_use_range(self, http_if_range: str, stat_result: os.stat_result) -> bool:
+        return http_if_range in (self.headers.get("etag"), formatdate(stat_result.st_mtime, usegmt=True))
+
+    async def __call__(self, scope, receive, send):
+        request_headers = Headers(scope=scope)
+        if (
+                "http.response.pathsend" in scope.get("extensions", {})
+                and scope["method"].upper() != "HEAD"
+                and "range" not in request_headers
+                and self.stat_result is not None
+        ):
+            await send({
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers
+            })
+            await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+            if self.background is not None:
+                await self.background()
+            return
+        await super().__call__(scope, receive, send)
@@ -1,22 +1,39 @@
+from datetime import datetime
+from typing import Literal
+
 from fastapi import (
     APIRouter,
     Depends,
     UploadFile,
-    File
+    File,
+    Header,
+    Query,
+    Request,
+    Response
 )
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from apps.libs.auth.auth_dependencies import get_current_user
-from apps.libs.database.database import get_db
+from apps.libs.config.core_config import core_config
+from apps.libs.database.database import get_async_db
 from apps.libs.database.models import User
-from .image_dto import ImageUpdate, ImageOut
+from .image_dto import ImageUpdate, ImageOut, ImageListItem, SimilarImage
 from .image_service import (
     service_get_all_images,
     service_get_image_by_id,
+    service_get_similar_images,
     service_upload_image,
+    service_upload_images,
     service_update_image,
     service_delete_image,
+    service_render_image,
+    service_download_image,
+    service_export_images,
+    service_get_event_status,
+    service_get_job,
+    service_stream_job,
 )
+from .render_cache import render_cache
 
 
 image_router = APIRouter(prefix="/image", dependencies=[Depends(get_current_user)])
@@ -25,7 +42,8 @@ image_router = APIRouter(prefix="/image", dependencies=[Depends(get_current_user
 @image_router.post("/upload_image", response_model=dict)
 async def upload_image(
     image: UploadFile = File(...),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Загружает новое изображение и отправляет его на обработку.
@@ -41,7 +59,9 @@ async def upload_image(
     Пример ответа:
     ```
     {
-        "detail": "Image upload request sent to the processing service"
+        "detail": "Image upload request sent to the processing service",
+        "message_id": "3f2b8c0e9a5d4e6f8a7b6c5d4e3f2a1b",
+        "job_id": "3f2b8c0e9a5d4e6f8a7b6c5d4e3f2a1b"
     }
     ```
 
@@ -50,8 +70,102 @@ async def upload_image(
     {
         "detail": "Not authenticated"
     }
+
+    OR (503, брокер перегружен или не подтвердил сообщение)
+
+    {
+        "detail": "Message broker is busy, try again later"
+    }
+
+    OR (413, файл больше MAX_UPLOAD_BYTES или изображение больше MAX_IMAGE_PIXELS)
+
+    {
+        "detail": "Image is too large: 20000x20000, limit is 50000000 pixels"
+    }
+
+    OR (415, файл не является изображением допустимого формата)
+
+    {
+        "detail": "Uploaded file is not a supported image"
+    }
+    """
+    return await service_upload_image(image, current_user, db)
+
+
+# тело разбирается потоково в сервисе, схема нужна только для документации
+UPLOAD_IMAGES_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "properties": {"images": {"type": "array", "items": {"type": "string", "format": "binary"}}},
+                "required": ["images"]
+            }
+        }
+    }
+}
+
+
+@image_router.post("/upload_images", response_model=dict, openapi_extra={"requestBody": UPLOAD_IMAGES_BODY})
+async def upload_images(
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Загружает пачку изображений одним multipart-запросом. Каждый файл
+    проверяется и сохраняется сразу после разбора, без буферизации всего
+    запроса; события уходят на обработку одной пакетной публикацией.
+    Не больше UPLOAD_BATCH_MAX_FILES файлов в запросе.
+    Только для авторизованных пользователей.
+
+    Пример запроса:
+    ```
+    curl -X POST "http://localhost:8000/image/upload_images"
+        -H "Authorization: Bearer yourAccessToken"
+        -F "images=@first.jpg"
+        -F "images=@second.png"
+    ```
+
+    Пример ответа (отклоненный файл не прерывает пачку):
+    ```
+    {
+        "detail": "Image upload requests sent to the processing service",
+        "files": [
+            {
+                "filename": "first.jpg",
+                "job_id": "3f2b8c0e9a5d4e6f8a7b6c5d4e3f2a1b",
+                "message_id": "3f2b8c0e9a5d4e6f8a7b6c5d4e3f2a1b"
+            },
+            {
+                "filename": "notes.txt",
+                "status_code": 415,
+                "detail": "Uploaded file is not a supported image"
+            }
+        ]
+    }
+    ```
+
+    OR (400, в запросе нет файлов или тело не multipart/form-data)
+
+    {
+        "detail": "No files in request"
+    }
+
+    OR (413, файлов больше UPLOAD_BATCH_MAX_FILES)
+
+    {
+        "detail": "Too many files in one request, limit is 500"
+    }
+
+    OR (503, брокер не принял ни одного сообщения пачки)
+
+    {
+        "detail": "Message broker is busy, try again later"
+    }
     """
-    return await service_upload_image(image, current_user)
+    return await service_upload_images(request, current_user, db)
 
 
 @image_router.put("/update/{image_id}", response_model=dict)
@@ -74,7 +188,8 @@ async def update_image(
     Пример ответа:
     ```
     {
-        "detail": "Image update request sent to the processing service"
+        "detail": "Image update request sent to the processing service",
+        "message_id": "3f2b8c0e9a5d4e6f8a7b6c5d4e3f2a1b"
     }
     ```
 
@@ -83,6 +198,12 @@ async def update_image(
     {
         "detail": "Not authenticated"
     }
+
+    OR (503, брокер перегружен или не подтвердил сообщение)
+
+    {
+        "detail": "Message broker is busy, try again later"
+    }
     """
     return await service_update_image(image_id, image_update, current_user)
 
@@ -104,7 +225,8 @@ async def delete_image(
     Пример ответа:
     ```
     {
-        "detail": "Image deletion request sent to the processing service"
+        "detail": "Image deletion request sent to the processing service",
+        "message_id": "3f2b8c0e9a5d4e6f8a7b6c5d4e3f2a1b"
     }
     ```
 
@@ -113,19 +235,138 @@ async def delete_image(
     {
         "detail": "Not authenticated"
     }
+
+    OR (503, брокер перегружен или не подтвердил сообщение)
+
+    {
+        "detail": "Message broker is busy, try again later"
+    }
     """
     return await service_delete_image(image_id, current_user)
 
 
-@image_router.get("/get_all_images", response_model=list[ImageOut])
-async def read_images(db: Session = Depends(get_db)):
+@image_router.get("/jobs/{job_id}", response_model=dict)
+async def read_job(
+        job_id: str,
+        wait: float = Query(0, ge=0, le=core_config.job_long_poll_max),
+        current_user: User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_async_db)):
+    """
+    Статус задачи загрузки по job_id из ответа upload_image: queued, processing, done или failed.
+    После done в image_id - id созданного изображения.
+    С параметром wait (секунды) работает как long-poll: отвечает, как только задача завершится.
+    Только для авторизованных пользователей
+
+    Пример curl-запроса:
+    ```
+        curl -X GET "http://localhost:8000/image/jobs/{job_id}?wait=25"
+        -H "Authorization: Bearer yourAccessToken"
+    ```
+
+    Пример ответа:
+    ```
+    {
+        "job_id": "3f2b8c0e9a5d4e6f8a7b6c5d4e3f2a1b",
+        "event_type": "UPLOAD",
+        "status": "done",
+        "image_id": 14,
+        "error": null,
+        "created_at": "2024-11-02T18:10:16.510939",
+        "updated_at": "2024-11-02T18:10:17.120512"
+    }
+    ```
+    """
+    return await service_get_job(job_id, wait, current_user, db)
+
+
+@image_router.get("/jobs/{job_id}/events")
+async def stream_job(
+        job_id: str,
+        current_user: User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_async_db)):
     """
-    Выдает все изображения.
+    Server-Sent Events: событие status при каждой смене статуса задачи,
+    поток закрывается после done или failed.
     Только для авторизованных пользователей
 
     Пример curl-запроса:
     ```
-        curl -X GET "http://localhost:8000/images/get_all_images"
+        curl -N "http://localhost:8000/image/jobs/{job_id}/events"
+        -H "Authorization: Bearer yourAccessToken"
+    ```
+
+    Пример потока:
+    ```
+    event: status
+    data: {"job_id": "3f2b8c0e9a5d4e6f8a7b6c5d4e3f2a1b", "status": "processing", ...}
+
+    event: status
+    data: {"job_id": "3f2b8c0e9a5d4e6f8a7b6c5d4e3f2a1b", "status": "done", "image_id": 14, ...}
+    ```
+    """
+    return await service_stream_job(job_id, current_user, db)
+
+
+@image_router.get("/events/{message_id}", response_model=dict)
+async def read_event_status(
+        message_id: str,
+        current_user: User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_async_db)):
+    """
+    Статус обработки события по message_id, который возвращают upload_image, update и delete.
+    Только для авторизованных пользователей
+
+    Пример curl-запроса:
+    ```
+        curl -X GET "http://localhost:8000/image/events/{message_id}"
+        -H "Authorization: Bearer yourAccessToken"
+    ```
+
+    Пример ответа:
+    ```
+    {
+        "message_id": "3f2b8c0e9a5d4e6f8a7b6c5d4e3f2a1b",
+        "status": "processed",
+        "event_type": "UPLOAD",
+        "processed_at": "2024-11-02T18:10:16.510939"
+    }
+
+    OR
+
+    {
+        "message_id": "3f2b8c0e9a5d4e6f8a7b6c5d4e3f2a1b",
+        "status": "pending"
+    }
+    ```
+    """
+    return await service_get_event_status(message_id, current_user, db)
+
+
+@image_router.get("/get_all_images", response_model=list[ImageListItem], response_model_exclude_unset=True)
+async def read_images(
+        response: Response,
+        limit: int = Query(100, ge=1, le=1000),
+        cursor: str = None,
+        owner_id: int = None,
+        min_size: int = Query(None, ge=0),
+        max_size: int = Query(None, ge=0),
+        created_from: datetime = None,
+        created_to: datetime = None,
+        fields: str = Query(None, description="Поля через запятую, например id,title,size"),
+        db: AsyncSession = Depends(get_async_db)):
+    """
+    Выдает изображения постранично, от новых к старым (keyset-пагинация по created_at, id).
+    Курсор следующей страницы возвращается в заголовке X-Next-Cursor, если страниц больше нет - заголовка нет.
+    Фильтры: owner_id, min_size/max_size (байты), created_from/created_to (ISO 8601).
+    Параметр fields ограничивает набор полей в ответе.
+    Только для авторизованных пользователей
+
+    Пример curl-запроса:
+    ```
+        curl -X GET "http://localhost:8000/image/get_all_images?limit=50&owner_id=1&fields=id,title,size"
+        -H "Authorization: Bearer yourAccessToken"
+
+        curl -X GET "http://localhost:8000/image/get_all_images?limit=50&cursor={X-Next-Cursor}"
         -H "Authorization: Bearer yourAccessToken"
     ```
 
@@ -161,11 +402,48 @@ async def read_images(db: Session = Depends(get_db)):
     }
     ```
     """
-    return await service_get_all_images(db)
+    return await service_get_all_images(
+        db,
+        response,
+        limit,
+        cursor=cursor,
+        owner_id=owner_id,
+        min_size=min_size,
+        max_size=max_size,
+        created_from=created_from,
+        created_to=created_to,
+        fields=fields
+    )
+
+
+@image_router.get("/export")
+async def export_images(
+        format: Literal["ndjson", "csv"] = "ndjson",
+        after_id: int = Query(0, ge=0),
+        owner_id: int = None):
+    """
+    Потоковая выгрузка метаданных всех изображений в порядке id (NDJSON или CSV).
+    Прерванную выгрузку можно продолжить с последнего полученного id через after_id.
+    Только для авторизованных пользователей
+
+    Пример curl-запроса:
+    ```
+        curl -X GET "http://localhost:8000/image/export?format=ndjson&after_id=0"
+        -H "Authorization: Bearer yourAccessToken"
+        --output images.ndjson
+    ```
+
+    Пример ответа (NDJSON, по объекту на строку):
+    ```
+    {"id": 1, "title": "name1.png", "file_path": "storage/20241102181015_name1.png", "resolution": "500x500", ...}
+    {"id": 2, "title": "name2.png", "file_path": "storage/20241102181015_name2.png", "resolution": "500x500", ...}
+    ```
+    """
+    return await service_export_images(after_id, format, owner_id)
 
 
 @image_router.get("/{image_id}", response_model=ImageOut)
-async def read_image(image_id: int, db: Session = Depends(get_db)):
+async def read_image(image_id: int, db: AsyncSession = Depends(get_async_db)):
     """
     Выдает изображение по image_id.
     Только для авторизованных пользователей
@@ -197,3 +475,113 @@ async def read_image(image_id: int, db: Session = Depends(get_db)):
     ```
     """
     return await service_get_image_by_id(image_id, db)
+
+
+@image_router.get("/{image_id}/similar", response_model=list[SimilarImage])
+async def read_similar_images(
+        image_id: int,
+        max_distance: int = Query(10, ge=0, le=core_config.similar_max_distance),
+        limit: int = Query(50, ge=1, le=500),
+        db: AsyncSession = Depends(get_async_db)):
+    """
+    Выдает похожие изображения (почти дубликаты): расстояние Хэмминга между
+    перцептивными хэшами (dHash) не больше max_distance, ближайшие первыми.
+    Поиск идет по BK-дереву в памяти, без сканирования таблицы и без чтения файлов.
+    Только для авторизованных пользователей
+
+    Пример curl-запроса:
+    ```
+        curl -X GET "http://localhost:8000/image/{image_id}/similar?max_distance=8"
+        -H "Authorization: Bearer yourAccessToken"
+    ```
+
+    Пример ответа:
+    ```
+    [
+        {
+            "id": 27,
+            "title": "name_copy.jpg",
+            "resolution": "500x500",
+            "size": 112044,
+            "user_id": 1,
+            "distance": 2
+        }
+    ]
+
+    OR (409, изображение загружено до появления хэшей)
+
+    {
+        "detail": "Perceptual hash is not computed for this image"
+    }
+    ```
+    """
+    return await service_get_similar_images(image_id, max_distance, limit, db)
+
+
+@image_router.get("/{image_id}/render")
+async def render_image(
+        image_id: int,
+        w: int = Query(None, ge=1, le=core_config.render_max_dimension),
+        h: int = Query(None, ge=1, le=core_config.render_max_dimension),
+        fit: Literal["contain", "cover", "stretch"] = "contain",
+        format: Literal["jpeg", "png", "webp"] = "jpeg",
+        db: AsyncSession = Depends(get_async_db)):
+    """
+    Отдает вариант изображения нужного размера, рендерит его при первом запросе.
+    Повторные запросы обслуживаются из кэша (память для небольших вариантов, затем диск).
+    Только для авторизованных пользователей
+
+    Пример curl-запроса:
+    ```
+        curl -X GET "http://localhost:8000/image/{image_id}/render?w=320&h=240&fit=cover&format=webp"
+        -H "Authorization: Bearer yourAccessToken"
+        --output preview.webp
+    ```
+    """
+    return await service_render_image(image_id, w, h, fit, format, db)
+
+
+@image_router.get("/render_cache/stats", response_model=dict)
+async def read_render_cache_stats():
+    """
+    Счетчики кэша рендеров: попадания, промахи, вытеснения и текущий объем.
+
+    Пример ответа:
+    ```
+    {
+        "memory_hits": 120,
+        "disk_hits": 8,
+        "misses": 15,
+        "collapsed": 3,
+        "memory_evictions": 0,
+        "disk_evictions": 0,
+        "memory_items": 15,
+        "memory_bytes": 254310,
+        "disk_items": 15,
+        "disk_bytes": 254310
+    }
+    ```
+    """
+    return render_cache.stats()
+
+
+@image_router.get("/{image_id}/download")
+async def download_image(
+        image_id: int,
+        rendition: str = None,
+        if_none_match: str = Header(None),
+        db: AsyncSession = Depends(get_async_db)):
+    """
+    Отдает файл изображения (или рендишена по имени, например thumbnail).
+    Поддерживает Range-запросы, сильный ETag по хэшу содержимого и If-None-Match (304).
+    Только для авторизованных пользователей
+
+    Пример curl-запроса:
+    ```
+        curl -X GET "http://localhost:8000/image/{image_id}/download?rendition=preview"
+        -H "Authorization: Bearer yourAccessToken"
+        -H "Range: bytes=0-1023"
+        --output part.jpg
+    ```
+    """
+    return await service_download_image(image_id, rendition, if_none_match, db)
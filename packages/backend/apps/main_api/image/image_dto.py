@@ -28,3 +28,28 @@ class ImageOut(ImageBase):
 
     class Config:
         orm_mode = True
+
+
+class ImageListItem(BaseModel):
+    """
+    Элемент списка изображений. При проекции (?fields=) заполнены только запрошенные поля.
+    """
+    id: Optional[int] = None
+    title: Optional[str] = None
+    resolution: Optional[str] = None
+    size: Optional[int] = None
+    file_path: Optional[str] = None
+    content_hash: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    user_id: Optional[int] = None
+
+
+class SimilarImage(BaseModel):
+    id: int
+    title: str
+    resolution: str
+    size: int
+    user_id: int
+    # расстояние Хэмминга между dHash: 0 - практически то же изображение
+    distance: int
@@ -1,28 +1,242 @@
+import asyncio
 import base64
-from sqlalchemy.orm import Session
-from fastapi import HTTPException, UploadFile
+import csv
+import hashlib
+import io
+import json
+import os
+import uuid
+import mimetypes
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from fastapi import HTTPException, UploadFile, Request, Response
+from fastapi.responses import StreamingResponse
+from PIL import Image as PILImage
+from starlette.concurrency import run_in_threadpool
 
 from apps.image_service.dto import ImageUpdate
-from apps.libs.broker.broker import send_message
-from apps.libs.database.models import Image, User
+from apps.image_service.jobs import JOB_QUEUED, JOB_DONE, JOB_FAILED
+from apps.image_service.renditions import RenditionPreset, render_to_bytes
+from apps.libs.broker.broker import PublishPendingError, broker_busy_exception, send_message, send_messages
+from apps.libs.broker.pool import BatchPublishError
+from apps.libs.config.core_config import core_config
+from apps.libs.database.database import AsyncSessionLocal
+from apps.libs.database.models import Image, Job, ProcessedEvent, User
+from apps.libs.storage.blobs import file_sha256
+from apps.libs.storage.image_guard import UploadGuard, check_upload_size
+from apps.libs.storage.staging import stage_upload, remove_staged
+from apps.libs.tracing.tracing import start_span
+from apps.main_api.image.file_delivery import (
+    ImageFileResponse,
+    etag_for,
+    etag_matches,
+    not_modified_response
+)
+from apps.main_api.image.image_dto import ImageListItem
+from apps.main_api.image.job_watcher import job_payload, job_watcher
+from apps.main_api.image.multipart_stream import MultipartStream
+from apps.main_api.image.render_cache import render_cache
+from apps.main_api.image.similarity import similarity_index
 
 
-async def service_upload_image(
-        image: UploadFile,
-        current_user: User
-):
-    image_bytes = await image.read()
-    encoded_image = base64.b64encode(image_bytes).decode('utf-8')
+async def read_upload_payload(image, current_user: User) -> tuple:
+    """
+    Читает загрузку (UploadFile или часть потокового multipart) и собирает
+    данные события UPLOAD: ссылку на staged-файл или сам файл в base64, по
+    UPLOAD_TRANSPORT. Возвращает (payload, staged).
+    """
+    # размер, известный после разбора multipart, проверяется до чтения файла;
+    # формат и размеры в пикселях - по первым байтам, до постановки в очередь
+    check_upload_size(image.size)
+    guard = UploadGuard()
+
+    if core_config.upload_transport == "claim_check":
+        with start_span("stage_upload"):
+            staged = await stage_upload(image, guard)
+        return {
+            "title": image.filename,
+            "resolution": guard.resolution,
+            "user_id": current_user.id,
+            **staged
+        }, staged
 
-    await send_message("UPLOAD", {
+    chunks = []
+    with start_span("read_upload"):
+        while chunk := await image.read(core_config.upload_chunk_size):
+            guard.feed(chunk)
+            chunks.append(chunk)
+        guard.finish()
+    image_bytes = b"".join(chunks)
+    return {
         "title": image.filename,
-        "resolution": "1920x1080",
+        "resolution": guard.resolution,
         "size": len(image_bytes),
+        "sha256": hashlib.sha256(image_bytes).hexdigest(),
         "user_id": current_user.id,
-        "file_data": encoded_image
-    })
+        "file_data": base64.b64encode(image_bytes).decode('utf-8')
+    }, None
+
+
+# задачи, дожидающиеся итога публикаций без подтверждения брокера
+pending_publishes = set()
+
+
+def settle_pending_publish(outcome, uploads: list):
+    """
+    Публикация не подтверждена вовремя: staged-файлы и задачи uploads
+    (job_id, staged) в порядке публикации остаются, пока не придет итог.
+    Сообщения, которые брокер так и не принял, завершают свои задачи с
+    ошибкой и удаляют staged-файлы, как при обычном отказе брокера.
+    """
+    async def settle():
+        try:
+            await outcome
+        except BatchPublishError as e:
+            failed = uploads[e.published:]
+        except Exception:
+            failed = uploads
+        else:
+            return
+        for _, staged in failed:
+            if staged is not None:
+                remove_staged(staged["staged_ref"])
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(Job)
+                .where(Job.id.in_([job_id for job_id, _ in failed]), Job.status == JOB_QUEUED)
+                .values(status=JOB_FAILED, error=broker_busy_exception().detail)
+            )
+            await db.commit()
+
+    task = asyncio.ensure_future(settle())
+    pending_publishes.add(task)
+    task.add_done_callback(pending_publishes.discard)
+
+
+async def service_upload_image(
+        image: UploadFile,
+        current_user: User,
+        db: AsyncSession
+):
+    payload, staged = await read_upload_payload(image, current_user)
+
+    # задача создается до публикации, чтобы воркер всегда находил ее строку
+    job = Job(id=uuid.uuid4().hex, user_id=current_user.id, event_type="UPLOAD", status=JOB_QUEUED)
+    db.add(job)
+    await db.commit()
+
+    try:
+        message_id = await send_message("UPLOAD", payload, message_id=job.id)
+    except PublishPendingError as e:
+        # сообщение могло дойти до брокера: итог покажет статус задачи
+        settle_pending_publish(e.outcome, [(job.id, staged)])
+        return {"detail": e.detail, "message_id": job.id, "job_id": job.id}
+    except HTTPException as e:
+        if staged is not None:
+            remove_staged(staged["staged_ref"])
+        job.status = JOB_FAILED
+        job.error = e.detail
+        await db.commit()
+        raise
+
+    return {
+        "detail": "Image upload request sent to the processing service",
+        "message_id": message_id,
+        "job_id": job.id
+    }
+
+
+async def publish_uploads(accepted: list, db: AsyncSession) -> tuple:
+    """
+    Публикует события UPLOAD принятых файлов одной пачкой и записывает итог
+    каждого файла в его результат. Возвращает (сколько сообщений принято
+    брокером или ждет подтверждения, ошибка брокера или None).
+    """
+    # задачи создаются до публикации, чтобы воркер всегда находил их строки
+    await db.commit()
+
+    try:
+        published = await send_messages("UPLOAD", [(job.id, payload) for _, job, payload, _ in accepted])
+    except PublishPendingError as e:
+        settle_pending_publish(e.outcome, [(job.id, staged) for _, job, _, staged in accepted])
+        for result, job, _, _ in accepted:
+            result.update(message_id=job.id, detail=e.detail)
+        return len(accepted), None
+    except HTTPException as e:
+        published, failure = [], e
+    else:
+        failure = broker_busy_exception()
+    published = set(published)
 
-    return {"detail": "Image upload request sent to the processing service"}
+    for result, job, _, staged in accepted:
+        if job.id in published:
+            result["message_id"] = job.id
+            continue
+        if staged is not None:
+            remove_staged(staged["staged_ref"])
+        job.status = JOB_FAILED
+        job.error = failure.detail
+        del result["job_id"]
+        result.update(status_code=failure.status_code, detail=failure.detail)
+    await db.commit()
+    return len(published), failure if len(published) < len(accepted) else None
+
+
+async def service_upload_images(request: Request, current_user: User, db: AsyncSession):
+    """
+    Пакетная загрузка: файлы multipart-запроса по мере разбора проверяются и
+    сохраняются (staged или в память, как в service_upload_image), события
+    UPLOAD уходят пакетной публикацией после разбора всего запроса. При
+    UPLOAD_TRANSPORT=inline файлы едут в теле сообщений, поэтому пачка
+    публикуется, как только в памяти набралось upload_batch_publish_bytes.
+    Отклоненный файл не прерывает пачку, ответ содержит результат по каждому.
+    """
+    reader = MultipartStream(
+        request.headers.get("content-type", ""), request.stream(), core_config.upload_batch_max_files
+    )
+    results = []
+    accepted = []
+    buffered = 0
+    sent = 0
+    failure = None
+    try:
+        async for upload in reader.files():
+            try:
+                payload, staged = await read_upload_payload(upload, current_user)
+            except HTTPException as e:
+                results.append({"filename": upload.filename, "status_code": e.status_code, "detail": e.detail})
+                continue
+            job = Job(id=uuid.uuid4().hex, user_id=current_user.id, event_type="UPLOAD", status=JOB_QUEUED)
+            db.add(job)
+            result = {"filename": upload.filename, "job_id": job.id}
+            results.append(result)
+            accepted.append((result, job, payload, staged))
+            buffered += len(payload.get("file_data", ""))
+            if buffered >= core_config.upload_batch_publish_bytes:
+                published, error = await publish_uploads(accepted, db)
+                sent, failure = sent + published, error or failure
+                accepted, buffered = [], 0
+    except BaseException:
+        # запрос оборван или некорректен: еще не отправленные файлы никто не обработает
+        for _, _, _, staged in accepted:
+            if staged is not None:
+                remove_staged(staged["staged_ref"])
+        raise
+
+    if not results:
+        raise HTTPException(status_code=400, detail="No files in request")
+    if accepted:
+        published, error = await publish_uploads(accepted, db)
+        sent, failure = sent + published, error or failure
+
+    if not sent:
+        if failure is not None:
+            raise failure
+        return {"detail": "No images were accepted", "files": results}
+    return {"detail": "Image upload requests sent to the processing service", "files": results}
 
 
 async def service_update_image(
@@ -30,32 +244,341 @@ async def service_update_image(
         image_update: ImageUpdate,
         current_user: User
 ):
-    await send_message("UPDATE", {
+    message_id = await send_message("UPDATE", {
         "image_id": image_id,
         "new_data": image_update.dict(exclude_unset=True),
         "user_id": current_user.id
     })
-    return {"detail": "Image update request sent to the processing service"}
+    return {"detail": "Image update request sent to the processing service", "message_id": message_id}
 
 
 async def service_delete_image(
         image_id: int,
         current_user: User
 ):
-    await send_message("DELETE", {
+    message_id = await send_message("DELETE", {
         "image_id": image_id,
         "user_id": current_user.id
     })
-    return {"detail": "Image deletion request sent to the processing service"}
+    return {"detail": "Image deletion request sent to the processing service", "message_id": message_id}
+
+
+async def service_get_event_status(message_id: str, current_user: User, db: AsyncSession):
+    event = await db.get(ProcessedEvent, message_id)
+    # чужие события не раскрываем: для них, как и для еще не обработанных, статус pending
+    if event is None or event.user_id != current_user.id:
+        return {"message_id": message_id, "status": "pending"}
+    return {
+        "message_id": message_id,
+        "status": "processed",
+        "event_type": event.event_type,
+        "processed_at": event.processed_at
+    }
+
+
+JOB_FINAL_STATUSES = (JOB_DONE, JOB_FAILED)
+
+
+async def get_user_job(job_id: str, current_user: User, db: AsyncSession) -> dict:
+    job = await db.get(Job, job_id)
+    if job is None or job.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_payload(job)
+
+
+async def service_get_job(job_id: str, wait: float, current_user: User, db: AsyncSession):
+    """
+    Статус задачи. При wait > 0 - long-poll: ответ приходит, как только задача
+    завершится, или по истечении wait секунд с текущим статусом.
+    """
+    job = await get_user_job(job_id, current_user, db)
+    if wait and job["status"] not in JOB_FINAL_STATUSES:
+        # соединение с БД не держим на время ожидания
+        await db.close()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while job["status"] not in JOB_FINAL_STATUSES and loop.time() < deadline:
+            changed = await job_watcher.wait_for_change(job_id, job["status"], deadline - loop.time())
+            if changed is None:
+                break
+            job = changed
+    return job
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=export_value)}\n\n"
+
+
+async def iter_job_events(job: dict):
+    yield format_sse("status", job)
+    while job["status"] not in JOB_FINAL_STATUSES:
+        changed = await job_watcher.wait_for_change(job["job_id"], job["status"], core_config.job_sse_heartbeat)
+        if changed is None:
+            # комментарий SSE не дает прокси закрыть простаивающее соединение
+            yield ": keep-alive\n\n"
+            continue
+        job = changed
+        yield format_sse("status", job)
+
+
+async def service_stream_job(job_id: str, current_user: User, db: AsyncSession):
+    job = await get_user_job(job_id, current_user, db)
+    await db.close()
+    return StreamingResponse(
+        iter_job_events(job),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+IMAGE_LIST_FIELDS = tuple(ImageListItem.model_fields)
+
+
+def encode_cursor(created_at: datetime, image_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), image_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
 
 
-async def service_get_all_images(db):
-    images = db.query(Image).all()
-    return images
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, image_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(image_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
-async def service_get_image_by_id(image_id: int, db: Session):
-    image = db.query(Image).filter_by(id=image_id).first()
+def parse_fields(fields: Optional[str]) -> list:
+    if not fields:
+        return list(IMAGE_LIST_FIELDS)
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = set(requested) - set(IMAGE_LIST_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return requested
+
+
+async def service_get_all_images(
+        db: AsyncSession,
+        response: Response,
+        limit: int,
+        cursor: Optional[str] = None,
+        owner_id: Optional[int] = None,
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        created_from: Optional[datetime] = None,
+        created_to: Optional[datetime] = None,
+        fields: Optional[str] = None
+):
+    """
+    Keyset-пагинация по (created_at, id) от новых к старым. Курсор следующей
+    страницы возвращается в заголовке X-Next-Cursor.
+    """
+    requested = parse_fields(fields)
+    # поля курсора выбираются всегда, даже если их нет в проекции
+    columns = list(dict.fromkeys([*requested, "created_at", "id"]))
+    query = select(*(getattr(Image, column) for column in columns))
+
+    if owner_id is not None:
+        query = query.where(Image.user_id == owner_id)
+    if min_size is not None:
+        query = query.where(Image.size >= min_size)
+    if max_size is not None:
+        query = query.where(Image.size <= max_size)
+    if created_from is not None:
+        query = query.where(Image.created_at >= created_from)
+    if created_to is not None:
+        query = query.where(Image.created_at < created_to)
+    if cursor:
+        after_created_at, after_id = decode_cursor(cursor)
+        query = query.where(tuple_(Image.created_at, Image.id) < tuple_(after_created_at, after_id))
+
+    query = query.order_by(Image.created_at.desc(), Image.id.desc()).limit(limit + 1)
+    rows = (await db.execute(query)).mappings().all()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+
+    return [{field: row[field] for field in requested} for row in rows]
+
+
+EXPORT_FIELDS = ("id", "title", "file_path", "resolution", "size", "content_hash", "user_id", "created_at", "updated_at")
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def format_export_rows(rows, export_format: str) -> str:
+    rows = [[export_value(value) for value in row] for row in rows]
+    if export_format == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue()
+    return "".join(json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + "\n" for row in rows)
+
+
+async def iter_image_export(after_id: int, export_format: str, owner_id: Optional[int] = None):
+    """
+    Генератор выгрузки: строки читаются серверным курсором пачками по export_batch_size,
+    поэтому память не зависит от размера таблицы. Сессия своя, так как генератор
+    работает уже после выхода из зависимостей запроса.
+    """
+    async with AsyncSessionLocal() as db:
+        query = select(*(getattr(Image, field) for field in EXPORT_FIELDS)).where(Image.id > after_id)
+        if owner_id is not None:
+            query = query.where(Image.user_id == owner_id)
+        query = query.order_by(Image.id).execution_options(yield_per=core_config.export_batch_size)
+
+        if export_format == "csv":
+            yield format_export_rows([EXPORT_FIELDS], export_format)
+        result = await db.stream(query)
+        async for partition in result.partitions():
+            yield format_export_rows(partition, export_format)
+
+
+async def service_export_images(after_id: int, export_format: str, owner_id: Optional[int] = None):
+    return StreamingResponse(
+        iter_image_export(after_id, export_format, owner_id),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="images.{export_format}"'}
+    )
+
+
+async def service_get_image_by_id(image_id: int, db: AsyncSession, with_renditions: bool = False):
+    query = select(Image).filter_by(id=image_id)
+    # в асинхронной сессии ленивой загрузки нет, рендишены подгружаются заранее
+    if with_renditions:
+        query = query.options(selectinload(Image.renditions))
+    image = await db.scalar(query)
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
     return image
+
+
+async def service_get_similar_images(
+        image_id: int,
+        max_distance: int,
+        limit: int,
+        db: AsyncSession
+) -> list:
+    image = await service_get_image_by_id(image_id, db)
+    if image.phash is None:
+        raise HTTPException(status_code=409, detail="Perceptual hash is not computed for this image")
+
+    await similarity_index.refresh(db)
+    matches = [
+        (distance, match_id)
+        for distance, match_id in similarity_index.search(image.phash, max_distance)
+        if match_id != image_id
+    ]
+
+    similar = []
+    # кандидаты уже отсортированы по расстоянию; строки удаленных изображений не найдутся
+    for start in range(0, len(matches), limit):
+        window = matches[start:start + limit]
+        rows = {row.id: row for row in await db.scalars(
+            select(Image).where(Image.id.in_([match_id for _, match_id in window]))
+        )}
+        for distance, match_id in window:
+            row = rows.get(match_id)
+            if row is None:
+                similarity_index.discard(match_id)
+                continue
+            similar.append({
+                "id": row.id,
+                "title": row.title,
+                "resolution": row.resolution,
+                "size": row.size,
+                "user_id": row.user_id,
+                "distance": distance
+            })
+        if len(similar) >= limit:
+            break
+    return similar[:limit]
+
+
+RENDER_MEDIA_TYPES = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+
+def render_source_path(image: Image) -> str:
+    # самый крупный рендишен цветной и без искажения пропорций, основной файл - 500x500 в сером
+    if image.renditions:
+        return max(image.renditions, key=lambda rendition: rendition.width * rendition.height).file_path
+    return image.file_path
+
+
+async def service_render_image(
+        image_id: int,
+        width: int,
+        height: int,
+        fit: str,
+        img_format: str,
+        db: AsyncSession
+):
+    image = await service_get_image_by_id(image_id, db, with_renditions=True)
+    source_path = render_source_path(image)
+    if not os.path.exists(source_path):
+        raise HTTPException(status_code=404, detail="Image file not found")
+
+    preset = RenditionPreset(
+        name="on_demand",
+        width=width or core_config.render_max_dimension,
+        height=height or core_config.render_max_dimension,
+        fit=fit,
+        format=img_format.upper()
+    )
+    key = render_cache.make_key(image.id, source_path, preset.width, preset.height, fit, img_format)
+    content = await render_cache.get_or_render(key, lambda: render_to_bytes(source_path, preset))
+
+    return Response(
+        content=content,
+        media_type=RENDER_MEDIA_TYPES[img_format],
+        # эндпоинт требует авторизации: общие кэши не должны отдавать вариант другим пользователям
+        headers={"Cache-Control": "private, max-age=86400"}
+    )
+
+
+async def service_download_image(
+        image_id: int,
+        rendition_name: str,
+        if_none_match: str,
+        db: AsyncSession
+):
+    image = await service_get_image_by_id(image_id, db, with_renditions=True)
+
+    target = image
+    media_type = mimetypes.guess_type(image.file_path)[0]
+    if rendition_name:
+        target = next((rendition for rendition in image.renditions if rendition.name == rendition_name), None)
+        if target is None:
+            raise HTTPException(status_code=404, detail="Rendition not found")
+        media_type = PILImage.MIME.get(target.format)
+
+    try:
+        stat_result = await run_in_threadpool(os.stat, target.file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image file not found")
+
+    # у записей, созданных до появления content_hash, хэш считается один раз при первой отдаче
+    if target.content_hash is None:
+        target.content_hash = await run_in_threadpool(file_sha256, target.file_path)
+        await db.commit()
+
+    headers = {
+        "ETag": etag_for(target.content_hash),
+        "Cache-Control": f"private, max-age={core_config.download_cache_max_age}, immutable"
+    }
+    if if_none_match and etag_matches(if_none_match, headers["ETag"]):
+        return not_modified_response(headers)
+
+    return ImageFileResponse(
+        target.file_path,
+        headers=headers,
+        media_type=media_type or "application/octet-stream",
+        filename=os.path.basename(target.file_path),
+        stat_result=stat_result,
+        content_disposition_type="inline"
+    )
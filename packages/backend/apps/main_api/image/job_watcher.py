@@ -0,0 +1,81 @@
+import asyncio
+import logging
+
+from sqlalchemy import select
+
+from apps.libs.config.core_config import core_config
+from apps.libs.database.database import AsyncSessionLocal
+from apps.libs.database.models import Job
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def job_payload(job: Job) -> dict:
+    return {
+        "job_id": job.id,
+        "event_type": job.event_type,
+        "status": job.status,
+        "image_id": job.image_id,
+        "error": job.error,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at
+    }
+
+
+class JobWatcher:
+    """
+    Ожидание смены статуса задач для long-poll и SSE.
+
+    Статус пишет image_service в другом процессе, поэтому его приходится
+    опрашивать. Опрос один на процесс: каждые poll_interval секунд одним
+    запросом читаются все задачи, которые кто-то ждет, сколько бы клиентов
+    ни висело на соединениях. Когда ждущих нет, опрос останавливается.
+    """
+
+    def __init__(self, poll_interval: float = core_config.job_poll_interval):
+        self.poll_interval = poll_interval
+        self._waiters = {}
+        self._task = None
+
+    async def wait_for_change(self, job_id: str, known_status: str, timeout: float):
+        """
+        Ждет, пока статус задачи станет отличным от known_status.
+        Возвращает новое состояние задачи или None по таймауту.
+        """
+        future = asyncio.get_running_loop().create_future()
+        waiter = (known_status, future)
+        self._waiters.setdefault(job_id, []).append(waiter)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._poll())
+        try:
+            return await asyncio.wait_for(future, timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters.get(job_id, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self._waiters.pop(job_id, None)
+
+    async def _poll(self):
+        while self._waiters:
+            await asyncio.sleep(self.poll_interval)
+            job_ids = list(self._waiters)
+            if not job_ids:
+                break
+            try:
+                async with AsyncSessionLocal() as db:
+                    jobs = (await db.scalars(select(Job).where(Job.id.in_(job_ids)))).all()
+            except Exception as e:
+                logger.error(f"Job status poll failed: {e}")
+                continue
+
+            for job in jobs:
+                for known_status, future in self._waiters.get(job.id, []):
+                    if job.status != known_status and not future.done():
+                        future.set_result(job_payload(job))
+
+
+job_watcher = JobWatcher()
@@ -0,0 +1,142 @@
+import collections
+
+from fastapi import HTTPException
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+
+def decode_header_value(value: bytes) -> str:
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return value.decode("latin-1")
+
+
+class StreamedFile:
+    """
+    Файловая часть multipart-запроса. read возвращает куски по мере их
+    разбора из тела запроса, поэтому ее можно передать в stage_upload
+    вместо UploadFile. Размер заранее неизвестен.
+    """
+
+    def __init__(self, reader: "MultipartStream", filename: str, content_type: str):
+        self.reader = reader
+        self.filename = filename
+        self.content_type = content_type
+        self.size = None
+        self.finished = False
+
+    async def read(self, size: int = -1) -> bytes:
+        return await self.reader.read_part(self, size)
+
+
+class MultipartStream:
+    """
+    Потоковый разбор multipart/form-data поверх request.stream(). В отличие
+    от разбора формы в Starlette файлы не копируются во временные файлы до
+    вызова обработчика: files() отдает часть сразу после ее заголовков, а
+    тело части читается из запроса по мере того, как его читает обработчик.
+    Недочитанный остаток части (например, отклоненной проверкой) пропускается.
+    """
+
+    def __init__(self, content_type: str, stream, max_files: int):
+        media_type, options = parse_options_header(content_type)
+        if media_type != b"multipart/form-data" or b"boundary" not in options:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data request")
+        self.stream = stream
+        self.max_files = max_files
+        self.events = collections.deque()
+        self.exhausted = False
+        self.current = None
+        self.pending = b""
+        self.header_name = b""
+        self.header_value = b""
+        self.part_headers = {}
+        self.parser = MultipartParser(options[b"boundary"], {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished
+        })
+
+    # колбэки парсера только складывают события: читать их можно лишь из async-кода
+    def on_part_begin(self):
+        self.part_headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self.header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.part_headers[self.header_name.lower()] = self.header_value
+        self.header_name = b""
+        self.header_value = b""
+
+    def on_headers_finished(self):
+        self.events.append(("part", self.part_headers))
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if end > start:
+            self.events.append(("data", bytes(data[start:end])))
+
+    def on_part_end(self):
+        self.events.append(("end", None))
+
+    async def next_event(self):
+        while not self.events:
+            if self.exhausted:
+                return None
+            try:
+                chunk = await self.stream.__anext__()
+            except StopAsyncIteration:
+                chunk = b""
+            try:
+                if chunk:
+                    self.parser.write(chunk)
+                else:
+                    self.parser.finalize()
+                    self.exhausted = True
+            except MultipartParseError:
+                raise HTTPException(status_code=400, detail="Malformed multipart body")
+        return self.events.popleft()
+
+    async def files(self):
+        count = 0
+        while (event := await self.next_event()) is not None:
+            kind, headers = event
+            # данные и конец пропущенных частей
+            if kind != "part":
+                continue
+            _, options = parse_options_header(headers.get(b"content-disposition", b""))
+            if b"filename" not in options:
+                continue
+            count += 1
+            if count > self.max_files:
+                raise HTTPException(
+                    status_code=413, detail=f"Too many files in one request, limit is {self.max_files}"
+                )
+            self.current = StreamedFile(
+                self, decode_header_value(options[b"filename"]),
+                decode_header_value(headers.get(b"content-type", b"application/octet-stream"))
+            )
+            self.pending = b""
+            yield self.current
+
+    async def read_part(self, part: StreamedFile, size: int) -> bytes:
+        if part.finished or part is not self.current:
+            return b""
+        if not self.pending:
+            event = await self.next_event()
+            if event is None or event[0] != "data":
+                part.finished = True
+                return b""
+            self.pending = event[1]
+        if size is None or size < 0:
+            size = len(self.pending)
+        chunk, self.pending = self.pending[:size], self.pending[size:]
+        return chunk
@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import os
+import threading
+
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+
+from apps.libs.config.core_config import core_config
+
+
+class RenderCache:
+    """
+    Двухуровневый кэш отрендеренных вариантов изображений.
+
+    В памяти - LRU по суммарному размеру, только для небольших вариантов
+    (горячие превью). На диске - LRU с ограничением общего объема, индекс
+    восстанавливается по mtime файлов при первом обращении к диску, а не при
+    импорте модуля. Одновременные запросы
+    одного ключа ждут один и тот же рендер.
+    """
+
+    def __init__(
+            self,
+            directory: str = core_config.render_cache_dir,
+            memory_max_bytes: int = core_config.render_cache_memory_bytes,
+            memory_item_max_bytes: int = core_config.render_cache_memory_item_bytes,
+            disk_max_bytes: int = core_config.render_cache_disk_bytes
+    ):
+        self.directory = directory
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_item_max_bytes = memory_item_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._disk_loaded = False
+        self._inflight = {}
+        self._counters = dict.fromkeys(
+            ("memory_hits", "disk_hits", "misses", "collapsed", "memory_evictions", "disk_evictions"), 0
+        )
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha256(":".join(str(part) for part in parts).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_disk_index(self):
+        """Вызывается под self._lock: каталог сканируется один раз."""
+        if self._disk_loaded:
+            return
+        self._disk_loaded = True
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".part"):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._load_disk_index()
+            return {
+                **self._counters,
+                "memory_items": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_items": len(self._disk),
+                "disk_bytes": self._disk_bytes
+            }
+
+    def _memory_get(self, key: str):
+        with self._lock:
+            content = self._memory.get(key)
+            if content is not None:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+            return content
+
+    def _memory_put(self, key: str, content: bytes):
+        if len(content) > self.memory_item_max_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = content
+            self._memory_bytes += len(content)
+            while self._memory_bytes > self.memory_max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+                self._counters["memory_evictions"] += 1
+
+    def _disk_get(self, key: str):
+        with self._lock:
+            self._load_disk_index()
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as cached:
+                content = cached.read()
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            # файл мог вытеснить другой процесс, работающий с тем же каталогом
+            with self._lock:
+                size = self._disk.pop(key, None)
+                if size is not None:
+                    self._disk_bytes -= size
+            return None
+        self._count("disk_hits")
+        return content
+
+    def _disk_put(self, key: str, content: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = f"{path}.{threading.get_ident()}.part"
+        with open(partial_path, "wb") as cached:
+            cached.write(content)
+        os.replace(partial_path, path)
+
+        evicted = []
+        with self._lock:
+            self._load_disk_index()
+            if key not in self._disk:
+                self._disk[key] = len(content)
+                self._disk_bytes += len(content)
+            while self._disk_bytes > self.disk_max_bytes and len(self._disk) > 1:
+                evicted_key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                self._counters["disk_evictions"] += 1
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            try:
+                os.remove(self._path(evicted_key))
+            except FileNotFoundError:
+                pass
+
+    def _load_or_render(self, key: str, render) -> bytes:
+        content = self._disk_get(key)
+        if content is None:
+            self._count("misses")
+            content = render()
+            self._disk_put(key, content)
+        self._memory_put(key, content)
+        return content
+
+    async def get_or_render(self, key: str, render) -> bytes:
+        content = self._memory_get(key)
+        if content is not None:
+            return content
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self._count("collapsed")
+        else:
+            # рендер - отдельная задача: отмена запроса, который его начал, не отменяет
+            # остальных ожидающих, а поток рендера все равно досчитает результат
+            task = asyncio.ensure_future(run_in_threadpool(self._load_or_render, key, render))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish_inflight(key, done))
+        return await asyncio.shield(task)
+
+    def _finish_inflight(self, key: str, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # исключение уже получили ожидающие, если они были
+        if not task.cancelled():
+            task.exception()
+
+
+render_cache = RenderCache()
@@ -0,0 +1,172 @@
+import asyncio
+import bisect
+import logging
+import time
+
+from sqlalchemy import or_, select
+
+from apps.image_service.phash import hamming_distance
+from apps.libs.config.core_config import core_config
+from apps.libs.database.models import Image
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Сколько диапазонов пропущенных id проверяется, старшие важнее; и сколько их в одной выборке
+MAX_PENDING_GAPS = 1000
+GAP_QUERY_CHUNK = 200
+
+
+class BKNode:
+    __slots__ = ("phash", "image_ids", "children")
+
+    def __init__(self, phash: int):
+        self.phash = phash
+        # одинаковый хэш у копий одного исходника и у очень похожих изображений
+        self.image_ids = set()
+        self.children = {}
+
+
+class BKTree:
+    """
+    BK-дерево по расстоянию Хэмминга. Потомки узла разложены по расстоянию
+    до него, поэтому поиск в радиусе r обходит только ветви с расстоянием
+    в [d - r, d + r] (неравенство треугольника), а не все хэши.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, phash: int, image_id: int) -> BKNode:
+        if self.root is None:
+            self.root = BKNode(phash)
+        node = self.root
+        while True:
+            distance = hamming_distance(phash, node.phash)
+            if distance == 0:
+                node.image_ids.add(image_id)
+                return node
+            child = node.children.get(distance)
+            if child is None:
+                child = node.children[distance] = BKNode(phash)
+            node = child
+
+    def search(self, phash: int, max_distance: int) -> list:
+        """
+        Пары (distance, image_id) для всех хэшей не дальше max_distance.
+        """
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(phash, node.phash)
+            if distance <= max_distance:
+                matches.extend((distance, image_id) for image_id in node.image_ids)
+            stack.extend(
+                child for edge, child in node.children.items()
+                if distance - max_distance <= edge <= distance + max_distance
+            )
+        return matches
+
+
+def split_gaps(gaps: list, found: list) -> list:
+    """
+    Вычитает найденные id из диапазонов [first, last, first_seen],
+    упорядоченных по first.
+    """
+    found = sorted(found)
+    result = []
+    for first, last, first_seen in gaps:
+        for image_id in found[bisect.bisect_left(found, first):bisect.bisect_right(found, last)]:
+            if image_id > first:
+                result.append([first, image_id - 1, first_seen])
+            first = image_id + 1
+        if first <= last:
+            result.append([first, last, first_seen])
+    return result
+
+
+class SimilarityIndex:
+    """
+    Индекс Image.phash в памяти процесса main_api. Загружается по мере
+    надобности: перед поиском дочитываются строки с id больше уже
+    загруженных, кусками по batch_size, так что база сканируется целиком
+    только при первом запросе.
+
+    Транзакции воркеров завершаются не по порядку id, поэтому пропуски в
+    прочитанных id запоминаются как диапазоны и проверяются при следующих
+    обновлениях, пока строка не появится или не пройдет gap_timeout секунд
+    (откат транзакции, удаление). Удаленные изображения остаются в дереве,
+    пока поиск не обнаружит, что их строк больше нет.
+    """
+
+    def __init__(
+            self,
+            batch_size: int = core_config.similar_index_batch_size,
+            gap_timeout: float = core_config.similar_index_gap_timeout
+    ):
+        self.batch_size = batch_size
+        self.gap_timeout = gap_timeout
+        self.tree = BKTree()
+        self._nodes = {}
+        self._loaded_id = 0
+        self._gaps = []
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _add(self, image_id: int, phash) -> int:
+        # строки без хэша (загруженные до миграции 0006) тоже считаются прочитанными
+        if phash is None or image_id in self._nodes:
+            return 0
+        self._nodes[image_id] = self.tree.add(phash, image_id)
+        return 1
+
+    async def _load_gaps(self, db, now: float) -> int:
+        self._gaps = [gap for gap in self._gaps if now - gap[2] < self.gap_timeout][-MAX_PENDING_GAPS:]
+        rows = []
+        for start in range(0, len(self._gaps), GAP_QUERY_CHUNK):
+            ranges = [Image.id.between(first, last) for first, last, _ in self._gaps[start:start + GAP_QUERY_CHUNK]]
+            rows.extend((await db.execute(select(Image.id, Image.phash).where(or_(*ranges)))).all())
+        if not rows:
+            return 0
+        self._gaps = split_gaps(self._gaps, [image_id for image_id, _ in rows])
+        return sum(self._add(image_id, phash) for image_id, phash in rows)
+
+    async def _load_new(self, db, now: float) -> int:
+        added = 0
+        while True:
+            rows = (await db.execute(
+                select(Image.id, Image.phash)
+                .where(Image.id > self._loaded_id)
+                .order_by(Image.id)
+                .limit(self.batch_size)
+            )).all()
+            for image_id, phash in rows:
+                if image_id > self._loaded_id + 1:
+                    self._gaps.append([self._loaded_id + 1, image_id - 1, now])
+                self._loaded_id = image_id
+                added += self._add(image_id, phash)
+            if len(rows) < self.batch_size:
+                return added
+
+    async def refresh(self, db):
+        async with self._lock:
+            now = time.monotonic()
+            added = await self._load_gaps(db, now)
+            added += await self._load_new(db, now)
+            if added:
+                logger.info("Similarity index: %s hashes added, %s total", added, len(self._nodes))
+
+    def search(self, phash: int, max_distance: int) -> list:
+        return sorted(self.tree.search(phash, max_distance))
+
+    def discard(self, image_id: int):
+        node = self._nodes.pop(image_id, None)
+        if node is not None:
+            # узел остается в дереве: через него проходят пути к потомкам
+            node.image_ids.discard(image_id)
+
+
+similarity_index = SimilarityIndex()
@@ -1,26 +1,49 @@
 import logging
 import uvicorn
 
-from fastapi import FastAPI, Request
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from starlette.middleware.gzip import GZipMiddleware
 
+from apps.image_service.main import start_in_process_worker, stop_in_process_worker
+from apps.libs.broker.backend import in_memory
+from apps.libs.broker.broker import start_publisher, close_publisher
 from apps.libs.config.core_config import core_config
+from apps.libs.database.database import async_engine
+from apps.libs.metrics.metrics import render_metrics
 from apps.main_api.auth.auth_controller import auth_router
+from apps.main_api.auth.hashing import start_hashing_pool, close_hashing_pool
 from apps.main_api.image.image_controller import image_router
+from apps.main_api.middleware import MetricsMiddleware, SelectiveGZipMiddleware, TracingMiddleware
 
 
 logging.basicConfig(level=logging.INFO)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_publisher()
+    start_hashing_pool()
+    # с брокером в памяти сообщения некому забрать, кроме воркера в этом же процессе
+    if in_memory():
+        start_in_process_worker()
+    yield
+    stop_in_process_worker()
+    close_hashing_pool()
+    close_publisher()
+    await async_engine.dispose()
+
+
 app = FastAPI(
     title="Image API",
     description="API для загрузки и управления изображениями",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1000)
 
 app.add_middleware(
     CORSMiddleware,
@@ -30,10 +53,22 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# добавлен последним, поэтому внешний: время включает сжатие и CORS
+app.add_middleware(MetricsMiddleware)
+
+# корневой спан трассы: охватывает и метрики, и сам запрос
+app.add_middleware(TracingMiddleware)
+
 app.include_router(auth_router)
 app.include_router(image_router)
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    content, media_type = render_metrics()
+    return Response(content=content, media_type=media_type)
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exception: RequestValidationError):
     logging.error("Validation error: %s", str(exception))
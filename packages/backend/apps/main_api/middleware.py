@@ -0,0 +1,129 @@
+import time
+
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+
+from apps.libs.metrics.metrics import HTTP_REQUEST_SECONDS, HTTP_REQUESTS_IN_PROGRESS
+from apps.libs.tracing.tracing import TRACE_ID_HEADER, extract, start_span
+
+# Уже сжатые форматы: повторное сжатие тратит CPU и почти не уменьшает размер.
+# Server-Sent Events тоже не сжимаются: gzip буферизует поток и задерживает события
+UNCOMPRESSIBLE_CONTENT_TYPES = (
+    "image/", "video/", "audio/", "application/zip", "application/gzip", "text/event-stream"
+)
+
+
+class SelectiveGZipResponder(GZipResponder):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.passthrough = False
+
+    async def send_with_gzip(self, message):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            # файловые ответы (FileResponse ставит accept-ranges) не сжимаются при любом типе:
+            # Content-Range считается по несжатому файлу, а pathsend отдает файл как есть
+            if (
+                    headers.get("content-type", "").startswith(UNCOMPRESSIBLE_CONTENT_TYPES)
+                    or "accept-ranges" in headers
+                    or "content-range" in headers
+            ):
+                self.passthrough = True
+                await self.send(message)
+                return
+        if self.passthrough:
+            # без изменений, включая http.response.pathsend
+            await self.send(message)
+            return
+        if message["type"] == "http.response.pathsend":
+            # GZipResponder не знает pathsend: задержанные им заголовки уходят без изменений
+            self.passthrough = True
+            await self.send(self.initial_message)
+            await self.send(message)
+            return
+        await super().send_with_gzip(message)
+
+
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware, который пропускает без сжатия изображения и другие уже сжатые ответы.
+    """
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            headers = Headers(scope=scope)
+            if "gzip" in headers.get("Accept-Encoding", ""):
+                responder = SelectiveGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class MetricsMiddleware:
+    """
+    Время обработки запросов по шаблону маршрута (/image/{image_id}, а не
+    конкретный путь), методу и статусу. Чистый ASGI без оберток над телом
+    ответа, поэтому потоковые ответы и pathsend проходят как есть.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_progress = HTTP_REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_progress.dec()
+            # маршрут известен только после роутинга: FastAPI кладет его в scope
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(
+                method, route.path if route is not None else "unmatched", status
+            ).observe(time.perf_counter() - started)
+
+
+class TracingMiddleware:
+    """
+    Корневой спан запроса. Входящий traceparent продолжается, иначе начинается
+    новая трасса. Спан текущий на время обработки, поэтому send_message кладет
+    его контекст в заголовки сообщения. Id трассы возвращается в x-trace-id,
+    чтобы по нему найти обработку загрузки в воркере.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with start_span(scope["method"], parent=extract(Headers(scope=scope))) as span:
+            async def send_with_trace_id(message):
+                if message["type"] == "http.response.start":
+                    span.set(status=message["status"])
+                    message["headers"] = [
+                        *message.get("headers", []), (TRACE_ID_HEADER.encode(), span.trace_id.encode())
+                    ]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_trace_id)
+            finally:
+                route = scope.get("route")
+                span.name = f"{scope['method']} {route.path if route is not None else 'unmatched'}"
@@ -0,0 +1,108 @@
+"""
+Нагрузочный тест API в процессе: httpx через ASGITransport, без сети и
+uvicorn. Замеряются /auth/login, /image/get_all_images и /image/upload_image
+при заданном числе одновременных клиентов. Публикация идет через обычный
+пул каналов в StandInBroker с задержками RabbitMQ.
+
+Запуск из packages/backend (sqlite-файл или локальный Postgres):
+    DATABASE_URL=sqlite:////tmp/bench.db python -m benchmarks.bench_api_load
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+
+from apps.libs.database.database import SessionLocal
+from apps.libs.database.models import Image, User
+from apps.main_api.main import app
+from benchmarks.fixtures import make_image_bytes, prepare_database, stand_in_publisher, temporary_storage
+from benchmarks.results import latency_result, print_results, throughput_result
+from benchmarks.stand_in_broker import StandInBroker
+
+ENDPOINTS = ("login", "get_all_images", "upload_image")
+
+
+def seed_images(username: str, count: int):
+    with SessionLocal() as db:
+        user = db.query(User).filter_by(username=username).one()
+        db.add_all([
+            Image(
+                title=f"seed_{i}.png", file_path=f"seed/{i}.png", resolution="640x480", size=1024, user_id=user.id
+            )
+            for i in range(count)
+        ])
+        db.commit()
+
+
+async def run_load(send, requests: int, concurrency: int) -> tuple:
+    """
+    concurrency клиентов по очереди забирают запросы, пока не выполнено requests.
+    Возвращает задержки каждого запроса и общее время.
+    """
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def client_loop():
+        for number in remaining:
+            started = time.perf_counter()
+            response = await send(number)
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.text
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started
+
+
+async def run_async(endpoints, requests: int, concurrency: int, seed: int) -> list:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        credentials = {"username": f"bench_api_{uuid.uuid4().hex[:8]}", "password": "benchpassword!"}
+        token = (await client.post("/auth/register", json=credentials)).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        seed_images(credentials["username"], seed)
+        image = make_image_bytes("PNG", (256, 256))
+
+        senders = {
+            "login": lambda _: client.post("/auth/login", json=credentials),
+            "get_all_images": lambda _: client.get("/image/get_all_images", headers=headers, params={"limit": 100}),
+            "upload_image": lambda number: client.post(
+                "/image/upload_image", headers=headers, files={"image": (f"bench_{number}.png", image, "image/png")}
+            )
+        }
+
+        results = []
+        with stand_in_publisher(StandInBroker()):
+            for endpoint in endpoints:
+                # прогрев: первое обращение к маршруту, пулы соединений и кэш пользователя
+                await run_load(senders[endpoint], concurrency, concurrency)
+                latencies, elapsed = await run_load(senders[endpoint], requests, concurrency)
+                results.append(latency_result(f"api/{endpoint}", latencies, concurrency=concurrency))
+                results.append(throughput_result(f"api/{endpoint}/throughput", len(latencies), elapsed))
+        return results
+
+
+def run(endpoints=ENDPOINTS, requests: int = 200, concurrency: int = 8, seed: int = 500) -> list:
+    prepare_database()
+    with temporary_storage():
+        return asyncio.run(run_async(endpoints, requests, concurrency, seed))
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--endpoints", nargs="+", default=list(ENDPOINTS), choices=ENDPOINTS)
+    parser.add_argument("--requests", type=int, default=200, help="запросов на каждый маршрут")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=500, help="изображений у пользователя для get_all_images")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    print_results(run(args.endpoints, args.requests, args.concurrency, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Задержка авторизованного GET /image/{id} с кэшем пользователей и без него.
+
+Запуск из packages/backend (нужна база с таблицами, например sqlite-файл):
+    DATABASE_URL=sqlite:///bench_auth.db python -m benchmarks.bench_auth_cache
+"""
+import argparse
+import statistics
+import time
+import uuid
+
+from fastapi.testclient import TestClient
+
+from apps.libs.auth.principal_cache import principal_cache
+from apps.libs.database.database import Base, SessionLocal, engine
+from apps.libs.database.models import Image, User
+from apps.main_api.main import app
+
+
+def prepare(client: TestClient):
+    Base.metadata.create_all(engine)
+    credentials = {"username": f"bench_{uuid.uuid4().hex[:8]}", "password": "benchpassword!"}
+    token = client.post("/auth/register", json=credentials).json()["access_token"]
+
+    with SessionLocal() as db:
+        user = db.query(User).filter_by(username=credentials["username"]).one()
+        image = Image(title="bench.png", file_path="storage/bench.png", resolution="500x500", size=1, user_id=user.id)
+        db.add(image)
+        db.commit()
+        return token, image.id
+
+
+def measure(client: TestClient, token: str, image_id: int, requests: int) -> list:
+    headers = {"Authorization": f"Bearer {token}"}
+    latencies = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = client.get(f"/image/{image_id}", headers=headers)
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.text
+    return latencies
+
+
+def report(name: str, latencies: list):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(
+        f"{name:>10}: mean {statistics.mean(latencies) * 1000:.3f} ms, "
+        f"p50 {statistics.median(latencies) * 1000:.3f} ms, p99 {p99 * 1000:.3f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    with TestClient(app) as client:
+        token, image_id = prepare(client)
+        cache_size = principal_cache.max_size
+
+        principal_cache.max_size = 0
+        principal_cache.clear()
+        measure(client, token, image_id, 50)
+        report("no cache", measure(client, token, image_id, args.requests))
+
+        principal_cache.max_size = cache_size
+        measure(client, token, image_id, 50)
+        report("cache", measure(client, token, image_id, args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Рендер массовой загрузки: поштучный process_image_file против пакетного
+process_image_files на одних и тех же исходниках одного размера. Файлы
+рендишенов обоих вариантов должны совпадать, иначе замер не засчитывается.
+
+Запуск из packages/backend:
+    python -m benchmarks.bench_bulk_ingest
+"""
+import argparse
+import hashlib
+import io
+import time
+
+from apps.image_service.bulk import process_image_files
+from apps.image_service.db import process_image_file
+from benchmarks.bench_save_image import parse_size
+from benchmarks.fixtures import make_image_bytes, temporary_storage
+from benchmarks.results import print_results, throughput_result
+
+
+def file_hashes(result: dict) -> list:
+    paths = [result["file_path"], *(rendition["file_path"] for rendition in result["renditions"])]
+    hashes = []
+    for path in paths:
+        with open(path, "rb") as f:
+            hashes.append(hashlib.sha256(f.read()).hexdigest())
+    return hashes
+
+
+def run(images: int = 64, size: str = "1280x720", chunk: int = 16) -> list:
+    sources = [make_image_bytes("JPEG", parse_size(size), seed) for seed in range(images)]
+    names = [f"bulk_{seed}.jpg" for seed in range(images)]
+
+    # каждый вариант пишет в свое хранилище: иначе второй найдет готовые блобы
+    with temporary_storage():
+        process_image_file(io.BytesIO(sources[0]), names[0])  # прогрев кодеков
+        started = time.perf_counter()
+        single = [process_image_file(io.BytesIO(content), name) for content, name in zip(sources, names)]
+        single_elapsed = time.perf_counter() - started
+        single_hashes = [file_hashes(result) for result in single]
+
+    with temporary_storage():
+        bulk = []
+        started = time.perf_counter()
+        for offset in range(0, images, chunk):
+            bulk.extend(process_image_files([
+                (io.BytesIO(content), name, None)
+                for content, name in zip(sources[offset:offset + chunk], names[offset:offset + chunk])
+            ]))
+        bulk_elapsed = time.perf_counter() - started
+        failed = [result for result in bulk if isinstance(result, Exception)]
+        assert not failed, f"bulk rendering failed: {failed[0]!r}"
+        assert [file_hashes(result) for result in bulk] == single_hashes, "bulk output differs from per-image"
+
+    return [
+        throughput_result(f"process_image_file/{size}/throughput", images, single_elapsed),
+        throughput_result(f"process_image_files/{size}/chunk{chunk}/throughput", images, bulk_elapsed)
+    ]
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument("--chunk", type=int, default=16)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    print_results(run(args.images, args.size, args.chunk))
+
+
+if __name__ == "__main__":
+    main()
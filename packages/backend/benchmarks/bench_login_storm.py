@@ -0,0 +1,97 @@
+"""
+Нагрузочный тест: шторм логинов и задержка GET /image/{id} в том же воркере.
+
+Сравнивает хэширование bcrypt прямо в event loop (прежнее поведение) и в
+отдельном пуле потоков. Приложение запускается в процессе через ASGITransport,
+поэтому логины и запросы изображений делят один event loop, как в uvicorn.
+
+Запуск из packages/backend (нужна база с таблицами, например sqlite-файл):
+    DATABASE_URL=sqlite:///bench_login.db python -m benchmarks.bench_login_storm
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+from apps.libs.database.database import Base, SessionLocal, engine
+from apps.libs.database.models import Image, User
+from apps.main_api.auth import hashing
+from apps.main_api.main import app
+
+
+async def run_inline(func, *args):
+    return func(*args)
+
+
+async def prepare(client: httpx.AsyncClient):
+    Base.metadata.create_all(engine)
+    credentials = {"username": f"bench_{uuid.uuid4().hex[:8]}", "password": "benchpassword!"}
+    token = (await client.post("/auth/register", json=credentials)).json()["access_token"]
+
+    with SessionLocal() as db:
+        user = db.query(User).filter_by(username=credentials["username"]).one()
+        image = Image(title="bench.png", file_path="storage/bench.png", resolution="500x500", size=1, user_id=user.id)
+        db.add(image)
+        db.commit()
+        return credentials, token, image.id
+
+
+async def login_storm(client: httpx.AsyncClient, credentials: dict, stop: asyncio.Event, counts: dict):
+    while not stop.is_set():
+        response = await client.post("/auth/login", json=credentials)
+        counts[response.status_code] = counts.get(response.status_code, 0) + 1
+
+
+async def probe(client: httpx.AsyncClient, token: str, image_id: int, duration: float) -> list:
+    headers = {"Authorization": f"Bearer {token}"}
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        response = await client.get(f"/image/{image_id}", headers=headers)
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.text
+        await asyncio.sleep(0.005)
+    return latencies
+
+
+async def run_mode(name: str, logins: int, duration: float):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        credentials, token, image_id = await prepare(client)
+
+        stop = asyncio.Event()
+        counts = {}
+        storm = [asyncio.create_task(login_storm(client, credentials, stop, counts)) for _ in range(logins)]
+        latencies = await probe(client, token, image_id, duration)
+        stop.set()
+        await asyncio.gather(*storm)
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(
+        f"{name:>7}: image p50 {statistics.median(latencies) * 1000:.1f} ms, "
+        f"p99 {p99 * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms; login responses {counts}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=8, help="одновременных клиентов, выполняющих логин")
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    run_hashing = hashing.run_hashing
+    hashing.run_hashing = run_inline
+    asyncio.run(run_mode("inline", args.logins, args.duration))
+
+    hashing.run_hashing = run_hashing
+    asyncio.run(run_mode("pool", args.logins, args.duration))
+    hashing.close_hashing_pool()
+
+
+if __name__ == "__main__":
+    main()
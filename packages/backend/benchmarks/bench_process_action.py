@@ -0,0 +1,109 @@
+"""
+Сквозной тест пропускной способности: загрузки и изменения проходят через
+API в StandInBroker, затем сохраненные сообщения обрабатываются
+process_image_action, как в режиме IMAGE_WORKER_MODE=simple.
+
+Запуск из packages/backend:
+    DATABASE_URL=sqlite:////tmp/bench.db python -m benchmarks.bench_process_action
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+
+from apps.image_service.processor import process_image_action
+from apps.libs.database.database import SessionLocal
+from apps.libs.database.models import Job
+from apps.main_api.main import app
+from benchmarks.bench_save_image import parse_size
+from benchmarks.fixtures import make_image_bytes, prepare_database, stand_in_publisher, temporary_storage
+from benchmarks.results import latency_result, print_results, throughput_result
+from benchmarks.stand_in_broker import StandInBroker
+
+
+async def publish_events(broker: StandInBroker, uploads: int, size: tuple) -> tuple:
+    """
+    Загружает uploads изображений через API и возвращает заголовки авторизации
+    и время, которое заняла публикация.
+    """
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        credentials = {"username": f"bench_e2e_{uuid.uuid4().hex[:8]}", "password": "benchpassword!"}
+        token = (await client.post("/auth/register", json=credentials)).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        sources = [make_image_bytes("JPEG", size, seed) for seed in range(uploads)]
+
+        with stand_in_publisher(broker):
+            started = time.perf_counter()
+            for seed, content in enumerate(sources):
+                files = {"image": (f"e2e_{seed}.jpg", content, "image/jpeg")}
+                response = await client.post("/image/upload_image", headers=headers, files=files)
+                assert response.status_code == 200, response.text
+            elapsed = time.perf_counter() - started
+        return headers, elapsed
+
+
+async def publish_updates(broker: StandInBroker, headers: dict, image_ids: list):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        with stand_in_publisher(broker):
+            for image_id in image_ids:
+                response = await client.put(
+                    f"/image/update/{image_id}", headers=headers, json={"title": f"renamed_{image_id}.jpg"}
+                )
+                assert response.status_code == 200, response.text
+
+
+def drain(broker: StandInBroker) -> tuple:
+    bodies = [body for _, body, _ in broker.messages]
+    broker.messages.clear()
+    durations = []
+    started = time.perf_counter()
+    for body in bodies:
+        message_started = time.perf_counter()
+        process_image_action(body)
+        durations.append(time.perf_counter() - message_started)
+    return bodies, durations, time.perf_counter() - started
+
+
+def run(uploads: int = 30, size: str = "1920x1080") -> list:
+    prepare_database()
+    broker = StandInBroker(keep_messages=True)
+    with temporary_storage():
+        headers, publish_elapsed = asyncio.run(publish_events(broker, uploads, parse_size(size)))
+        bodies, durations, elapsed = drain(broker)
+        with SessionLocal() as db:
+            job_ids = [json.loads(body)["message_id"] for body in bodies]
+            image_ids = [job.image_id for job in db.query(Job).filter(Job.id.in_(job_ids))]
+        assert len(image_ids) == uploads and all(image_ids), "not every upload was processed"
+
+        asyncio.run(publish_updates(broker, headers, image_ids))
+        _, update_durations, update_elapsed = drain(broker)
+
+    return [
+        latency_result(f"process_image_action/UPLOAD/{size}", durations),
+        throughput_result(f"process_image_action/UPLOAD/{size}/throughput", len(durations), elapsed),
+        latency_result("process_image_action/UPDATE", update_durations),
+        throughput_result("process_image_action/UPDATE/throughput", len(update_durations), update_elapsed),
+        # от первого запроса к API до сохранения последнего изображения
+        throughput_result(f"end_to_end/UPLOAD/{size}/throughput", uploads, publish_elapsed + elapsed)
+    ]
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--uploads", type=int, default=30)
+    parser.add_argument("--size", default="1920x1080")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    print_results(run(args.uploads, args.size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Пропускная способность публикации в RabbitMQ: соединение на каждый запрос
+(прежнее поведение send_message) против пула ChannelPool, и задержки
+event loop при блокирующей публикации против публикации через потоки.
+
+Запуск из packages/backend:
+    DATABASE_URL=sqlite:// python -m benchmarks.bench_publisher
+"""
+import argparse
+import asyncio
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from apps.libs.broker import broker as broker_module
+from apps.libs.broker.pool import ChannelPool
+from benchmarks.stand_in_broker import StandInBroker
+
+
+QUEUE = "bench_image_events"
+BODY = b'{"event_type": "UPDATE", "data": {"image_id": 1, "new_data": {}, "user_id": 1}}'
+
+
+def publish_per_request(broker: StandInBroker):
+    connection = broker.connection_factory()
+    channel = connection.channel()
+    channel.queue_declare(queue=QUEUE)
+    channel.basic_publish(exchange='', routing_key=QUEUE, body=BODY)
+
+
+def run(publish, messages: int, concurrency: int) -> float:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda _: publish(), range(messages)))
+    return messages / (time.perf_counter() - started)
+
+
+async def measure_loop_stall(publish_all) -> float:
+    """
+    Публикует сообщения и параллельно измеряет максимальную задержку тика event loop.
+    """
+    max_stall = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal max_stall
+        while not done.is_set():
+            tick = time.perf_counter()
+            await asyncio.sleep(0.001)
+            max_stall = max(max_stall, time.perf_counter() - tick - 0.001)
+
+    ticker_task = asyncio.create_task(ticker())
+    await publish_all()
+    done.set()
+    await ticker_task
+    return max_stall
+
+
+async def run_async(pool: ChannelPool, messages: int):
+    async def blocking_publish_all():
+        for _ in range(messages):
+            pool.publish(QUEUE, BODY)
+            await asyncio.sleep(0)
+
+    async def executor_publish_all():
+        await asyncio.gather(*(broker_module.publish(QUEUE, BODY) for _ in range(messages)))
+
+    blocking_stall = await measure_loop_stall(blocking_publish_all)
+
+    broker_module.publisher_pool = pool
+    broker_module.start_publisher()
+    started = time.perf_counter()
+    executor_stall = await measure_loop_stall(executor_publish_all)
+    elapsed = time.perf_counter() - started
+    broker_module.close_publisher()
+
+    print(f"blocking publish in event loop: max loop stall {blocking_stall * 1000:6.2f} ms")
+    print(f"publisher threads + confirms:   max loop stall {executor_stall * 1000:6.2f} ms, "
+          f"{messages / elapsed:.0f} msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--pool-size", type=int, default=4)
+    args = parser.parse_args()
+
+    broker = StandInBroker()
+    per_request = run(lambda: publish_per_request(broker), args.messages, args.concurrency)
+    print(f"per-request connection: {per_request:10.0f} msg/s, connections opened: {broker.connections}")
+
+    broker = StandInBroker()
+    pool = ChannelPool(QUEUE, size=args.pool_size, connection_factory=broker.connection_factory)
+    pooled = run(lambda: pool.publish(QUEUE, BODY), args.messages, args.concurrency)
+    pool.close()
+    print(f"pooled publisher:       {pooled:10.0f} msg/s, connections opened: {broker.connections}")
+    print(f"speedup: x{pooled / per_request:.1f}")
+
+    broker = StandInBroker(rtt=0.005)
+    pool = ChannelPool(QUEUE, size=args.pool_size, connection_factory=broker.connection_factory)
+    asyncio.run(run_async(pool, min(args.messages, 200)))
+
+
+if __name__ == "__main__":
+    main()
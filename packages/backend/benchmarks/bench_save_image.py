@@ -0,0 +1,75 @@
+"""
+Микробенчмарк save_processed_image: декодирование, рендишены, запись блоба
+и строки Image для разных форматов и размеров исходника. Каждый замер - на
+новом исходнике, поэтому дедупликация блобов не подменяет обработку.
+
+Запуск из packages/backend:
+    DATABASE_URL=sqlite:////tmp/bench.db python -m benchmarks.bench_save_image
+"""
+import argparse
+import io
+import time
+
+from fastapi import UploadFile
+
+from apps.image_service.db import save_processed_image
+from apps.libs.database.database import SessionLocal
+from apps.libs.database.models import User
+from benchmarks.fixtures import FORMAT_EXTENSIONS, create_user, make_image_bytes, prepare_database, temporary_storage
+from benchmarks.results import latency_result, print_results
+
+FORMATS = ("JPEG", "PNG", "WEBP")
+SIZES = ("640x480", "1920x1080", "4000x3000")
+
+
+def parse_size(value: str) -> tuple:
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def bench_case(user_id: int, img_format: str, size: tuple, repeat: int) -> dict:
+    # исходники готовятся заранее: их кодирование не должно попадать в замер
+    sources = [make_image_bytes(img_format, size, seed) for seed in range(repeat + 1)]
+    extension = FORMAT_EXTENSIONS[img_format]
+    durations = []
+    with SessionLocal() as db:
+        user = db.get(User, user_id)
+        for seed, content in enumerate(sources):
+            upload = UploadFile(file=io.BytesIO(content), filename=f"bench_{seed}.{extension}")
+            started = time.perf_counter()
+            save_processed_image(upload, db, user)
+            elapsed = time.perf_counter() - started
+            # первый вызов - прогрев (импорт кодеков, кэши Pillow)
+            if seed:
+                durations.append(elapsed)
+    return latency_result(
+        f"save_processed_image/{img_format}/{size[0]}x{size[1]}", durations, source_bytes=len(sources[-1])
+    )
+
+
+def run(formats=FORMATS, sizes=SIZES, repeat: int = 5) -> list:
+    prepare_database()
+    user_id = create_user("bench_save")
+    with temporary_storage():
+        return [
+            bench_case(user_id, img_format, parse_size(size), repeat)
+            for size in sizes
+            for img_format in formats
+        ]
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--formats", nargs="+", default=list(FORMATS), choices=FORMATS)
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES), help="например 1920x1080")
+    parser.add_argument("--repeat", type=int, default=5)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    print_results(run(args.formats, args.sizes, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Масштабирование обработки UPLOAD-сообщений по числу процессов пула
+(render_in_worker в ProcessPoolExecutor, как в режиме IMAGE_WORKER_MODE=pool).
+
+Запуск из packages/backend:
+    DATABASE_URL=sqlite:// python -m benchmarks.bench_worker_pool
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image as PILImage
+
+from apps.image_service.worker_pool import render_in_worker
+
+
+def make_sources(directory: str, count: int, size: tuple) -> list:
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"source_{i}.jpg")
+        PILImage.new("RGB", size, color=(i % 255, 120, 200)).save(path, format="JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+
+def run(sources: list, processes: int) -> float:
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # прогрев: запуск процессов не должен попадать в замер
+        list(executor.map(render_in_worker, sources[:processes], ["warmup.jpg"] * processes))
+        started = time.perf_counter()
+        futures = [executor.submit(render_in_worker, path, f"bench_{i}.jpg") for i, path in enumerate(sources)]
+        for future in futures:
+            future.result()
+    return len(sources) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=64)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    args = parser.parse_args()
+
+    cpu_count = os.cpu_count() or 1
+    process_counts = sorted({1, 2, 4, 8, cpu_count} & set(range(1, cpu_count + 1)))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        sources = make_sources(workdir, args.messages, (args.width, args.height))
+        os.chdir(workdir)
+
+        baseline = None
+        for processes in process_counts:
+            rate = run(sources, processes)
+            baseline = baseline or rate
+            print(f"{processes:3d} processes: {rate:8.1f} msg/s (x{rate / baseline:.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Подготовка окружения для бенчмарков: таблицы, пользователь, временное
+хранилище файлов, исходные изображения и публикатор на StandInBroker.
+"""
+import io
+import os
+import tempfile
+import uuid
+
+from contextlib import contextmanager
+
+from PIL import Image as PILImage
+
+from apps.libs.broker import broker as broker_module
+from apps.libs.broker.pool import ChannelPool
+from apps.libs.broker.topology import declare_topology
+from apps.libs.config.core_config import core_config
+from apps.libs.database.database import Base, SessionLocal, engine
+from apps.libs.database.models import User
+from benchmarks.stand_in_broker import StandInBroker
+
+FORMAT_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+
+def prepare_database():
+    Base.metadata.create_all(engine)
+
+
+def create_user(prefix: str = "bench") -> int:
+    with SessionLocal() as db:
+        user = User(username=f"{prefix}_{uuid.uuid4().hex[:8]}", hashed_password="-")
+        db.add(user)
+        db.commit()
+        return user.id
+
+
+@contextmanager
+def temporary_storage():
+    """
+    Блобы и staged-загрузки пишутся во временный каталог и удаляются после замера.
+    """
+    saved = core_config.blob_dir, core_config.staging_dir
+    with tempfile.TemporaryDirectory(prefix="bench_storage_") as directory:
+        core_config.blob_dir = os.path.join(directory, "blobs")
+        core_config.staging_dir = os.path.join(directory, "staging")
+        try:
+            yield directory
+        finally:
+            core_config.blob_dir, core_config.staging_dir = saved
+
+
+def make_image_bytes(img_format: str, size: tuple, seed: int = 0) -> bytes:
+    """
+    Шум поверх градиента: однотонная картинка сжимается почти в ноль и не
+    похожа на фотографию. seed меняет содержимое, чтобы у каждого исходника
+    был свой sha256 и дедупликация блобов не подменяла обработку.
+    """
+    noise = PILImage.effect_noise(size, 48)
+    gradient = PILImage.linear_gradient("L").resize(size)
+    img = PILImage.merge("RGB", (noise, gradient, PILImage.blend(noise, gradient, 0.5)))
+    img.putpixel((seed % size[0], (seed // size[0]) % size[1]), (seed % 256, 0, 255))
+    buffer = io.BytesIO()
+    img.save(buffer, format=img_format)
+    return buffer.getvalue()
+
+
+@contextmanager
+def stand_in_publisher(broker: StandInBroker):
+    """
+    send_message публикует в StandInBroker через обычный ChannelPool с
+    подтверждениями и объявлением топологии, как в работе с RabbitMQ.
+    """
+    saved = broker_module.publisher_pool
+    broker_module.publisher_pool = ChannelPool(
+        queue_name=core_config.rabbitmq_queue,
+        connection_factory=broker.connection_factory,
+        declare=declare_topology
+    )
+    broker_module.start_publisher()
+    try:
+        yield broker
+    finally:
+        broker_module.close_publisher()
+        broker_module.publisher_pool = saved
@@ -0,0 +1,103 @@
+"""
+Общий формат результатов бенчмарков: JSON со списком замеров и сравнение
+с сохраненным baseline, чтобы регрессии были видны в ревью.
+
+Замер - словарь {"name", "value", "unit", "better", ...}, где better - "lower"
+(задержки) или "higher" (пропускная способность). Остальные поля (p95,
+число замеров) выводятся как есть и в сравнении не участвуют.
+"""
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def latency_result(name: str, seconds: list, **extra) -> dict:
+    """
+    Медиана задержки в миллисекундах: устойчивее среднего к единичным выбросам (GC, диск).
+    """
+    return {
+        "name": name,
+        "value": round(statistics.median(seconds) * 1000, 3),
+        "unit": "ms",
+        "better": "lower",
+        "p95": round(percentile(seconds, 0.95) * 1000, 3),
+        "samples": len(seconds),
+        **extra
+    }
+
+
+def throughput_result(name: str, count: int, elapsed: float, **extra) -> dict:
+    return {
+        "name": name,
+        "value": round(count / elapsed, 2),
+        "unit": "ops/s",
+        "better": "higher",
+        "samples": count,
+        **extra
+    }
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """
+    Дописывает в замеры значение baseline и изменение в долях, возвращает
+    имена замеров, которые ухудшились больше чем на tolerance.
+    """
+    previous = {result["name"]: result for result in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        base = previous.get(result["name"])
+        if base is None or not base["value"]:
+            continue
+        change = (result["value"] - base["value"]) / base["value"]
+        result["baseline"] = base["value"]
+        result["change"] = round(change, 4)
+        worse = change if result["better"] == "lower" else -change
+        if worse > tolerance:
+            regressions.append(result["name"])
+    return regressions
+
+
+def environment() -> dict:
+    # результаты сравнимы только на той же машине и с той же базой
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "database": (os.getenv("DATABASE_URL") or "").split(":", 1)[0]
+    }
+
+
+def load_baseline(path: str) -> dict:
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def write_report(path: str, results: list, regressions: list, tolerance: float):
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment(),
+        "tolerance": tolerance,
+        "regressions": regressions,
+        "results": results
+    }
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+        file.write("\n")
+
+
+def print_results(results: list):
+    for result in results:
+        line = f"{result['name']:<48} {result['value']:>12.2f} {result['unit']:<6}"
+        if "change" in result:
+            line += f" baseline {result['baseline']:>10.2f} ({result['change'] * 100:+.1f}%)"
+        print(line)
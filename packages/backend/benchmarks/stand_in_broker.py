@@ -0,0 +1,86 @@
+import collections
+import threading
+import time
+
+
+class StandInChannel:
+    """
+    Канал-заглушка, имитирующий задержки RabbitMQ без сети.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+        self.confirms = False
+
+    def confirm_delivery(self):
+        self.confirms = True
+
+    def queue_declare(self, queue, **kwargs):
+        time.sleep(self.connection.broker.rtt)
+        self.connection.broker.declares += 1
+
+    def exchange_declare(self, exchange, **kwargs):
+        time.sleep(self.connection.broker.rtt)
+
+    def queue_bind(self, queue, exchange, **kwargs):
+        time.sleep(self.connection.broker.rtt)
+
+    def basic_qos(self, **kwargs):
+        time.sleep(self.connection.broker.rtt)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        time.sleep(self.connection.broker.publish_latency)
+        if self.confirms:
+            # ожидание Basic.Ack от брокера
+            time.sleep(self.connection.broker.rtt)
+        with self.connection.broker.lock:
+            self.connection.broker.published += 1
+            if self.connection.broker.keep_messages:
+                self.connection.broker.messages.append((routing_key, body, properties))
+
+    def close(self):
+        self.is_open = False
+
+
+class StandInConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        # TCP + AMQP handshake: несколько round trip'ов
+        time.sleep(broker.rtt * broker.handshake_round_trips)
+        with broker.lock:
+            broker.connections += 1
+
+    def channel(self):
+        time.sleep(self.broker.rtt)
+        return StandInChannel(self)
+
+    def close(self):
+        self.is_open = False
+
+
+class StandInBroker:
+    """
+    keep_messages - сохранять опубликованные сообщения, чтобы потом отдать их воркеру.
+    """
+
+    def __init__(
+            self,
+            rtt: float = 0.0005,
+            publish_latency: float = 0.00005,
+            handshake_round_trips: int = 6,
+            keep_messages: bool = False
+    ):
+        self.rtt = rtt
+        self.publish_latency = publish_latency
+        self.handshake_round_trips = handshake_round_trips
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.declares = 0
+        self.published = 0
+        self.keep_messages = keep_messages
+        self.messages = collections.deque()
+
+    def connection_factory(self):
+        return StandInConnection(self)
@@ -0,0 +1,66 @@
+"""
+Набор бенчмарков API, брокера и воркера с отчетом в JSON и сравнением с
+baseline. Код возврата 1, если какой-то замер ухудшился больше чем на
+--tolerance: так регрессия видна в ревью и в CI.
+
+Запуск из packages/backend (база с таблицами создается сама):
+    DATABASE_URL=sqlite:////tmp/bench.db python -m benchmarks.suite \\
+        --output bench.json --baseline benchmarks/baseline.json
+
+Новый baseline - это просто отчет прошлого запуска на той же машине:
+    python -m benchmarks.suite --output benchmarks/baseline.json
+"""
+import argparse
+import sys
+
+from benchmarks import bench_api_load, bench_bulk_ingest, bench_process_action, bench_save_image
+from benchmarks.results import compare, load_baseline, print_results, write_report
+
+# quick - для проверки перед ревью за минуту-две, full - для сравнения перед релизом
+PROFILES = {
+    "quick": {
+        "save_image": {"sizes": ["640x480", "1920x1080"], "repeat": 3},
+        "api_load": {"requests": 50, "concurrency": 4, "seed": 200},
+        "process_action": {"uploads": 10, "size": "1280x720"},
+        "bulk_ingest": {"images": 32, "size": "1280x720"}
+    },
+    "full": {
+        "save_image": {},
+        "api_load": {},
+        "process_action": {},
+        "bulk_ingest": {}
+    }
+}
+
+BENCHMARKS = {
+    "save_image": bench_save_image.run,
+    "api_load": bench_api_load.run,
+    "process_action": bench_process_action.run,
+    "bulk_ingest": bench_bulk_ingest.run
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", choices=PROFILES, default="quick")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--baseline", help="отчет предыдущего запуска для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="допустимое ухудшение, доля")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.only:
+        print(f"running {name}...", flush=True)
+        results.extend(BENCHMARKS[name](**PROFILES[args.profile][name]))
+
+    regressions = compare(results, load_baseline(args.baseline), args.tolerance)
+    write_report(args.output, results, regressions, args.tolerance)
+    print_results(results)
+    if regressions:
+        print(f"regressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
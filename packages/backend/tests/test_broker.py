@@ -0,0 +1,258 @@
+import asyncio
+import time
+
+import pika
+import pytest
+
+from fastapi import HTTPException
+
+from apps.libs.broker import broker as broker_module
+from apps.libs.broker.broker import PublishPendingError
+from apps.libs.broker.memory import MemoryBroker
+from apps.libs.broker.pool import ChannelPool, PoolClosedError
+from apps.libs.broker.topology import consumer_channels, declare_topology, queue_arguments, retry_queue
+from apps.libs.broker.upgrade import upgrade_topology
+from apps.libs.config.core_config import core_config
+
+
+class FakeChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+
+    def queue_declare(self, queue, **kwargs):
+        self.connection.broker.declares += 1
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        if self.connection.broker.fail_next_publish:
+            self.connection.broker.fail_next_publish = False
+            self.is_open = False
+            raise pika.exceptions.StreamLostError("connection reset")
+        broker = self.connection.broker
+        time.sleep(broker.publish_delay)
+        if broker.nack_publishes:
+            raise pika.exceptions.NackError([body])
+        broker.published.append(body)
+
+
+class FakeConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+
+    def channel(self):
+        return FakeChannel(self)
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeBroker:
+    def __init__(self):
+        self.connections = 0
+        self.declares = 0
+        self.published = []
+        self.fail_next_publish = False
+        self.nack_publishes = False
+        self.publish_delay = 0
+        self.refuse_connections = False
+
+    def connect(self):
+        if self.refuse_connections:
+            raise pika.exceptions.AMQPConnectionError("connection refused")
+        self.connections += 1
+        return FakeConnection(self)
+
+
+class FakeRabbitChannel:
+    """
+    Канал с проверкой аргументов очередей, как в RabbitMQ: повторное
+    объявление с другими аргументами закрывает канал с кодом 406.
+    """
+
+    def __init__(self, rabbit):
+        self.rabbit = rabbit
+        self.delivery_tag = 0
+        self.unacked = {}
+
+    def confirm_delivery(self):
+        pass
+
+    def exchange_declare(self, exchange, exchange_type):
+        pass
+
+    def queue_bind(self, queue, exchange):
+        pass
+
+    def queue_declare(self, queue, passive=False, arguments=None):
+        queues = self.rabbit.queues
+        if queue not in queues:
+            if passive:
+                raise pika.exceptions.ChannelClosedByBroker(404, "NOT_FOUND")
+            queues[queue] = (arguments or {}, [])
+        elif not passive and queues[queue][0] != (arguments or {}):
+            raise pika.exceptions.ChannelClosedByBroker(406, "PRECONDITION_FAILED")
+
+    def queue_delete(self, queue):
+        del self.rabbit.queues[queue]
+
+    def basic_get(self, queue):
+        messages = self.rabbit.queues[queue][1]
+        if not messages:
+            return None, None, None
+        self.delivery_tag += 1
+        body = self.unacked[self.delivery_tag] = messages.pop(0)
+        return pika.spec.Basic.GetOk(delivery_tag=self.delivery_tag), pika.BasicProperties(), body
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.rabbit.queues[routing_key][1].append(body)
+
+    def basic_ack(self, delivery_tag):
+        del self.unacked[delivery_tag]
+
+    def close(self):
+        pass
+
+
+class FakeRabbit:
+    def __init__(self):
+        self.queues = {}
+
+    def channel(self):
+        return FakeRabbitChannel(self)
+
+
+@pytest.fixture
+def broker():
+    return FakeBroker()
+
+
+@pytest.fixture
+def publisher(broker, monkeypatch):
+    """
+    send_message публикует в FakeBroker; исполнитель и семафор создаются
+    заново при первой публикации теста и закрываются после него.
+    """
+    monkeypatch.setattr(broker_module, "publisher_pool", ChannelPool(
+        core_config.rabbitmq_queue, size=1, connection_factory=broker.connect, reconnect_attempts=1
+    ))
+    yield broker
+    broker_module.close_publisher()
+
+
+def send_update():
+    return broker_module.send_message("UPDATE", {"image_id": 1, "user_id": 1})
+
+
+def test_pool_reuses_connection_and_declares_queue_once(broker):
+    pool = ChannelPool("image_events", size=2, connection_factory=broker.connect)
+
+    for i in range(10):
+        pool.publish("image_events", f"message {i}")
+
+    assert len(broker.published) == 10
+    assert broker.connections == 1
+    assert broker.declares == 1
+
+
+def test_pool_reconnects_after_stale_channel(broker):
+    pool = ChannelPool("image_events", size=2, connection_factory=broker.connect)
+    pool.publish("image_events", "first")
+
+    broker.fail_next_publish = True
+    pool.publish("image_events", "second")
+
+    assert broker.published == ["first", "second"]
+    assert broker.connections == 2
+    assert broker.declares == 2
+
+
+def test_pool_rejects_publish_after_close(broker):
+    pool = ChannelPool("image_events", size=2, connection_factory=broker.connect)
+    pool.publish("image_events", "first")
+    pool.close()
+
+    with pytest.raises(PoolClosedError):
+        pool.publish("image_events", "second")
+
+
+def test_memory_broker_delays_retries_and_dead_letters_rejected_messages(monkeypatch):
+    monkeypatch.setattr(core_config, "rabbitmq_retry_delay", 0.05)
+    memory = MemoryBroker()
+    pool = ChannelPool(core_config.rabbitmq_queue, size=1, connection_factory=memory.connect, declare=declare_topology)
+    pool.publish(core_config.rabbitmq_queue, "upload", pika.BasicProperties(message_id="m1"))
+
+    connection = memory.connect()
+    deliveries = []
+
+    def on_message(ch, method, properties, body):
+        deliveries.append((method.routing_key, body))
+        if len(deliveries) == 1:
+            # копия уходит в очередь задержки и по TTL возвращается в рабочую очередь
+            ch.basic_publish('', retry_queue(method.routing_key, 1), body, properties)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+        else:
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            ch.stop_consuming()
+
+    channels = consumer_channels(connection, prefetch_count=1)
+    for queue, channel in channels:
+        channel.basic_consume(queue=queue, on_message_callback=on_message)
+    channels[0][1].start_consuming()
+
+    assert deliveries == [(core_config.rabbitmq_queue, "upload")] * 2
+    dead = memory.queues[core_config.rabbitmq_dead_letter_queue].messages
+    assert [message[3] for message in dead] == ["upload"]
+
+
+@pytest.mark.parametrize("failure", ["nack", "connection", "timeout"])
+def test_send_message_reports_unpublished_message_as_busy(publisher, monkeypatch, failure):
+    if failure == "nack":
+        publisher.nack_publishes = True
+    elif failure == "connection":
+        publisher.refuse_connections = True
+    else:
+        monkeypatch.setattr(core_config, "rabbitmq_publish_timeout", 0.05)
+        publisher.publish_delay = 0.3
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(send_update())
+    assert error.value.status_code == 503
+    # по таймауту итог неизвестен: публикация продолжается, и сообщение еще может дойти
+    assert isinstance(error.value, PublishPendingError) == (failure == "timeout")
+    if failure != "timeout":
+        assert publisher.published == []
+
+
+def test_send_message_rejects_publish_over_in_flight_limit(publisher, monkeypatch):
+    monkeypatch.setattr(core_config, "rabbitmq_max_in_flight", 1)
+    monkeypatch.setattr(core_config, "rabbitmq_backpressure_timeout", 0.05)
+    publisher.publish_delay = 0.3
+
+    async def send_two():
+        return await asyncio.gather(send_update(), send_update(), return_exceptions=True)
+
+    first, second = asyncio.run(send_two())
+    assert isinstance(first, str)
+    assert isinstance(second, HTTPException) and second.status_code == 503
+    assert len(publisher.published) == 1
+
+
+def test_upgrade_redeclares_legacy_queue_and_keeps_messages():
+    rabbit = FakeRabbit()
+    # очередь версии без dead-letter очереди: объявлена без аргументов
+    rabbit.queues[core_config.rabbitmq_queue] = ({}, ["first", "second"])
+    with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+        declare_topology(rabbit.channel())
+
+    upgrade_topology(rabbit)
+    upgrade_topology(rabbit)
+
+    declare_topology(rabbit.channel())
+    assert rabbit.queues[core_config.rabbitmq_queue][1] == ["first", "second"]
+    for queue, arguments in queue_arguments():
+        assert rabbit.queues[queue][0] == arguments
+    assert not [queue for queue in rabbit.queues if queue.endswith(".upgrade")]
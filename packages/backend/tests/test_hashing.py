@@ -0,0 +1,50 @@
+import asyncio
+import threading
+
+import pytest
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from apps.libs.config.core_config import core_config
+from apps.libs.database.database import SessionLocal
+from apps.libs.database.models import User
+from apps.main_api.auth import hashing
+from apps.main_api.main import app
+
+
+def test_saturated_hashing_pool_rejects_with_503(monkeypatch):
+    monkeypatch.setattr(core_config, "password_hash_workers", 1)
+    monkeypatch.setattr(core_config, "password_hash_max_queue", 1)
+    hashing.start_hashing_pool()
+    release = threading.Event()
+
+    async def storm():
+        busy = [asyncio.ensure_future(hashing.run_hashing(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        with pytest.raises(HTTPException) as rejected:
+            await hashing.run_hashing(release.wait)
+        release.set()
+        await asyncio.gather(*busy)
+        return rejected.value.status_code
+
+    try:
+        assert asyncio.run(storm()) == 503
+        assert hashing.pending == 0
+    finally:
+        hashing.close_hashing_pool()
+
+
+def test_login_rehashes_password_with_outdated_cost():
+    with TestClient(app) as client:
+        with SessionLocal() as db:
+            db.add(User(username="oldcost", hashed_password=hashing.pwd_context.hash("testpassword!", rounds=4)))
+            db.commit()
+
+        response = client.post("/auth/login", json={"username": "oldcost", "password": "testpassword!"})
+        assert response.status_code == 200
+
+        with SessionLocal() as db:
+            hashed_password = db.query(User).filter_by(username="oldcost").one().hashed_password
+        assert f"${core_config.bcrypt_rounds:02d}$" in hashed_password
+        assert hashing.verify_password("testpassword!", hashed_password)
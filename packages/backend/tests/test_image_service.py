@@ -0,0 +1,336 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import queue
+import threading
+import uuid
+import pika
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from PIL import Image as PILImage
+from sqlalchemy.exc import OperationalError
+
+from apps.image_service.batch_consumer import BatchImageConsumer
+from apps.image_service.db import process_image_file
+from apps.image_service.ledger import EventLedger
+from apps.image_service.processor import callback
+from apps.image_service.renditions import PRIMARY_PRESET, RenditionPreset, render_renditions, render_to_bytes
+from apps.libs.config.core_config import core_config
+from apps.libs.database.database import SessionLocal
+from apps.libs.database.models import Blob, Image, User
+
+
+class FakeChannel:
+    def __init__(self):
+        self.acked = []
+        self.nacked = []
+        self.published = []
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((routing_key, body, properties))
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked.append((delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.nacked.append(delivery_tag)
+
+
+class FakeConnection:
+    def call_later(self, delay, callback):
+        return object()
+
+    def remove_timeout(self, timer):
+        pass
+
+
+class ThreadsafeConnection(FakeConnection):
+    def __init__(self):
+        self.callbacks = queue.Queue()
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.put(callback)
+
+
+@pytest.fixture
+def db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def user_with_images(db):
+    user = User(username=f"batch_{uuid.uuid4().hex}", hashed_password="hash")
+    db.add(user)
+    db.commit()
+    images = [
+        Image(title=f"image_{i}.png", file_path="storage/image.png", resolution="500x500", size=100, user_id=user.id)
+        for i in range(3)
+    ]
+    db.add_all(images)
+    db.commit()
+    return user, images
+
+
+def test_batch_consumer_isolates_poison_messages(db, user_with_images):
+    user, images = user_with_images
+    image_ids = [image.id for image in images]
+    channel = FakeChannel()
+    consumer = BatchImageConsumer(FakeConnection(), channel, batch_size=4)
+
+    bodies = [
+        json.dumps({'event_type': 'UPDATE', 'data': {
+            'image_id': image_ids[0], 'new_data': {'title': 'renamed.png'}, 'user_id': user.id
+        }}),
+        b"not json",
+        json.dumps({'event_type': 'DELETE', 'data': {'image_id': image_ids[1], 'user_id': user.id}}),
+        json.dumps({'event_type': 'UPDATE', 'data': {
+            'image_id': image_ids[2], 'new_data': {'size': 'not a number'}, 'user_id': user.id
+        }}),
+    ]
+    for tag, body in enumerate(bodies, start=1):
+        consumer.on_message(channel, SimpleNamespace(delivery_tag=tag), None, body)
+
+    assert channel.nacked == [2, 4]
+    assert channel.acked == [(3, True)]
+
+    db.expunge_all()
+    assert db.get(Image, image_ids[0]).title == "renamed.png"
+    assert db.get(Image, image_ids[1]) is None
+    assert db.get(Image, image_ids[2]).size == 100
+
+
+def test_identical_uploads_share_one_blob(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(core_config, "blob_dir", str(tmp_path))
+    user = User(username=f"blob_{uuid.uuid4().hex}", hashed_password="hash")
+    db.add(user)
+    db.commit()
+
+    source = io.BytesIO()
+    PILImage.new("RGB", (64, 48), color="blue").save(source, format="PNG")
+    file_data = base64.b64encode(source.getvalue()).decode()
+
+    def upload(title):
+        return json.dumps({'event_type': 'UPLOAD', 'data': {'title': title, 'user_id': user.id, 'file_data': file_data}})
+
+    channel = FakeChannel()
+    consumer = BatchImageConsumer(FakeConnection(), channel, batch_size=2)
+    consumer.on_message(channel, SimpleNamespace(delivery_tag=1), None, upload("first.png"))
+    consumer.on_message(channel, SimpleNamespace(delivery_tag=2), None, upload("second.png"))
+
+    # повторная загрузка известных байтов не декодируется
+    with patch("apps.image_service.batch_consumer.render_in_worker") as render:
+        consumer.on_message(channel, SimpleNamespace(delivery_tag=3), None, upload("third.png"))
+        consumer.flush()
+    render.assert_not_called()
+
+    db.expire_all()
+    images = db.query(Image).filter_by(user_id=user.id).order_by(Image.id).all()
+    assert [image.title for image in images] == ["first.png", "second.png", "third.png"]
+    assert len({image.file_path for image in images}) == 1
+    blob_hash = images[0].blob_hash
+    assert db.get(Blob, blob_hash).refcount == 3
+    files = [images[0].file_path, *(rendition.file_path for rendition in images[0].renditions)]
+    assert all(os.path.exists(path) for path in files)
+
+    image_ids = [image.id for image in images]
+    for tag, image_id in enumerate(image_ids, start=4):
+        consumer.on_message(channel, SimpleNamespace(delivery_tag=tag), None, json.dumps(
+            {'event_type': 'DELETE', 'data': {'image_id': image_id, 'user_id': user.id}}
+        ))
+        consumer.flush()
+        db.expire_all()
+        if image_id != image_ids[-1]:
+            assert all(os.path.exists(path) for path in files)
+
+    assert db.get(Blob, blob_hash) is None
+    assert not any(os.path.exists(path) for path in files)
+
+
+def test_redelivered_upload_is_applied_once(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(core_config, "blob_dir", str(tmp_path))
+    user = User(username=f"ledger_{uuid.uuid4().hex}", hashed_password="hash")
+    db.add(user)
+    db.commit()
+
+    source = io.BytesIO()
+    PILImage.new("RGB", (32, 32), color="green").save(source, format="PNG")
+    body = json.dumps({'message_id': uuid.uuid4().hex, 'event_type': 'UPLOAD', 'data': {
+        'title': 'once.png', 'user_id': user.id, 'file_data': base64.b64encode(source.getvalue()).decode()
+    }})
+
+    channel = FakeChannel()
+    consumer = BatchImageConsumer(FakeConnection(), channel, batch_size=2)
+    # повтор внутри одной пачки и повторная доставка после commit
+    consumer.on_message(channel, SimpleNamespace(delivery_tag=1), None, body)
+    consumer.on_message(channel, SimpleNamespace(delivery_tag=2), None, body)
+    consumer.on_message(channel, SimpleNamespace(delivery_tag=3), None, body)
+    consumer.flush()
+
+    assert channel.nacked == []
+    assert channel.acked == [(2, True), (3, True)]
+    assert db.query(Image).filter_by(user_id=user.id).count() == 1
+
+
+def test_transient_failure_is_retried_then_dead_lettered(user_with_images, monkeypatch):
+    monkeypatch.setattr(core_config, "rabbitmq_retry_max_attempts", 2)
+    user, images = user_with_images
+    queue = core_config.rabbitmq_priority_queue
+    body = json.dumps({'message_id': uuid.uuid4().hex, 'event_type': 'UPDATE', 'data': {
+        'image_id': images[0].id, 'new_data': {'title': 'retried.png'}, 'user_id': user.id
+    }})
+
+    channel = FakeChannel()
+    consumer = BatchImageConsumer(FakeConnection(), channel, batch_size=1)
+    locked = OperationalError("UPDATE image", {}, Exception("database is locked"))
+    with patch.object(BatchImageConsumer, "apply", side_effect=locked):
+        consumer.on_message(channel, SimpleNamespace(delivery_tag=1, routing_key=queue), None, body)
+
+        # копия ушла в очередь задержки первого повтора, оригинал подтвержден
+        assert channel.acked == [(1, True)]
+        routing_key, retried_body, properties = channel.published[0]
+        assert routing_key == f"{queue}.retry.1"
+        assert retried_body == body
+        assert properties.headers["x-retry-attempt"] == 1
+
+        # последняя попытка тоже упала: сообщение отклоняется в dead-letter очередь
+        consumer.on_message(channel, SimpleNamespace(delivery_tag=2, routing_key=queue), properties, body)
+    assert channel.nacked == [2]
+    assert len(channel.published) == 1
+
+
+def test_batch_is_processed_off_the_connection_thread(user_with_images):
+    user, images = user_with_images
+
+    def update(image):
+        return json.dumps({'event_type': 'UPDATE', 'data': {
+            'image_id': image.id, 'new_data': {'title': 'threaded.png'}, 'user_id': user.id
+        }})
+
+    started, release = threading.Event(), threading.Event()
+    process_batch = BatchImageConsumer.process_batch
+
+    def slow_process_batch(self, items, resources):
+        started.set()
+        release.wait(5)
+        process_batch(self, items, resources)
+
+    channel = FakeChannel()
+    connection = ThreadsafeConnection()
+    with ThreadPoolExecutor(max_workers=1) as batch_thread, \
+            patch.object(BatchImageConsumer, "process_batch", slow_process_batch):
+        consumer = BatchImageConsumer(connection, channel, batch_size=1, batch_thread=batch_thread)
+        consumer.on_message(channel, SimpleNamespace(delivery_tag=1), None, update(images[0]))
+        # поток соединения свободен, пока пачка в работе: следующее сообщение только копится
+        assert started.wait(5)
+        consumer.on_message(channel, SimpleNamespace(delivery_tag=2), None, update(images[1]))
+        assert channel.acked == [] and len(consumer.items) == 1
+
+        release.set()
+        connection.callbacks.get(timeout=5)()
+        assert channel.acked == [(1, True)]
+        # подтверждение первой пачки отправило в работу накопленную вторую
+        connection.callbacks.get(timeout=5)()
+    assert channel.acked == [(1, True), (2, True)]
+
+
+def test_dead_lettered_upload_releases_staged_source(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(core_config, "rabbitmq_retry_max_attempts", 1)
+    monkeypatch.setattr(core_config, "staging_dir", str(tmp_path))
+    user = User(username=f"dead_{uuid.uuid4().hex}", hashed_password="hash")
+    db.add(user)
+    db.commit()
+    staged_ref = uuid.uuid4().hex
+    (tmp_path / staged_ref).write_bytes(b"staged upload")
+    message_id = uuid.uuid4().hex
+    body = json.dumps({'message_id': message_id, 'event_type': 'UPLOAD', 'data': {
+        'title': 'dead.png', 'user_id': user.id, 'staged_ref': staged_ref
+    }})
+
+    channel = FakeChannel()
+    locked = OperationalError("INSERT INTO image", {}, Exception("database is locked"))
+    with patch("apps.image_service.processor.save_processed_image", side_effect=locked):
+        callback(
+            channel, SimpleNamespace(delivery_tag=1, routing_key=core_config.rabbitmq_queue),
+            pika.BasicProperties(message_id=message_id), body
+        )
+
+    # повторов не осталось: сообщение в dead-letter очереди, исходник больше никто не прочитает
+    assert channel.nacked == [1]
+    assert not (tmp_path / staged_ref).exists()
+
+
+def test_ledger_skips_database_for_unseen_ids():
+    ledger = EventLedger(recent_size=2, bloom_capacity=100, bloom_error_rate=0.01)
+    ledger.remember(["a", "b", "c"])
+
+    # db=None: отрицательный ответ фильтра не должен приводить к запросу в БД
+    assert not ledger.seen("unknown", None)
+    assert ledger.seen("c", None)
+    assert "a" not in ledger.recent and "a" in ledger.bloom
+
+
+def test_bulk_ingest_renders_like_per_image_path(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(core_config, "blob_dir", str(tmp_path))
+    monkeypatch.setattr(core_config, "image_bulk_ingest", True)
+    monkeypatch.setattr(core_config, "image_bulk_chunk_size", 2)
+    user = User(username=f"bulk_{uuid.uuid4().hex}", hashed_password="hash")
+    db.add(user)
+    db.commit()
+
+    noise = PILImage.effect_noise((640, 480), 64)
+    sources = {
+        "rgb.jpg": (PILImage.merge("RGB", (noise, noise.rotate(90), noise.transpose(0))), "JPEG"),
+        "rgba.png": (PILImage.merge("RGBA", (noise, noise, noise.rotate(45), noise)).resize((300, 200)), "PNG"),
+        "gray.png": (noise.resize((120, 90)), "PNG"),
+    }
+    contents = {}
+    for title, (img, img_format) in sources.items():
+        buffer = io.BytesIO()
+        img.save(buffer, format=img_format)
+        contents[title] = buffer.getvalue()
+    contents["broken.png"] = b"not an image"
+
+    channel = FakeChannel()
+    consumer = BatchImageConsumer(FakeConnection(), channel, batch_size=len(contents))
+    for tag, (title, content) in enumerate(contents.items(), start=1):
+        data = {'title': title, 'user_id': user.id, 'file_data': base64.b64encode(content).decode()}
+        consumer.on_message(
+            channel, SimpleNamespace(delivery_tag=tag), None, json.dumps({'event_type': 'UPLOAD', 'data': data})
+        )
+
+    assert channel.nacked == [4]
+    images = db.query(Image).filter_by(user_id=user.id).order_by(Image.id).all()
+    assert [image.title for image in images] == list(sources)
+    # векторный перевод в оттенки серого дает те же байты, что convert("L")
+    for image in images:
+        expected = process_image_file(io.BytesIO(contents[image.title]), image.title)
+        assert image.content_hash == expected["content_hash"]
+        assert sorted(rendition.content_hash for rendition in image.renditions) == sorted(
+            rendition["content_hash"] for rendition in expected["renditions"]
+        )
+
+
+def test_thumbnail_is_not_resized_from_stretched_primary(tmp_path):
+    noise = PILImage.effect_noise((900, 600), 64)
+    buffer = io.BytesIO()
+    PILImage.merge("RGB", (noise, noise.rotate(90), noise.transpose(0))).save(buffer, format="PNG")
+    thumbnail = RenditionPreset(name="thumbnail", width=256, height=256, fit="cover", format="PNG")
+
+    # основной кадр 500x500 крупнее миниатюры и строится раньше нее
+    buffer.seek(0)
+    primary, rendered = render_renditions(buffer, [PRIMARY_PRESET, thumbnail], str(tmp_path), "source.png")
+
+    assert (primary["width"], primary["height"]) == (500, 500)
+    buffer.seek(0)
+    expected = render_to_bytes(buffer, thumbnail)
+    assert rendered["content_hash"] == hashlib.sha256(expected).hexdigest()
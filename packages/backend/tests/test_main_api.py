@@ -1,13 +1,33 @@
+import asyncio
 import json
+import os
+import random
+import threading
+import pika
 import pytest
 
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
 from io import BytesIO
 from PIL import Image
 
-from apps.libs.database.database import SessionLocal
+from apps.libs.broker.broker import PublishPendingError
+from apps.libs.config.core_config import core_config
+from apps.libs.database.database import AsyncSessionLocal, SessionLocal
+from apps.libs.database.models import Image as ImageRecord, User
 from apps.main_api.main import app
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
+
+from apps.image_service.processor import callback, process_image_action
+from apps.libs.tracing import tracing
+from apps.image_service.phash import hamming_distance, to_signed
+from apps.main_api.image.similarity import BKTree, SimilarityIndex
+from apps.libs.storage.image_guard import UploadGuard
+from apps.main_api.image.file_delivery import ImageFileResponse
+from apps.main_api.middleware import SelectiveGZipMiddleware
 
 
 @pytest.fixture
@@ -48,14 +68,56 @@ def test_upload_image(client, db, create_test_image):
     response = client.post("/auth/login", json=login_data)
     token = response.json().get("access_token")
 
-    response = client.post(
-        "/image/upload_image",
-        headers={"Authorization": f"Bearer {token}"},
-        files={"image": ("test_image.png", create_test_image, "image/png")}
-    )
+    # без RabbitMQ публикация отвечает 503, поэтому подменяется только отправка в канал
+    with patch("apps.libs.broker.broker.publish", new_callable=AsyncMock) as publish:
+        response = client.post(
+            "/image/upload_image",
+            headers={"Authorization": f"Bearer {token}"},
+            files={"image": ("test_image.png", create_test_image, "image/png")}
+        )
 
+    publish.assert_called_once()
     assert response.status_code == 200
-    assert response.json() == {"detail": "Image upload request sent to the processing service"}
+    assert response.json()["detail"] == "Image upload request sent to the processing service"
+    assert len(response.json()["message_id"]) == 32
+
+
+def test_unconfirmed_publish_keeps_upload_until_outcome_is_known(client, create_test_image, tmp_path, monkeypatch):
+    monkeypatch.setattr(core_config, "staging_dir", str(tmp_path))
+    client.post("/auth/register", json={"username": "pendinguser", "password": "testpassword!"})
+    token = client.post(
+        "/auth/login", json={"username": "pendinguser", "password": "testpassword!"}
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    outcomes = []
+
+    async def publish(routing_key, message, properties=None):
+        # брокер не ответил за rabbitmq_publish_timeout, публикация продолжается
+        loop = asyncio.get_running_loop()
+        outcomes.append((loop, loop.create_future()))
+        raise PublishPendingError(outcomes[-1][1])
+
+    job_ids = []
+    with patch("apps.libs.broker.broker.publish", new=publish):
+        for name in ("delivered.png", "lost.png"):
+            create_test_image.seek(0)
+            response = client.post(
+                "/image/upload_image", headers=headers, files={"image": (name, create_test_image, "image/png")}
+            )
+            assert response.status_code == 200
+            job_ids.append(response.json()["job_id"])
+    assert len(os.listdir(tmp_path)) == 2
+
+    (loop, delivered), (_, lost) = outcomes
+    loop.call_soon_threadsafe(delivered.set_result, None)
+    loop.call_soon_threadsafe(lost.set_exception, pika.exceptions.AMQPConnectionError("connection lost"))
+
+    lost_job = client.get(f"/image/jobs/{job_ids[1]}", headers=headers, params={"wait": 5}).json()
+    assert lost_job["status"] == "failed"
+    assert client.get(f"/image/jobs/{job_ids[0]}", headers=headers).json()["status"] == "queued"
+    # staged-файл доставленного сообщения остается для воркера
+    assert len(os.listdir(tmp_path)) == 1
 
 
 def test_get_all_images(client, db):
@@ -96,3 +158,336 @@ def test_image_service_listener(client):
 
         mock_process_image_action(body)
         mock_process_image_action.assert_called_once_with(body)
+
+
+def test_upload_job_long_poll_and_events(client, create_test_image):
+    client.post("/auth/register", json={"username": "jobuser", "password": "testpassword!"})
+    token = client.post("/auth/login", json={"username": "jobuser", "password": "testpassword!"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    with patch("apps.main_api.image.image_service.send_message", new_callable=AsyncMock) as send_message:
+        send_message.side_effect = lambda event_type, data, message_id: message_id
+        response = client.post(
+            "/image/upload_image",
+            headers=headers,
+            files={"image": ("job_image.png", create_test_image, "image/png")}
+        )
+    job_id = response.json()["job_id"]
+    event_type, payload = send_message.call_args.args
+    assert client.get(f"/image/jobs/{job_id}", headers=headers).json()["status"] == "queued"
+
+    # воркер завершает задачу, пока клиент ждет в long-poll
+    body = json.dumps({"message_id": job_id, "event_type": event_type, "data": payload})
+    worker = threading.Timer(0.2, process_image_action, args=(body,))
+    worker.start()
+    job = client.get(f"/image/jobs/{job_id}", headers=headers, params={"wait": 10}).json()
+    worker.join()
+
+    assert job["status"] == "done"
+    assert client.get(f"/image/{job['image_id']}", headers=headers).status_code == 200
+
+    events = client.get(f"/image/jobs/{job_id}/events", headers=headers)
+    assert events.headers["content-type"].startswith("text/event-stream")
+    assert events.text.startswith("event: status\n")
+    assert '"status": "done"' in events.text
+
+
+def test_upload_rejects_oversized_and_non_image_files(client, create_test_image, monkeypatch):
+    client.post("/auth/register", json={"username": "guarduser", "password": "testpassword!"})
+    token = client.post("/auth/login", json={"username": "guarduser", "password": "testpassword!"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    with patch("apps.main_api.image.image_service.send_message", new_callable=AsyncMock) as send_message:
+        response = client.post(
+            "/image/upload_image",
+            headers=headers,
+            files={"image": ("notes.png", BytesIO(b"definitely not an image" * 100), "image/png")}
+        )
+        assert response.status_code == 415
+
+        # 100x100 по заголовку больше лимита: файл отклоняется без декодирования
+        monkeypatch.setattr(core_config, "max_image_pixels", 5000)
+        response = client.post(
+            "/image/upload_image",
+            headers=headers,
+            files={"image": ("huge.png", create_test_image, "image/png")}
+        )
+        assert response.status_code == 413
+        assert "100x100" in response.json()["detail"]
+
+        monkeypatch.setattr(core_config, "max_upload_bytes", 10)
+        create_test_image.seek(0)
+        response = client.post(
+            "/image/upload_image",
+            headers=headers,
+            files={"image": ("heavy.png", create_test_image, "image/png")}
+        )
+        assert response.status_code == 413
+
+    send_message.assert_not_called()
+
+
+def test_upload_guard_reads_past_large_app_segments():
+    image = BytesIO()
+    # ICC-профиль ~100 КБ: APP2-сегменты перед SOF длиннее upload_sniff_bytes
+    Image.new('RGB', (800, 600), color='green').save(image, format='JPEG', icc_profile=bytes(100 * 1024))
+    content = image.getvalue()
+    assert content.index(b"\xff\xc0") > core_config.upload_sniff_bytes
+
+    guard = UploadGuard()
+    for start in range(0, len(content), 16 * 1024):
+        guard.feed(content[start:start + 16 * 1024])
+    guard.finish()
+    assert (guard.format, guard.resolution) == ("JPEG", "800x600")
+
+    # неизвестная сигнатура отклоняется на первом куске
+    with pytest.raises(HTTPException) as rejected:
+        UploadGuard().feed(b"definitely not an image" * 100)
+    assert rejected.value.status_code == 415
+
+
+def test_metrics_endpoint_labels_requests_by_route_template(client):
+    client.get("/image/12345")
+    client.get("/no/such/path")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'route="/image/{image_id}"' in response.text
+    assert 'route="/image/12345"' not in response.text
+    assert 'route="unmatched",status="404"' in response.text
+    assert "image_stage_duration_seconds" in response.text
+
+
+def test_trace_context_propagates_from_request_to_worker(client, tmp_path, monkeypatch):
+    # свое изображение: уже обработанный исходник не рендерится повторно
+    image = BytesIO()
+    Image.new('RGB', (120, 80), color='green').save(image, format='PNG')
+    image.seek(0)
+    spans_path = tmp_path / "spans.jsonl"
+    monkeypatch.setattr(tracing, "exporter", tracing.JsonLinesExporter(str(spans_path)))
+    client.post("/auth/register", json={"username": "traceuser", "password": "testpassword!"})
+    token = client.post("/auth/login", json={"username": "traceuser", "password": "testpassword!"}).json()["access_token"]
+
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    with patch("apps.libs.broker.broker.publish", new_callable=AsyncMock) as publish:
+        response = client.post(
+            "/image/upload_image",
+            headers={"Authorization": f"Bearer {token}", "traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"},
+            files={"image": ("traced.png", image, "image/png")}
+        )
+    assert response.headers["x-trace-id"] == trace_id
+
+    queue, body, properties = publish.call_args.args
+    assert properties.headers["traceparent"].startswith(f"00-{trace_id}-")
+    callback(MagicMock(), SimpleNamespace(delivery_tag=1, routing_key=queue), properties, body)
+
+    spans = [json.loads(line) for line in spans_path.read_text().splitlines()]
+    by_name = {span["name"]: span for span in spans if span["trace_id"] == trace_id}
+    assert {"POST /image/upload_image", "publish", "queue_wait", "process", "open", "db_commit"} <= set(by_name)
+    # обработка в воркере - продолжение спана публикации, стадии - ее дочерние спаны
+    assert by_name["process"]["parent_id"] == by_name["publish"]["span_id"]
+    assert by_name["queue_wait"]["parent_id"] == by_name["publish"]["span_id"]
+    assert by_name["open"]["parent_id"] == by_name["process"]["span_id"]
+
+
+@pytest.mark.parametrize("mode", ["simple", "pool"])
+def test_memory_broker_runs_worker_in_api_process(create_test_image, monkeypatch, mode):
+    monkeypatch.setattr(core_config, "broker_backend", "memory")
+    monkeypatch.setattr(core_config, "image_worker_mode", mode)
+    # процессы пула внутри процесса API запускаются через spawn, а не fork
+    monkeypatch.setattr(core_config, "image_worker_processes", 1)
+    username = f"memory{mode}"
+
+    with TestClient(app) as client:
+        client.post("/auth/register", json={"username": username, "password": "testpassword!"})
+        token = client.post(
+            "/auth/login", json={"username": username, "password": "testpassword!"}
+        ).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        response = client.post(
+            "/image/upload_image",
+            headers=headers,
+            files={"image": ("memory.png", create_test_image, "image/png")}
+        )
+        job = client.get(f"/image/jobs/{response.json()['job_id']}", headers=headers, params={"wait": 10}).json()
+
+    assert job["status"] == "done"
+
+
+def test_batch_upload_publishes_accepted_files_in_one_batch(client):
+    client.post("/auth/register", json={"username": "batchuser", "password": "testpassword!"})
+    token = client.post("/auth/login", json={"username": "batchuser", "password": "testpassword!"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    files = []
+    for color in ("blue", "yellow"):
+        image = BytesIO()
+        Image.new('RGB', (64, 48), color=color).save(image, format='PNG')
+        files.append(("images", (f"{color}.png", image.getvalue(), "image/png")))
+    files.insert(1, ("images", ("notes.png", b"definitely not an image" * 100, "image/png")))
+
+    with patch("apps.libs.broker.broker.publish_batch", new_callable=AsyncMock) as publish_batch:
+        response = client.post("/image/upload_images", headers=headers, files=files)
+    assert response.status_code == 200
+    results = response.json()["files"]
+    assert [result["filename"] for result in results] == ["blue.png", "notes.png", "yellow.png"]
+    assert results[1]["status_code"] == 415 and "job_id" not in results[1]
+
+    publish_batch.assert_called_once()
+    queue, messages = publish_batch.call_args.args
+    assert [properties.message_id for _, properties in messages] == [results[0]["job_id"], results[2]["job_id"]]
+    for body, _ in messages:
+        process_image_action(body)
+    for result in (results[0], results[2]):
+        job = client.get(f"/image/jobs/{result['job_id']}", headers=headers).json()
+        assert job["status"] == "done"
+
+    response = client.post("/image/upload_images", headers=headers, data={"title": "no files"})
+    assert response.status_code == 400
+
+
+def test_inline_batch_upload_publishes_in_bounded_chunks(client, monkeypatch):
+    monkeypatch.setattr(core_config, "upload_transport", "inline")
+    monkeypatch.setattr(core_config, "upload_batch_publish_bytes", 1)
+    client.post("/auth/register", json={"username": "inlinebatch", "password": "testpassword!"})
+    token = client.post(
+        "/auth/login", json={"username": "inlinebatch", "password": "testpassword!"}
+    ).json()["access_token"]
+    files = []
+    for color in ("blue", "yellow", "green"):
+        image = BytesIO()
+        Image.new('RGB', (64, 48), color=color).save(image, format='PNG')
+        files.append(("images", (f"{color}.png", image.getvalue(), "image/png")))
+
+    with patch("apps.libs.broker.broker.publish_batch", new_callable=AsyncMock) as publish_batch:
+        response = client.post("/image/upload_images", headers={"Authorization": f"Bearer {token}"}, files=files)
+    assert response.status_code == 200
+    # файлы в теле сообщений не копятся до конца запроса: каждый публикуется сразу
+    assert [len(call.args[1]) for call in publish_batch.call_args_list] == [1, 1, 1]
+    assert all("message_id" in result for result in response.json()["files"])
+
+
+def test_similar_images_found_by_perceptual_hash(client):
+    client.post("/auth/register", json={"username": "similaruser", "password": "testpassword!"})
+    token = client.post(
+        "/auth/login", json={"username": "similaruser", "password": "testpassword!"}
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    original = Image.merge("RGB", (
+        Image.radial_gradient("L"), Image.linear_gradient("L"), Image.linear_gradient("L").rotate(90)
+    )).resize((320, 240))
+    sources = {
+        "original.png": (original, "PNG"),
+        # пересжатая и чуть осветленная копия - почти дубликат
+        "copy.jpg": (original.point(lambda value: min(255, value + 12)), "JPEG"),
+        "other.png": (original.rotate(180), "PNG")
+    }
+    with patch("apps.main_api.image.image_service.send_message", new_callable=AsyncMock) as send_message:
+        send_message.side_effect = lambda event_type, data, message_id: message_id
+        image_ids = {}
+        for filename, (image, img_format) in sources.items():
+            content = BytesIO()
+            image.save(content, format=img_format, quality=60)
+            job_id = client.post(
+                "/image/upload_image", headers=headers, files={"image": (filename, content.getvalue(), "image/png")}
+            ).json()["job_id"]
+            event_type, payload = send_message.call_args.args
+            process_image_action(json.dumps({"message_id": job_id, "event_type": event_type, "data": payload}))
+            image_ids[filename] = client.get(f"/image/jobs/{job_id}", headers=headers).json()["image_id"]
+
+    response = client.get(f"/image/{image_ids['original.png']}/similar", headers=headers, params={"max_distance": 6})
+    assert response.status_code == 200
+    similar = {item["id"]: item["distance"] for item in response.json()}
+    assert image_ids["copy.jpg"] in similar and similar[image_ids["copy.jpg"]] <= 6
+    assert image_ids["original.png"] not in similar
+    assert image_ids["other.png"] not in similar
+
+    response = client.get(f"/image/{image_ids['original.png']}/similar", headers=headers, params={"max_distance": 65})
+    assert response.status_code == 400
+
+
+def test_bk_tree_search_matches_linear_scan():
+    rng = random.Random(7)
+    hashes = []
+    tree = BKTree()
+    for image_id in range(3000):
+        # каждый третий хэш - соседний к предыдущему, чтобы были близкие пары
+        if image_id % 3 == 0 and hashes:
+            value = (hashes[-1] ^ (1 << rng.randrange(64))) & (2 ** 64 - 1)
+        else:
+            value = rng.getrandbits(64)
+        hashes.append(to_signed(value))
+        tree.add(hashes[-1], image_id)
+
+    for query in hashes[:30]:
+        for max_distance in (0, 4, 10):
+            expected = sorted(
+                (hamming_distance(query, value), image_id)
+                for image_id, value in enumerate(hashes) if hamming_distance(query, value) <= max_distance
+            )
+            assert sorted(tree.search(query, max_distance)) == expected
+
+
+def test_similarity_index_picks_up_late_commits(db):
+    user = User(username="lateuser", hashed_password="hash")
+    db.add(user)
+    db.commit()
+    base = 10 ** 6
+
+    def commit_image(image_id, phash):
+        db.add(ImageRecord(
+            id=image_id, title=f"{image_id}.png", file_path=f"{image_id}.png", resolution="8x8", size=1,
+            phash=phash, user_id=user.id
+        ))
+        db.commit()
+
+    async def search(index, phash):
+        async with AsyncSessionLocal() as session:
+            await index.refresh(session)
+        return [image_id for _, image_id in index.search(phash, 0)]
+
+    index = SimilarityIndex(batch_size=2)
+    expired = SimilarityIndex(batch_size=2, gap_timeout=0)
+    commit_image(base + 1, 11)
+    commit_image(base + 3, 33)
+    assert asyncio.run(search(index, 33)) == [base + 3]
+    assert asyncio.run(search(expired, 33)) == [base + 3]
+
+    # транзакция с меньшим id завершилась после того, как индекс прочитал base + 3
+    commit_image(base + 2, 22)
+    assert asyncio.run(search(index, 22)) == [base + 2]
+    assert asyncio.run(search(expired, 22)) == []
+    assert all(last <= base for _, last, _ in index._gaps)
+
+
+@pytest.mark.parametrize("file_response", [True, False])
+def test_gzip_passes_pathsend_through_for_any_media_type(tmp_path, file_response):
+    path = tmp_path / "blob.bin"
+    path.write_bytes(b"x" * 5000)
+
+    async def app(scope, receive, send):
+        if file_response:
+            response = ImageFileResponse(str(path), media_type="application/x-custom-blob", stat_result=os.stat(path))
+            await response(scope, receive, send)
+            return
+        # ответ без accept-ranges: pathsend приходит после заголовков, которые GZipResponder задержал
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/x-custom-blob")]})
+        await send({"type": "http.response.pathsend", "path": str(path)})
+
+    scope = {
+        "type": "http", "method": "GET", "path": "/", "query_string": b"",
+        "headers": [(b"accept-encoding", b"gzip")], "extensions": {"http.response.pathsend": {}}
+    }
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(SelectiveGZipMiddleware(app, minimum_size=1000)(scope, receive, send))
+    assert [message["type"] for message in sent] == ["http.response.start", "http.response.pathsend"]
+    assert b"content-encoding" not in dict(sent[0]["headers"])
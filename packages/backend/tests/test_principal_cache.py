@@ -0,0 +1,65 @@
+import pytest
+
+from fastapi.testclient import TestClient
+
+from apps.libs.auth.principal_cache import PrincipalCache, principal_cache
+from apps.libs.database.database import SessionLocal
+from apps.libs.database.models import User
+from apps.main_api.main import app
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_and_least_recently_used_is_evicted():
+    clock = FakeClock()
+    cache = PrincipalCache(max_size=2, ttl=10, clock=clock)
+
+    cache.put(1, "alice")
+    cache.put(2, "bob")
+    assert cache.get(1) == "alice"
+    cache.put(3, "carol")
+    assert cache.get(2) is None
+    assert cache.get(1) == "alice"
+
+    clock.now = 11
+    assert cache.get(1) is None
+    assert cache.get(3) is None
+
+
+def test_password_change_invalidates_cached_user(client, db):
+    client.post("/auth/register", json={"username": "cacheduser", "password": "testpassword!"})
+    token = client.post("/auth/login", json={"username": "cacheduser", "password": "testpassword!"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    assert client.get("/image/get_all_images", headers=headers).status_code == 200
+    user = db.query(User).filter_by(username="cacheduser").first()
+    assert principal_cache.get(user.id) is not None
+
+    user.hashed_password = "changed"
+    db.commit()
+    assert principal_cache.get(user.id) is None
+
+    db.delete(user)
+    db.commit()
+    assert client.get("/image/get_all_images", headers=headers).status_code == 401
@@ -0,0 +1,67 @@
+import asyncio
+import threading
+import time
+
+from apps.main_api.image.render_cache import RenderCache
+
+
+def test_concurrent_requests_share_one_render(tmp_path):
+    cache = RenderCache(directory=str(tmp_path), memory_max_bytes=1024, memory_item_max_bytes=1024)
+    renders = []
+
+    def render():
+        renders.append(threading.get_ident())
+        time.sleep(0.05)
+        return b"rendered"
+
+    async def request_many():
+        return await asyncio.gather(*(cache.get_or_render("key", render) for _ in range(5)))
+
+    assert asyncio.run(request_many()) == [b"rendered"] * 5
+    assert len(renders) == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["collapsed"] == 4
+
+    assert asyncio.run(cache.get_or_render("key", render)) == b"rendered"
+    assert cache.stats()["memory_hits"] == 1
+
+
+def test_disk_layer_evicts_least_recently_used(tmp_path):
+    cache = RenderCache(
+        directory=str(tmp_path),
+        memory_max_bytes=0,
+        memory_item_max_bytes=0,
+        disk_max_bytes=20
+    )
+
+    for key in ("a", "b", "c"):
+        asyncio.run(cache.get_or_render(key, lambda: b"0123456789"))
+
+    stats = cache.stats()
+    assert stats["disk_evictions"] == 1
+    assert stats["disk_bytes"] == 20
+
+    asyncio.run(cache.get_or_render("c", lambda: b"unused"))
+    assert cache.stats()["disk_hits"] == 1
+
+    reopened = RenderCache(directory=str(tmp_path), disk_max_bytes=20)
+    assert reopened.stats()["disk_items"] == 2
+
+
+def test_cancelled_request_does_not_cancel_collapsed_waiters(tmp_path):
+    cache = RenderCache(directory=str(tmp_path), memory_max_bytes=1024, memory_item_max_bytes=1024)
+
+    def render():
+        time.sleep(0.1)
+        return b"rendered"
+
+    async def leader_cancelled():
+        leader = asyncio.create_task(cache.get_or_render("key", render))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.get_or_render("key", render))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await waiter, leader.cancelled()
+
+    assert asyncio.run(leader_cancelled()) == (b"rendered", True)
+    assert cache.stats()["misses"] == 1